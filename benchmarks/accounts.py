@@ -0,0 +1,113 @@
+"""Latency of latest account state lookups versus the number of historical versions.
+
+The `max(version) GROUP BY account` subquery used before `latest_account_states` is timed next
+to the point lookups through that table. `pair` looks up two accounts, as make-money does, and
+`page` reads the first page of all accounts with their total, as query-accounts does.
+
+Run with ``python3 -m benchmarks.accounts``. Hashes are random bytes, only the lookups are timed.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from functools import partial
+from typing import Any, Callable, List
+
+from sqlalchemy import select, func, and_
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession  # type: ignore
+
+from horde.models import Base, AccountState, select_latest_account_states, upgrade_schema
+
+INSERT_CHUNK_SIZE = 10000
+
+
+def select_latest_account_states_by_max(*accounts: str) -> Any:
+    # the subquery the processors used before
+    subquery = select(
+        AccountState.account,  # type: ignore
+        func.max(AccountState.version).label('latest_version')
+    )
+    if accounts:
+        subquery = subquery.where(AccountState.account.in_(accounts))
+    subquery = subquery.group_by(AccountState.account).alias('latest')  # type: ignore
+    # noinspection PyUnresolvedReferences,PyTypeChecker
+    return select(AccountState).join(subquery, and_(  # type: ignore
+        AccountState.account == subquery.c.account,  # type: ignore
+        AccountState.version == subquery.c.latest_version,  # type: ignore
+    ))
+
+
+async def fill(path: str, versions: int, accounts: int) -> None:
+    engine = create_async_engine('sqlite:///' + path)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.exec_driver_sql('DROP TABLE latest_account_states')
+        rows: List[Any] = []
+        for index in range(versions):
+            rows.append({
+                'account': 'client%d' % (index % accounts),
+                'version': index // accounts + 1,
+                'value': 0.0,
+                'hash': os.urandom(32),
+            })
+            if len(rows) == INSERT_CHUNK_SIZE:
+                await conn.execute(AccountState.__table__.insert(), rows)
+                rows = []
+        if rows:
+            await conn.execute(AccountState.__table__.insert(), rows)
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade_schema)
+    await engine.dispose()
+
+
+async def query_pair(session: AsyncSession, select_latest: Callable[..., Any]) -> None:
+    result = list((await session.execute(select_latest('client0', 'client1'))).scalars())
+    assert len(result) == 2
+
+
+async def query_page(session: AsyncSession, select_latest: Callable[..., Any]) -> None:
+    stmt = select_latest()
+    await session.execute(select(func.count(stmt.alias('data').c.hash)))
+    list((await session.execute(stmt.limit(15))).scalars())
+
+
+async def measure(query: Callable[[], Any], repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await query()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+async def run(args: argparse.Namespace) -> None:
+    print('%10s %6s %16s %16s %10s' % ('versions', 'query', 'max ms', 'latest ms', 'speedup'))
+    for versions in args.versions:
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'sqlite.db')
+            await fill(path, versions, args.accounts)
+            engine = create_async_engine('sqlite:///' + path)
+            async with AsyncSession(engine) as session:
+                for name, query in (('pair', query_pair), ('page', query_page)):
+                    by_max = await measure(
+                        partial(query, session, select_latest_account_states_by_max), args.repeat)
+                    latest = await measure(
+                        partial(query, session, select_latest_account_states), args.repeat)
+                    print('%10d %6s %16.3f %16.3f %9.1fx' % (
+                        versions, name, by_max * 1000, latest * 1000, by_max / latest))
+            await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--versions', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='historical account versions in the database')
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Bytes on the wire and encode+decode time of a block, JSON versus msgpack.
+
+Run with ``python3 -m benchmarks.codec``.
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from functools import partial
+from typing import Any, Callable
+
+from horde.codec import encode, decode, as_bytes, JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, \
+    HAS_MSGPACK
+from horde.processors.node import NodeProcessor
+
+
+def random_block(transactions: int, mutations: int) -> Any:
+    def account_state(version: int) -> Any:
+        return {'hash': os.urandom(32), 'version': version, 'value': 100.0}
+    return {
+        'hash': os.urandom(32),
+        'prev_hash': os.urandom(32),
+        'timestamp': datetime.utcnow(),
+        'number': 100,
+        'transactions': [{
+            'hash': os.urandom(32),
+            'endorser': 'endorser1',
+            'signature': os.urandom(64),
+            'timestamp': datetime.utcnow(),
+            'mutations': [{
+                'hash': os.urandom(32),
+                'account': 'client%d' % j,
+                'prev_account_state': account_state(1),
+                'next_account_state': account_state(2),
+            } for j in range(mutations)],
+        } for _ in range(transactions)],
+    }
+
+
+def read_hashes(data: Any) -> None:
+    # what the check_valid_* functions do with the hashes of a received block
+    as_bytes(data['hash'])
+    as_bytes(data['prev_hash'])
+    for transaction in data['transactions']:
+        as_bytes(transaction['hash'])
+        as_bytes(transaction['signature'])
+        for mutation in transaction['mutations']:
+            as_bytes(mutation['hash'])
+            as_bytes(mutation['prev_account_state']['hash'])
+            as_bytes(mutation['next_account_state']['hash'])
+
+
+def decode_block(raw: bytes, content_type: str) -> None:
+    read_hashes(decode(raw, content_type))
+
+
+def best_time(func: Callable[[], Any], repeat: int) -> float:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        result.append(time.perf_counter() - start)
+    return min(result)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=500)
+    parser.add_argument('--mutations', type=int, default=3, help='mutations per transaction')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    data = NodeProcessor.serialize_blockchain(random_block(args.transactions, args.mutations))
+    content_types = [JSON_CONTENT_TYPE] + ([MSGPACK_CONTENT_TYPE] if HAS_MSGPACK else [])
+    print('%-22s %12s %12s %12s' % ('encoding', 'bytes', 'encode ms', 'decode ms'))
+    for content_type in content_types:
+        raw = encode(data, content_type)
+        encode_time = best_time(partial(encode, data, content_type), args.repeat)
+        decode_time = best_time(partial(decode_block, raw, content_type), args.repeat)
+        print('%-22s %12d %12.2f %12.2f' % (
+            content_type, len(raw), encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Operations per second of every primitive on every available crypto backend.
+
+Run with ``python3 -m benchmarks.crypto``.
+"""
+import argparse
+import os
+import time
+from typing import Callable, List, Tuple
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+
+from horde.crypto import available_backends, CryptoBackend
+
+
+def operations(backend: CryptoBackend) -> List[Tuple[str, Callable[[], object]]]:
+    public_key, private_key = generate_keypair()
+    message = os.urandom(256)
+    key = os.urandom(32)
+    init_vector = os.urandom(16)
+    frame = os.urandom(16 * 1024)
+    encrypted_frame = backend.sm4_encrypt_cbc(key, init_vector, frame)
+    signature = backend.sm2_sign(message, private_key)
+    encrypted_random = backend.sm2_encrypt(os.urandom(16), public_key)
+    return [
+        ('sm3 256B', lambda: backend.sm3_digest(message)),
+        ('sm4 encrypt 16KiB', lambda: backend.sm4_encrypt_cbc(key, init_vector, frame)),
+        ('sm4 decrypt 16KiB', lambda: backend.sm4_decrypt_cbc(key, init_vector, encrypted_frame)),
+        ('sm2 sign', lambda: backend.sm2_sign(message, private_key)),
+        ('sm2 verify', lambda: backend.sm2_verify(signature, message, public_key)),
+        ('sm2 encrypt', lambda: backend.sm2_encrypt(message[:16], public_key)),
+        ('sm2 decrypt', lambda: backend.sm2_decrypt(encrypted_random, private_key)),
+    ]
+
+
+def ops_per_second(operation: Callable[[], object], duration: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < duration:
+        operation()
+        count += 1
+        elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=0.5,
+                        help='seconds spent on each primitive')
+    args = parser.parse_args()
+    backends = available_backends()
+    results = {backend.name: operations(backend) for backend in backends}
+    print('%-20s' % 'ops/s' + ''.join('%14s' % backend.name for backend in backends))
+    for index, (name, _) in enumerate(results[backends[0].name]):
+        print('%-20s' % name + ''.join(
+            '%14.1f' % ops_per_second(results[backend.name][index][1], args.duration)
+            for backend in backends))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Latency of query-transaction and query-account-history versus the length of the chain.
+
+A chain is grown to each size in turn and looked up at every size. Both RPCs are index
+searches, so their latency should hardly move between sizes. ``walk`` is how a transaction was
+found before: list-blockchains and query-blockchain from the tip until the block holding it,
+here for a transaction ``--depth`` blocks below the tip.
+
+Run with ``python3 -m benchmarks.history``. Hashes and signatures are random bytes.
+"""
+import argparse
+import asyncio
+import functools
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List
+
+from benchmarks.router import request_context
+from benchmarks.storage import storage_peer
+from horde.codec import encode_cursor
+from horde.models import Base, AccountState, LatestAccountState, TransactionMutation, \
+    Transaction, Blockchain
+from horde.processors.peer import PeerProcessor
+from horde.storage import create_storage_engine
+
+INSERT_CHUNK_SIZE = 1000  # blocks
+SAMPLE_SIZE = 1000
+
+
+class Chain:
+    # appends blocks of random transactions, remembering a sample of their hashes
+    def __init__(self, path: str, args: argparse.Namespace):
+        self.path = path
+        self.args = args
+        self.versions = {'client%d' % index: 1 for index in range(args.accounts)}
+        self.accounts = list(self.versions)
+        self.number = 0
+        self.transaction_count = 0
+        self.sample: List[bytes] = []
+        self.blocks: List[List[bytes]] = []  # transactions of the latest blocks
+
+    async def create(self) -> None:
+        engine = create_storage_engine(self.path, {})
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(AccountState.__table__.insert(), [{
+                'account': account, 'version': 1, 'value': 0.0, 'hash': os.urandom(32),
+            } for account in self.accounts])
+        await engine.dispose()
+
+    async def grow(self, transactions: int) -> None:
+        engine = create_storage_engine(self.path, {})
+        timestamp = datetime.utcnow()
+        rows: Dict[Any, List[Any]] = {table: [] for table in (
+            Blockchain.__table__, Transaction.__table__, TransactionMutation.__table__,
+            AccountState.__table__)}
+        while self.transaction_count < transactions:
+            self.number += 1
+            blockchain_hash = os.urandom(32)
+            rows[Blockchain.__table__].append({
+                'hash': blockchain_hash, 'prev_hash': os.urandom(32), 'timestamp': timestamp,
+                'number': self.number,
+            })
+            hashes = []
+            for _ in range(self.args.block_size):
+                transaction_hash = os.urandom(32)
+                hashes.append(transaction_hash)
+                self.transaction_count += 1
+                if len(self.sample) < SAMPLE_SIZE:
+                    self.sample.append(transaction_hash)
+                elif random.random() < SAMPLE_SIZE / self.transaction_count:
+                    self.sample[random.randrange(SAMPLE_SIZE)] = transaction_hash
+                rows[Transaction.__table__].append({
+                    'hash': transaction_hash, 'signature': os.urandom(64),
+                    'endorser': 'endorser1', 'timestamp': timestamp,
+                    'blockchain_hash': blockchain_hash,
+                })
+                for account in random.sample(self.accounts, 2):
+                    self.versions[account] += 1
+                    version = self.versions[account]
+                    rows[TransactionMutation.__table__].append({
+                        'hash': os.urandom(32), 'account': account, 'prev_version': version - 1,
+                        'next_version': version, 'transaction_hash': transaction_hash,
+                    })
+                    rows[AccountState.__table__].append({
+                        'account': account, 'version': version, 'value': float(version),
+                        'hash': os.urandom(32),
+                    })
+            self.blocks = (self.blocks + [hashes])[-self.args.depth - 1:]
+            if self.number % INSERT_CHUNK_SIZE == 0 or self.transaction_count >= transactions:
+                async with engine.begin() as conn:
+                    for table, table_rows in rows.items():
+                        await conn.execute(table.insert(), table_rows)
+                        table_rows.clear()
+        async with engine.begin() as conn:
+            await conn.execute(LatestAccountState.__table__.delete())
+            await conn.execute(LatestAccountState.__table__.insert(), [
+                {'account': account, 'version': version}
+                for account, version in self.versions.items()])
+        await engine.dispose()
+
+
+async def measure(query: Callable[[], Awaitable[Any]], repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await query()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+async def query_transaction(peer: PeerProcessor, chain: Chain) -> None:
+    await peer.query_transaction_handler({'hash': random.choice(chain.sample)},
+                                         request_context(peer))
+
+
+async def query_history(peer: PeerProcessor, chain: Chain, deep: bool) -> None:
+    # the first page of a random account, or the page from the middle of its history
+    account = random.choice(chain.accounts)
+    data: Dict[str, Any] = {'account': account}
+    if deep:
+        data['cursor'] = encode_cursor([chain.versions[account] // 2 + 1])
+    await peer.query_account_history_handler(data, request_context(peer))
+
+
+async def walk(peer: PeerProcessor, transaction_hash: bytes) -> None:
+    # from the tip, a page of block numbers and then each block until the transaction
+    context = request_context(peer)
+    cursor = None
+    while True:
+        page = await peer.list_blockchains_handler(
+            {'cursor': cursor} if cursor else {}, context)
+        for item in page['data']:
+            blockchain = await peer.query_blockchain_handler(
+                {'blockchain_number': item['number']}, context)
+            if any(transaction['hash'] == transaction_hash
+                   for transaction in blockchain['transactions']):
+                return
+        cursor = page['next_cursor']
+
+
+async def run(args: argparse.Namespace) -> None:
+    print('%12s %14s %14s %14s %12s' % ('transactions', 'transaction ms', 'history ms',
+                                        'deep page ms', 'walk ms'))
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        os.makedirs(os.path.join(root, 'endorser1'))  # the directory of the peers
+        chain = Chain(os.path.join(root, 'endorser1', 'sqlite.db'), args)
+        await chain.create()
+        for size in args.sizes:
+            await chain.grow(size)
+            peer = storage_peer(root, {'read_connections': 1, 'priority_read_connections': 1})
+            await peer.warm_state_cache()
+            transaction = await measure(functools.partial(query_transaction, peer, chain),
+                                        args.repeat)
+            history = await measure(functools.partial(query_history, peer, chain, False),
+                                    args.repeat)
+            deep = await measure(functools.partial(query_history, peer, chain, True),
+                                 args.repeat)
+            walked = await measure(functools.partial(walk, peer, chain.blocks[0][0]), 3)
+            await peer.read_pool.close()
+            print('%12d %14.3f %14.3f %14.3f %12.1f' % (
+                chain.transaction_count, transaction * 1000, history * 1000, deep * 1000,
+                walked * 1000))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=None, help='where the database is created')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='transactions in the chain, each mutating 2 accounts')
+    parser.add_argument('--block-size', type=int, default=10, help='transactions per block')
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=100,
+                        help='blocks between the tip and the transaction walked to')
+    parser.add_argument('--repeat', type=int, default=50)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
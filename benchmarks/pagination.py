@@ -0,0 +1,142 @@
+"""Latency of list-blockchains and query-accounts pages versus how deep the page is.
+
+Pages were read with ``OFFSET`` and a ``count(*)`` of the whole result, both linear in the
+length of the chain. They are timed next to the handlers, which turn offsets of blocks into a
+range of numbers, read pages after a cursor and take totals from counters.
+
+Run with ``python3 -m benchmarks.pagination``. Hashes are random bytes, only the reads are timed.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from functools import partial
+from typing import Any, Awaitable, Callable, List
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from benchmarks.router import request_context
+from benchmarks.storage import storage_peer
+from horde.codec import encode_cursor
+from horde.models import Base, AccountState, LatestAccountState, Blockchain
+from horde.storage import create_storage_engine
+
+INSERT_CHUNK_SIZE = 10000
+PAGE_SIZE = 15
+
+
+async def insert(conn: Any, table: Any, rows: Any) -> None:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            await conn.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        await conn.execute(table.insert(), chunk)
+
+
+async def fill(path: str, args: argparse.Namespace) -> None:
+    engine = create_storage_engine(path, {})
+    timestamp = datetime.utcnow()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await insert(conn, Blockchain.__table__, ({
+            'hash': os.urandom(32), 'prev_hash': os.urandom(32), 'timestamp': timestamp,
+            'number': number,
+        } for number in range(1, args.blocks + 1)))
+        await insert(conn, AccountState.__table__, ({
+            'account': 'client%d' % account, 'version': version, 'value': 0.0,
+            'hash': os.urandom(32),
+        } for account in range(args.accounts) for version in range(1, args.versions + 1)))
+        await insert(conn, LatestAccountState.__table__, ({
+            'account': 'client%d' % account, 'version': args.versions,
+        } for account in range(args.accounts)))
+    await engine.dispose()
+
+
+def offset_page(stmt: Any, offset: int) -> Callable[[Session], Any]:
+    # how both handlers read a page before
+    def query(session: Session) -> Any:
+        total = session.execute(select(func.count(stmt.alias('data').c.hash))).scalar()
+        return list(session.execute(stmt.offset(offset).limit(PAGE_SIZE)).scalars()), total
+    return query
+
+
+def last_state_before(offset: int) -> Callable[[Session], Any]:
+    # the cursor of the accounts a client got with the previous page
+    def query(session: Session) -> Any:
+        return session.execute(
+            select(AccountState.account, AccountState.version)  # type: ignore
+                .order_by(AccountState.account, AccountState.version)
+                .offset(offset - 1).limit(1)).all()
+    return query
+
+
+async def measure(query: Callable[[], Awaitable[Any]], repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await query()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+async def run(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        peer = storage_peer(root, {'read_connections': 1, 'priority_read_connections': 1})
+        await fill(os.path.join(peer.config['root'], 'sqlite.db'), args)
+        await peer.warm_state_cache()
+        context = request_context(peer)
+        # noinspection PyTypeChecker
+        all_blocks = select(Blockchain).order_by(Blockchain.number.desc())  # type: ignore
+        # noinspection PyTypeChecker
+        all_states = select(AccountState)  # type: ignore
+        print('%8s %10s %12s %12s %12s' % ('page', 'rpc', 'before ms', 'offset ms',
+                                           'cursor ms'))
+        for page in args.pages:
+            offset = (page - 1) * PAGE_SIZE
+            # the cursor a client got with the previous page
+            assert peer.tip is not None
+            block_cursor = encode_cursor([peer.tip[1] + 1 - offset])
+            previous: List[Any] = await peer.read_pool.run(last_state_before(offset)) \
+                if offset else []
+            timings = [await measure(partial(peer.read_pool.run, offset_page(all_blocks, offset)),
+                                     args.repeat)]
+            for query in ({'offset': offset}, {'cursor': block_cursor} if offset else {}):
+                timings.append(await measure(partial(peer.list_blockchains_handler,
+                                                     dict(query, limit=PAGE_SIZE), context),
+                                             args.repeat))
+            print('%8d %10s %12.3f %12.3f %12.3f' % (page, 'blocks', *[
+                timing * 1000 for timing in timings]))
+            timings = [await measure(partial(peer.read_pool.run, offset_page(all_states, offset)),
+                                     args.repeat)]
+            for query in ({'offset': offset},
+                          {'cursor': encode_cursor(list(previous[0]))} if previous else {}):
+                timings.append(await measure(partial(peer.query_accounts_handler,
+                                                     dict(query, limit=PAGE_SIZE), context),
+                                             args.repeat))
+            print('%8d %10s %12.3f %12.3f %12.3f' % (page, 'accounts', *[
+                timing * 1000 for timing in timings]))
+        await peer.read_pool.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=None, help='where the database is created')
+    parser.add_argument('--blocks', type=int, default=200000)
+    parser.add_argument('--accounts', type=int, default=2000)
+    parser.add_argument('--versions', type=int, default=100,
+                        help='versions of each account, all accounts are in the pages')
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 100, 10000],
+                        help='pages of %d items' % PAGE_SIZE)
+    parser.add_argument('--repeat', type=int, default=10)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
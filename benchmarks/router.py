@@ -0,0 +1,237 @@
+"""Benchmarks for the Router connection engine.
+
+Run with ``python3 -m benchmarks.router``. The throughput and batch benchmarks connect two routers
+over plain TCP, so the numbers do not include SM TLS.
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, List, Tuple, cast
+
+from benchmarks.codec import random_block
+from horde.codec import JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, HAS_MSGPACK
+from horde.processors.node import NodeProcessor
+from horde.processors.router import Router, Context, processor, on_requested
+from horde.sm_tls import SMTLSStreamReader, SMTLSStreamWriter
+from horde.testing import create_processor
+
+
+def fake_router(root: str, peers: int, content_type: str) -> Router:
+    router = create_processor(Router, root, 'router')
+    for i in range(peers):
+        id_ = 'connection%d' % i
+        router.writer_queues[id_] = asyncio.Queue()
+        router.connection_to_config[id_] = {'id': 'peer%d' % i, 'type': 'peer'}
+        router.content_types[id_] = content_type
+    return router
+
+
+def drain_queues(router: Router) -> int:
+    # what the writer tasks do with the queued items
+    size = 0
+    for id_, queue in router.writer_queues.items():
+        while not queue.empty():
+            size += len(router.frame_outgoing(queue.get_nowait(), id_))
+    return size
+
+
+async def notify_all(router: Router, data: Any) -> None:
+    await asyncio.gather(*[router.notify('new-blockchain', data, connection)
+                           for connection in router.connection_to_config])
+
+
+async def broadcast(router: Router, data: Any) -> None:
+    await router.broadcast('new-blockchain', data)
+
+
+async def best_time(func: Callable[[Router, Any], Awaitable[None]], router: Router,
+                    data: Any, repeat: int) -> float:
+    result: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func(router, data)
+        drain_queues(router)
+        result.append(time.perf_counter() - start)
+    return min(result)
+
+
+async def run_broadcast(args: argparse.Namespace) -> None:
+    data = NodeProcessor.serialize_blockchain(random_block(args.transactions, args.mutations))
+    content_types = [JSON_CONTENT_TYPE] + ([MSGPACK_CONTENT_TYPE] if HAS_MSGPACK else [])
+    print('%-22s %6s %12s %12s %8s' % ('encoding', 'peers', 'notify ms', 'broadcast ms',
+                                        'speedup'))
+    with tempfile.TemporaryDirectory() as root:
+        for content_type in content_types:
+            for peers in args.peers:
+                router = fake_router(root, peers, content_type)
+                notify_time = await best_time(notify_all, router, data, args.repeat)
+                broadcast_time = await best_time(broadcast, router, data, args.repeat)
+                print('%-22s %6d %12.2f %12.2f %7.1fx' % (
+                    content_type, peers, notify_time * 1000, broadcast_time * 1000,
+                    notify_time / broadcast_time))
+
+
+@processor
+class EchoProcessor(Router):
+    @on_requested('echo')
+    async def echo_handler(self, data: Any, context: Context) -> Any:
+        if data['delay']:  # the handler waits, like for a database query
+            await asyncio.sleep(data['delay'])
+        return data
+
+
+def echo_router(root: str, id_: str, in_flight: int) -> Router:
+    return create_processor(EchoProcessor, root, id_, sections={'rpc': {
+        'request_timeout': None,
+        'writer_queue_size': 2 * in_flight,
+        'max_concurrent_requests': in_flight,
+    }})
+
+
+def request_context(router: Router, connection_id: str = 'client') -> Context:
+    # for handlers called directly, as if the request came on `connection_id`
+    return Context(router, connection_id, None, lambda config: None)
+
+
+async def delay_relay(port: int, latency: float) -> int:
+    # forwards both directions after `latency` seconds, like a network link, returns the port to
+    # connect to instead of `port`
+    async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            loop.call_later(latency, writer.write, data)
+        loop.call_later(latency, writer.close)
+
+    async def callback(reader, writer):
+        server_reader, server_writer = await asyncio.open_connection('127.0.0.1', port)
+        asyncio.create_task(pipe(reader, server_writer))
+        asyncio.create_task(pipe(server_reader, writer))
+    relay = await asyncio.start_server(callback, '127.0.0.1', 0)
+    assert relay.sockets
+    return relay.sockets[0].getsockname()[1]
+
+
+async def connect(client: Router, server: Router,
+                  latency: float = 0.0) -> Tuple[str, asyncio.AbstractServer]:
+    connected = asyncio.Event()
+
+    async def callback(reader, writer):
+        asyncio.create_task(server.on_connected('client', 'server', reader, writer,
+                                                {'id': 'client', 'type': 'client'}))
+        connected.set()
+    tcp_server = await asyncio.start_server(callback, '127.0.0.1', 0)
+    assert tcp_server.sockets
+    port = tcp_server.sockets[0].getsockname()[1]
+    if latency:
+        port = await delay_relay(port, latency)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    # plain TCP, the router only uses the stream interface of the SM TLS reader and writer
+    asyncio.create_task(client.on_connected('server', None, cast(SMTLSStreamReader, reader),
+                                            cast(SMTLSStreamWriter, writer),
+                                            {'id': 'server', 'type': 'peer'}))
+    await connected.wait()
+    await asyncio.sleep(0)  # let the client start its connection
+    return 'server', tcp_server
+
+
+async def throughput(root: str, in_flight: int, delay: float, duration: float) -> float:
+    client = echo_router(root, 'client', in_flight)
+    server = echo_router(root, 'server', in_flight)
+    connection, tcp_server = await connect(client, server)
+    count = 0
+    end = time.perf_counter() + duration
+
+    async def worker() -> None:
+        nonlocal count
+        while time.perf_counter() < end:
+            await client.request('echo', {'delay': delay}, connection)
+            count += 1
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(in_flight)])
+    elapsed = time.perf_counter() - start
+    client.close_connection(connection)
+    server.close_connection('client')
+    tcp_server.close()
+    # a request and its response are two messages
+    return 2 * count / elapsed
+
+
+async def run_throughput(args: argparse.Namespace) -> None:
+    print('%10s %10s %12s' % ('in-flight', 'delay ms', 'msgs/s'))
+    with tempfile.TemporaryDirectory() as root:
+        for delay in args.delay:
+            for in_flight in args.in_flight:
+                result = max([await throughput(root, in_flight, delay, args.duration)
+                              for _ in range(args.repeat)])
+                print('%10d %10g %12.0f' % (in_flight, delay * 1000, result))
+
+
+async def query_time(root: str, queries: int, latency: float, batch: bool) -> float:
+    client = echo_router(root, 'client', queries)
+    server = echo_router(root, 'server', queries)
+    connection, tcp_server = await connect(client, server, latency)
+    calls = [('echo', {'delay': 0, 'number': i}) for i in range(queries)]
+    start = time.perf_counter()
+    if batch:
+        await client.request_many(calls, connection)
+    else:
+        for method, data in calls:
+            await client.request(method, data, connection)
+    elapsed = time.perf_counter() - start
+    client.close_connection(connection)
+    server.close_connection('client')
+    tcp_server.close()
+    return elapsed
+
+
+async def run_batch(args: argparse.Namespace) -> None:
+    print('%12s %14s %12s %8s' % ('latency ms', 'sequential ms', 'batch ms', 'speedup'))
+    with tempfile.TemporaryDirectory() as root:
+        for latency in args.latency:
+            sequential = min([await query_time(root, args.queries, latency, False)
+                              for _ in range(args.repeat)])
+            batch = min([await query_time(root, args.queries, latency, True)
+                         for _ in range(args.repeat)])
+            print('%12g %14.2f %12.2f %7.1fx' % (latency * 1000, sequential * 1000,
+                                                 batch * 1000, sequential / batch))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of several runs')
+    sub_parsers = parser.add_subparsers(title='benchmark')
+    parser_broadcast = sub_parsers.add_parser(
+        'broadcast', help='send a block to every peer, one notify each versus a broadcast')
+    parser_broadcast.add_argument('--peers', type=int, nargs='+', default=[4, 16, 64])
+    parser_broadcast.add_argument('--transactions', type=int, default=500)
+    parser_broadcast.add_argument('--mutations', type=int, default=3,
+                                  help='mutations per transaction')
+    parser_broadcast.set_defaults(func=run_broadcast)
+    parser_throughput = sub_parsers.add_parser(
+        'throughput', help='messages per second of one connection')
+    parser_throughput.add_argument('--in-flight', type=int, nargs='+', default=[1, 100, 1000],
+                                   help='concurrent requests')
+    parser_throughput.add_argument('--delay', type=float, nargs='+', default=[0, 0.01],
+                                   help='seconds each handler waits')
+    parser_throughput.add_argument('--duration', type=float, default=2.0,
+                                   help='seconds per run')
+    parser_throughput.set_defaults(func=run_throughput)
+    parser_batch = sub_parsers.add_parser(
+        'batch', help='latency of small queries, one batch versus one request after another')
+    parser_batch.add_argument('--queries', type=int, default=50)
+    parser_batch.add_argument('--latency', type=float, nargs='+', default=[0, 0.001],
+                              help='seconds added to each direction of the link')
+    parser_batch.set_defaults(func=run_batch)
+    args = parser.parse_args()
+    if 'func' in args:
+        asyncio.run(args.func(args))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
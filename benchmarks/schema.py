@@ -0,0 +1,164 @@
+"""Latency of loading a block by query-blockchain before and after the schema upgrade.
+
+A database is filled with the tables of ``main.py init`` from before the column types of the
+transactions and mutations were fixed and indexed. Blocks are loaded from it, then it is
+upgraded in place by ``upgrade_schema`` and the same blocks are loaded again. The query plans
+of the statements of a block load are printed for both schemas.
+
+Run with ``python3 -m benchmarks.schema``. Hashes and signatures are random bytes.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import event
+
+from benchmarks.router import request_context
+from benchmarks.storage import storage_peer
+from horde.models import Base, AccountState, LatestAccountState, TransactionMutation, \
+    Transaction, Blockchain, upgrade_schema
+from horde.processors.peer import PeerProcessor
+from horde.storage import create_storage_engine
+
+INSERT_CHUNK_SIZE = 10000
+# the tables of `main.py init` before their column types were fixed and indexed
+LEGACY_TABLES = [
+    '''CREATE TABLE transactions (
+        hash BLOB NOT NULL, signature BLOB NOT NULL, endorser VARCHAR NOT NULL,
+        timestamp TIMESTAMP NOT NULL, blockchain_hash INTEGER NOT NULL, mutations_root BLOB,
+        PRIMARY KEY (hash), FOREIGN KEY(blockchain_hash) REFERENCES blockchains (hash))''',
+    '''CREATE TABLE transaction_mutations (
+        hash BLOB NOT NULL, account INTEGER NOT NULL, prev_version INTEGER NOT NULL,
+        next_version INTEGER NOT NULL, transaction_hash INTEGER NOT NULL, PRIMARY KEY (hash),
+        FOREIGN KEY(account) REFERENCES account_states (account),
+        FOREIGN KEY(prev_version) REFERENCES account_states (version),
+        FOREIGN KEY(next_version) REFERENCES account_states (version),
+        FOREIGN KEY(transaction_hash) REFERENCES transactions (hash))''',
+]
+
+
+async def fill(path: str, args: argparse.Namespace) -> None:
+    engine = create_storage_engine(path, {})
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.exec_driver_sql('DROP TABLE transaction_mutations')
+        await conn.exec_driver_sql('DROP TABLE transactions')
+        for statement in LEGACY_TABLES:
+            await conn.exec_driver_sql(statement)
+    timestamp = datetime.utcnow()
+    versions = {'client%d' % index: 1 for index in range(args.accounts)}
+    rows: Dict[Any, List[Any]] = {table: [] for table in (
+        Blockchain.__table__, Transaction.__table__, TransactionMutation.__table__,
+        AccountState.__table__)}
+    rows[AccountState.__table__].extend({
+        'account': account, 'version': 1, 'value': 0.0, 'hash': os.urandom(32),
+    } for account in versions)
+    accounts = list(versions)
+    for number in range(1, args.blocks + 1):
+        blockchain_hash = os.urandom(32)
+        rows[Blockchain.__table__].append({
+            'hash': blockchain_hash, 'prev_hash': os.urandom(32), 'timestamp': timestamp,
+            'number': number,
+        })
+        for _ in range(args.transactions):
+            transaction_hash = os.urandom(32)
+            rows[Transaction.__table__].append({
+                'hash': transaction_hash, 'signature': os.urandom(64), 'endorser': 'endorser1',
+                'timestamp': timestamp, 'blockchain_hash': blockchain_hash,
+            })
+            for account in random.sample(accounts, 2):
+                versions[account] += 1
+                rows[TransactionMutation.__table__].append({
+                    'hash': os.urandom(32), 'account': account,
+                    'prev_version': versions[account] - 1, 'next_version': versions[account],
+                    'transaction_hash': transaction_hash,
+                })
+                rows[AccountState.__table__].append({
+                    'account': account, 'version': versions[account], 'value': 0.0,
+                    'hash': os.urandom(32),
+                })
+        if number % INSERT_CHUNK_SIZE == 0 or number == args.blocks:
+            async with engine.begin() as conn:
+                for table, table_rows in rows.items():
+                    if table_rows:
+                        await conn.execute(table.insert(), table_rows)
+                    table_rows.clear()
+    async with engine.begin() as conn:
+        await conn.execute(LatestAccountState.__table__.insert(), [
+            {'account': account, 'version': version} for account, version in versions.items()])
+    await engine.dispose()
+
+
+def query_plans(path: str, statements: List[Tuple[str, Any]]) -> None:
+    engine = create_storage_engine(path, {}, read_only=True)
+    with engine.sync_engine.connect() as conn:
+        # the block, then its transactions, mutations and their previous and next states
+        for index, (statement, parameters) in enumerate(statements):
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            print('  %d. %s' % (index + 1, '\n     '.join(row[3] for row in plan)))
+    engine.sync_engine.dispose()
+
+
+async def load_blocks(peer: PeerProcessor,
+                      numbers: List[int]) -> Tuple[float, List[Tuple[str, Any]]]:
+    # median latency of a block load, and the statements of the first one
+    statements: List[Tuple[str, Any]] = []
+
+    def record(conn: Any, cursor: Any, statement: str, parameters: Any, *_: Any) -> None:
+        statements.append((statement, parameters))
+    # the read connections share one engine
+    event.listen(peer.read_pool.lanes[0].engine, 'before_cursor_execute', record)
+    samples = []
+    context = request_context(peer)
+    for number in numbers:
+        start = time.perf_counter()
+        await peer.query_blockchain_handler({'blockchain_number': number}, context)
+        samples.append(time.perf_counter() - start)
+        if number == numbers[0]:
+            first = list(statements)
+    await peer.read_pool.close()
+    return statistics.median(samples), first
+
+
+async def run(args: argparse.Namespace) -> None:
+    storage_config = {'read_connections': 1, 'priority_read_connections': 1}
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        peer = storage_peer(root, storage_config)
+        path = os.path.join(peer.config['root'], 'sqlite.db')
+        await fill(path, args)
+        numbers = random.sample(range(1, args.blocks + 1), args.repeat)
+        before, statements = await load_blocks(peer, numbers)
+        print('query plans before')
+        query_plans(path, statements)
+        engine = create_storage_engine(path, {})
+        start = time.perf_counter()
+        async with engine.begin() as conn:
+            await conn.run_sync(upgrade_schema)
+        upgrade = time.perf_counter() - start
+        await engine.dispose()
+        # a peer started on the upgraded tables
+        after, statements = await load_blocks(storage_peer(root, storage_config), numbers)
+        print('query plans after')
+        query_plans(path, statements)
+        print('%8s %14s %14s %14s' % ('blocks', 'before ms', 'after ms', 'upgrade s'))
+        print('%8d %14.3f %14.3f %14.1f' % (args.blocks, before * 1000, after * 1000, upgrade))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=None, help='where the database is created')
+    parser.add_argument('--blocks', type=int, default=100000)
+    parser.add_argument('--transactions', type=int, default=1, help='transactions per block')
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20, help='blocks loaded')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
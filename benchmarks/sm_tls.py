@@ -0,0 +1,197 @@
+"""Benchmarks for the SM encrypted TLS stream layer.
+
+Run with ``python3 -m benchmarks.sm_tls``. For the reader and writer benchmarks the SM4 cipher is
+replaced by the identity function, so the numbers measure buffering and framing only.
+"""
+import argparse
+import asyncio
+import time
+from typing import List, Type, Any, Tuple, Optional
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+
+from horde.sm_tls import SMTLSStreamReader, SMTLSStreamWriter, IV_DATA, MAX_FRAME_SIZE, \
+    SessionCache, open_sm_tls_connection, start_sm_tls_server
+
+FRAME_SIZE = 16 * 1024
+
+
+class PlainReader(SMTLSStreamReader):
+    def decrypt(self, data: bytes) -> bytes:
+        return data
+
+
+class PlainWriter(SMTLSStreamWriter):
+    frames = 0
+
+    def encrypt(self, data: bytes) -> bytes:
+        self.frames += 1
+        return data
+
+
+class NullStreamWriter:
+    calls = 0
+
+    def write(self, data: bytes) -> None:
+        self.calls += 1
+
+    def writelines(self, data: List[bytes]) -> None:
+        self.calls += 1
+
+
+class LegacyPlainReader:
+    """The reader before it was backed by a bytearray, kept here for comparison."""
+    inner: asyncio.StreamReader
+    buffer: bytes
+
+    def __init__(self, inner: asyncio.StreamReader, key: bytes):
+        self.inner = inner
+        self.buffer = b''
+
+    async def readexactly(self, n: int) -> bytes:
+        result = self.buffer
+        while len(result) < n:
+            data_len = int.from_bytes(await self.inner.readexactly(4), byteorder='big')
+            data = await self.inner.readexactly(data_len)
+            padding = int.from_bytes(data[:1], byteorder='big')
+            result += data[1:] if padding == 0 else data[1:-padding]
+        self.buffer = result[n:]
+        return result[:n]
+
+    async def readuntil(self, separator: bytes = b'\n') -> bytes:
+        result = self.buffer
+        while result.find(separator) == -1:
+            data_len = int.from_bytes(await self.inner.readexactly(4), byteorder='big')
+            data = await self.inner.readexactly(data_len)
+            padding = int.from_bytes(data[:1], byteorder='big')
+            result += data[1:] if padding == 0 else data[1:-padding]
+        index = result.find(separator) + len(separator)
+        self.buffer = result[index:]
+        return result[:index]
+
+
+def plain_frames(data: bytes, frame_size: int) -> List[bytes]:
+    frames = []
+    for i in range(0, len(data), frame_size):
+        chunk = data[i:i + frame_size]
+        padding = (15 - len(chunk)) % 16
+        frame = padding.to_bytes(1, byteorder='big') + chunk + b'\0' * padding
+        frames.append(len(frame).to_bytes(4, byteorder='big') + frame)
+    return frames
+
+
+async def read_messages(reader_type: Type, message_size: int, count: int) -> float:
+    body = b'x' * message_size
+    frames = plain_frames(b'Content-Length: %d\r\n\r\n%s' % (len(body), body), FRAME_SIZE)
+    inner = asyncio.StreamReader()
+    reader = reader_type(inner, bytes(IV_DATA) * 2)
+    start = time.perf_counter()
+    for _ in range(count):
+        for frame in frames:
+            inner.feed_data(frame)
+        await reader.readuntil(b'\r\n\r\n')
+        await reader.readexactly(message_size)
+    return time.perf_counter() - start
+
+
+def bench_reader(args: argparse.Namespace) -> None:
+    print('%-10s %-8s %12s %12s' % ('message', 'count', 'legacy MB/s', 'new MB/s'))
+    for message_size, count in [(1024, 5000), (100 * 1024, 200), (10 * 1024 * 1024, 2)]:
+        count = max(1, int(count * args.scale))
+        total = message_size * count / 1024 / 1024
+        legacy = min(asyncio.run(read_messages(LegacyPlainReader, message_size, count))
+                     for _ in range(args.repeat))
+        new = min(asyncio.run(read_messages(PlainReader, message_size, count))
+                  for _ in range(args.repeat))
+        print('%-10d %-8d %12.1f %12.1f' % (message_size, count, total / legacy, total / new))
+
+
+async def write_messages(message_size: int, count: int, burst: int,
+                         options: Any) -> Tuple[float, int, int]:
+    message = b'x' * message_size
+    inner = NullStreamWriter()
+    writer = PlainWriter(inner, bytes(IV_DATA) * 2, **options)  # type: ignore
+    start = time.perf_counter()
+    for _ in range(count // burst):
+        for _ in range(burst):
+            writer.write(message)
+        await asyncio.sleep(0)  # let the coalesced writes flush
+    return time.perf_counter() - start, writer.frames, inner.calls
+
+
+def bench_writer(args: argparse.Namespace) -> None:
+    print('%-10s %-8s %-6s %-10s %8s %8s %12s %10s' % (
+        'message', 'count', 'burst', 'mode', 'frames', 'writes', 'frames/s', 'MB/s'))
+    modes = [
+        ('default', {}),
+        ('coalesce', {'coalesce': True, 'max_frame_size': MAX_FRAME_SIZE}),
+    ]
+    for message_size, count, burst in [(200, 20000, 100), (200, 20000, 1),
+                                       (10 * 1024 * 1024, 4, 1)]:
+        count = max(burst, int(count * args.scale))
+        for mode, options in modes:
+            elapsed, frames, calls = min(
+                (asyncio.run(write_messages(message_size, count, burst, options))
+                 for _ in range(args.repeat)), key=lambda x: x[0])
+            print('%-10d %-8d %-6d %-10s %8d %8d %12.0f %10.1f' % (
+                message_size, count, burst, mode, frames, calls, frames / elapsed,
+                message_size * count / 1024 / 1024 / elapsed))
+
+
+async def handshakes(count: int, resume: bool) -> float:
+    server_public_key, server_private_key = generate_keypair()
+    client_public_key, client_private_key = generate_keypair()
+
+    async def callback(reader: SMTLSStreamReader, writer: SMTLSStreamWriter,
+                       remote_id: str) -> None:
+        writer.close()
+
+    server = await start_sm_tls_server(callback, server_private_key, {
+        'client': client_public_key,
+    }, '127.0.0.1', session_cache=SessionCache())
+    assert server.sockets is not None
+    port = server.sockets[0].getsockname()[1]
+    client_cache: Optional[SessionCache] = SessionCache() if resume else None
+    async with server:
+        # the first handshake is always a full one, it issues the ticket
+        _, writer = await open_sm_tls_connection(
+            'client', client_private_key, server_public_key, '127.0.0.1', port,
+            session_cache=client_cache)
+        writer.close()
+        start = time.perf_counter()
+        for _ in range(count):
+            _, writer = await open_sm_tls_connection(
+                'client', client_private_key, server_public_key, '127.0.0.1', port,
+                session_cache=client_cache)
+            writer.close()
+        return time.perf_counter() - start
+
+
+def bench_handshake(args: argparse.Namespace) -> None:
+    count = max(1, int(20 * args.scale))
+    print('%-10s %8s %14s' % ('handshake', 'count', 'handshakes/s'))
+    for mode, resume in [('full', False), ('resumed', True)]:
+        elapsed = min(asyncio.run(handshakes(count, resume)) for _ in range(args.repeat))
+        print('%-10s %8d %14.1f' % (mode, count, count / elapsed))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the iteration count')
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of several runs')
+    sub_parsers = parser.add_subparsers(title='benchmark')
+    parser_reader = sub_parsers.add_parser('reader', help='receive buffer throughput')
+    parser_reader.set_defaults(func=bench_reader)
+    parser_writer = sub_parsers.add_parser('writer', help='frame rate with and without coalescing')
+    parser_writer.set_defaults(func=bench_writer)
+    parser_handshake = sub_parsers.add_parser('handshake', help='full versus resumed handshakes')
+    parser_handshake.set_defaults(func=bench_handshake)
+    args = parser.parse_args()
+    if 'func' in args:
+        args.func(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+"""Block persistence of a peer.
+
+``profiles`` reports blocks committed per second for several SQLite storage profiles. Blocks are
+handed to the writer back to back, as when several verified blocks are saved at once.
+``inserts`` reports the commit time of one block saved through ORM objects versus Core inserts.
+``reads`` reports the queries per second of explorer clients (list-blockchains and
+query-blockchain) versus the number of read connections, and the latency of consensus reads
+made meanwhile, with and without the priority lane. ``block-cache`` reports the hit rate and
+latency of query-blockchain versus the size of the block cache, explorers mostly asking for
+recent blocks. ``backends`` reports blocks committed per second, the latency of random
+query-blockchain calls and the bytes on disk of the SQLite tables versus the block log.
+
+Each block mutates accounts no other block in the run touches, so that the blocks only differ
+in the rows they write. Run with ``python3 -m benchmarks.storage profiles``, ``inserts``,
+``reads``, ``block-cache`` or ``backends``.
+Signatures are random bytes, nothing is verified.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession  # type: ignore
+from sqlalchemy.orm import Session
+
+from benchmarks.router import request_context
+from horde.blocklog import BlockLog
+from horde.models import Base, AccountState, LatestAccountState, TransactionMutation, \
+    Transaction, Blockchain
+from horde.processors.peer import PeerProcessor
+from horde.storage import create_storage_engine, STORAGE_BACKENDS
+from horde.testing import create_processor
+
+PROFILES: Dict[str, Any] = {
+    # the SQLite defaults used before storage profiles
+    'rollback': {'journal_mode': 'delete', 'synchronous': 'full', 'mmap_size': 0,
+                 'cache_size': 2000, 'group_commit_size': 1},
+    'wal-full': {'group_commit_size': 1},
+    'wal-full-group': {},
+    'wal-normal': {'synchronous': 'normal', 'group_commit_size': 1},
+    'wal-normal-group': {'synchronous': 'normal'},
+}
+
+
+def storage_peer(root: str, storage_config: Any, block_cache_size: int = 0) -> PeerProcessor:
+    # the database is `sqlite.db` in `root`/endorser1, the same one for every peer on `root`
+    return create_processor(PeerProcessor, root, 'endorser1', sections={
+        'storage': storage_config, 'cache': {'blocks': block_cache_size}})
+
+
+def mutation(account: str) -> Any:
+    prev_hash = AccountState.compute_hash(account, 1, 0.0)
+    next_hash = AccountState.compute_hash(account, 2, 1.0)
+    return {
+        'hash': TransactionMutation.compute_hash(prev_hash, next_hash),
+        'account': account,
+        'prev_account_state': {'hash': prev_hash, 'version': 1, 'value': 0.0},
+        'next_account_state': {'hash': next_hash, 'version': 2, 'value': 1.0},
+    }
+
+
+def blocks(count: int, transactions: int, mutations: int) -> List[Any]:
+    result: List[Any] = []
+    prev_hash = bytes(32)
+    for number in range(2, count + 2):
+        timestamp = datetime.utcnow()
+        result.append({
+            'hash': os.urandom(32),
+            'prev_hash': prev_hash,
+            'timestamp': timestamp,
+            'number': number,
+            'transactions': [{
+                'hash': os.urandom(32),
+                'endorser': 'endorser1',
+                'signature': os.urandom(64),
+                'timestamp': timestamp,
+                'mutations': [mutation('client%d-%d-%d' % (number, i, j))
+                              for j in range(mutations)],
+            } for i in range(transactions)],
+        })
+        prev_hash = result[-1]['hash']
+    return result
+
+
+async def create_database(peer: PeerProcessor, data: List[Any]) -> None:
+    async with peer.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession(peer.engine) as session:
+        async with session.begin():
+            session.add(Blockchain(hash=bytes(32), prev_hash=bytes(32),
+                                   timestamp=datetime.utcnow(), number=1))
+            for block in data:
+                for transaction in block['transactions']:
+                    for item in transaction['mutations']:
+                        state = item['prev_account_state']
+                        session.add(AccountState(account=item['account'], version=1,
+                                                 value=state['value'], hash=state['hash']))
+                        session.add(LatestAccountState(account=item['account'], version=1))
+
+
+async def commit_rate(storage_config: Any, data: List[Any], directory: str) -> float:
+    with tempfile.TemporaryDirectory(dir=directory) as root:
+        peer = storage_peer(root, storage_config)
+        await create_database(peer, data)
+        writer_task = asyncio.create_task(peer.write_blockchains())
+        start = time.perf_counter()
+        await asyncio.gather(*[peer.save_blockchain(block) for block in data])
+        elapsed = time.perf_counter() - start
+        writer_task.cancel()
+        await peer.engine.dispose()
+    return len(data) / elapsed
+
+
+async def run_profiles(args: argparse.Namespace) -> None:
+    data = blocks(args.blocks, args.transactions, args.mutations)
+    print('%18s %12s' % ('profile', 'blocks/s'))
+    for name in args.profiles:
+        print('%18s %12.1f' % (name, await commit_rate(PROFILES[name], data, args.dir)))
+
+
+def add_blockchain_with_orm(session: AsyncSession, blockchain: Any) -> None:
+    # how blocks were saved before Core inserts
+    session.add(Blockchain(
+        hash=blockchain['hash'], prev_hash=blockchain['prev_hash'],
+        timestamp=blockchain['timestamp'], number=blockchain['number']))
+    for transaction in blockchain['transactions']:
+        session.add(Transaction(
+            hash=transaction['hash'], signature=transaction['signature'],
+            endorser=transaction['endorser'], timestamp=transaction['timestamp'],
+            blockchain_hash=blockchain['hash']))
+        for item in transaction['mutations']:
+            account = item['next_account_state']
+            session.add(TransactionMutation(
+                hash=item['hash'], account=item['account'],
+                prev_version=item['prev_account_state']['version'],
+                next_version=account['version'], transaction_hash=transaction['hash']))
+            session.add(AccountState(
+                hash=account['hash'], version=account['version'], value=account['value'],
+                account=item['account']))
+            session.add(LatestAccountState(account=item['account'], version=account['version']))
+
+
+async def commit_time(peer: PeerProcessor, blockchain: Any, orm: bool) -> float:
+    start = time.perf_counter()
+    async with AsyncSession(peer.engine) as session:
+        async with session.begin():
+            if orm:
+                add_blockchain_with_orm(session, blockchain)
+            else:
+                await peer.insert_blockchains(session, [blockchain])
+    return time.perf_counter() - start
+
+
+async def run_inserts(args: argparse.Namespace) -> None:
+    print('%10s %12s %12s %10s' % ('mutations', 'orm ms', 'core ms', 'speedup'))
+    for mutations in args.mutations:
+        samples: Dict[bool, List[float]] = {True: [], False: []}
+        for orm in (True, False):
+            data = blocks(args.repeat, max(1, mutations // 2), min(2, mutations))
+            with tempfile.TemporaryDirectory(dir=args.dir) as root:
+                peer = storage_peer(root, {})
+                # accounts differ in every block, so the ORM can insert their head rows too
+                await create_database(peer, [])
+                for blockchain in data:
+                    samples[orm].append(await commit_time(peer, blockchain, orm))
+                await peer.engine.dispose()
+        orm_time = statistics.median(samples[True])
+        core_time = statistics.median(samples[False])
+        print('%10d %12.2f %12.2f %9.1fx' % (mutations, orm_time * 1000, core_time * 1000,
+                                             orm_time / core_time))
+
+
+class InlineReadPool:
+    # how queries ran before the read pool: on one connection, blocking the event loop
+    def __init__(self, engine: Any):
+        self.session = Session(bind=engine.sync_engine)
+
+    async def run(self, func: Callable[[Session], Any], priority: bool = False) -> Any:
+        return func(self.session)
+
+    async def close(self) -> None:
+        self.session.close()
+
+
+async def read_rates(peer: PeerProcessor, args: argparse.Namespace,
+                     priority: bool) -> Tuple[float, int, float, float]:
+    # queries per second of the explorers, count, median and max of the consensus reads
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + args.duration
+    queries = 0
+    latencies = []
+    context = request_context(peer)
+
+    async def explorer(index: int) -> None:
+        nonlocal queries
+        while loop.time() < deadline:
+            await peer.list_blockchains_handler({'offset': index % 10, 'limit': 15}, context)
+            await peer.query_blockchain_handler(
+                {'blockchain_number': 2 + (queries + index) % args.blocks}, context)
+            queries += 2
+
+    async def consensus() -> None:
+        accounts = [item['account'] for item in args.accounts]
+        while loop.time() < deadline:
+            peer.account_state_cache.entries.clear()  # always read the database
+            start = loop.time()
+            await peer.latest_account_states(accounts, priority)
+            latencies.append(loop.time() - start)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(consensus(), *[explorer(index) for index in range(args.clients)])
+    return queries / args.duration, len(latencies), statistics.median(latencies), \
+        max(latencies)
+
+
+async def run_reads(args: argparse.Namespace) -> None:
+    data = blocks(args.blocks, args.transactions, 2)
+    args.accounts = data[-1]['transactions'][0]['mutations']
+    print('%12s %10s %12s %16s %18s %16s' % ('connections', 'priority', 'queries/s',
+                                              'consensus reads', 'consensus p50 ms',
+                                              'consensus max ms'))
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        writer = storage_peer(root, {})
+        await create_database(writer, data)
+        async with AsyncSession(writer.engine) as session:
+            async with session.begin():
+                await writer.insert_blockchains(session, data)
+        await writer.engine.dispose()
+        await writer.read_pool.close()
+        for connections in args.connections:
+            for priority in (False, True) if connections else (False,):
+                peer = storage_peer(root, {'read_connections': max(1, connections)})
+                if not connections:
+                    await peer.read_pool.close()
+                    peer.read_pool = InlineReadPool(  # type: ignore
+                        create_storage_engine(os.path.join(peer.config['root'], 'sqlite.db'),
+                                              {}, read_only=True))
+                await peer.warm_state_cache()
+                rate, reads, median, maximum = await read_rates(peer, args, priority)
+                await peer.read_pool.close()
+                print('%12s %10s %12.1f %16d %18.2f %16.2f' % (
+                    connections or 'inline', priority, rate, reads, median * 1000,
+                    maximum * 1000))
+
+
+async def browse_recent(peer: PeerProcessor, generator: random.Random, args: argparse.Namespace,
+                        latencies: List[float]) -> None:
+    context = request_context(peer)
+    for _ in range(args.queries // args.clients):
+        # the newest blocks are the most viewed
+        age = min(int(generator.expovariate(1 / args.mean_age)), args.blocks)
+        start = time.perf_counter()
+        await peer.query_blockchain_handler({'blockchain_number': args.blocks + 1 - age},
+                                            context)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_block_cache(args: argparse.Namespace) -> None:
+    data = blocks(args.blocks, args.transactions, 2)
+    print('%12s %10s %12s %12s %12s' % ('cache size', 'hit rate', 'queries/s', 'p50 ms',
+                                        'p99 ms'))
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        writer = storage_peer(root, {})
+        await create_database(writer, data)
+        async with AsyncSession(writer.engine) as session:
+            async with session.begin():
+                await writer.insert_blockchains(session, data)
+        await writer.engine.dispose()
+        await writer.read_pool.close()
+        for size in args.sizes:
+            peer = storage_peer(root, {}, block_cache_size=size)
+            generator = random.Random(0)
+            latencies: List[float] = []
+            start = time.perf_counter()
+            await asyncio.gather(*[browse_recent(peer, generator, args, latencies)
+                                   for _ in range(args.clients)])
+            elapsed = time.perf_counter() - start
+            await peer.read_pool.close()
+            latencies.sort()
+            cache = peer.block_cache
+            print('%12d %10.2f %12.1f %12.3f %12.3f' % (
+                size, cache.hits / (cache.hits + cache.misses), len(latencies) / elapsed,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[len(latencies) * 99 // 100] * 1000))
+
+
+def create_block_log(block_log: BlockLog, data: List[Any]) -> None:
+    # what `main.py init` writes, with the accounts of the blocks
+    block_log.open()
+    block_log.append([PeerProcessor.serialize_blockchain({
+        'hash': bytes(32), 'prev_hash': bytes(32), 'timestamp': datetime.utcnow(), 'number': 1,
+        'transactions': [],
+    })])
+    block_log.put_states([
+        AccountState(account=item['account'], version=1, value=item['prev_account_state']['value'],
+                     hash=item['prev_account_state']['hash'])
+        for block in data for transaction in block['transactions']
+        for item in transaction['mutations']])
+
+
+def disk_usage(root: str) -> int:
+    paths = [os.path.join(root, name) for name in os.listdir(root)]
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+async def run_backends(args: argparse.Namespace) -> None:
+    data = blocks(args.blocks, args.transactions, 2)
+    print('%10s %12s %12s %12s %12s' % ('backend', 'blocks/s', 'p50 ms', 'p99 ms', 'MiB'))
+    for backend in args.backends:
+        with tempfile.TemporaryDirectory(dir=args.dir) as root:
+            peer = storage_peer(root, {'backend': backend})
+            if peer.block_log is not None:
+                create_block_log(peer.block_log, data)
+            else:
+                await create_database(peer, data)
+            await peer.warm_state_cache()
+            writer_task = asyncio.create_task(peer.write_blockchains())
+            start = time.perf_counter()
+            await asyncio.gather(*[peer.save_blockchain(block) for block in data])
+            rate = len(data) / (time.perf_counter() - start)
+            writer_task.cancel()
+            latencies = []
+            context = request_context(peer)
+            for number in random.sample(range(1, args.blocks + 2), min(args.queries,
+                                                                       args.blocks + 1)):
+                start = time.perf_counter()
+                await peer.query_blockchain_handler({'blockchain_number': number}, context)
+                latencies.append(time.perf_counter() - start)
+            await peer.read_pool.close()
+            await peer.engine.dispose()
+            if peer.block_log is not None:
+                peer.block_log.close()
+            latencies.sort()
+            print('%10s %12.1f %12.3f %12.3f %12.1f' % (
+                backend, rate, latencies[len(latencies) // 2] * 1000,
+                latencies[len(latencies) * 99 // 100] * 1000,
+                disk_usage(peer.config['root']) / 1024 / 1024))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=None,
+                        help='where the databases are created, fsync costs depend on the disk')
+    sub_parsers = parser.add_subparsers(title='benchmark')
+    parser_profiles = sub_parsers.add_parser(
+        'profiles', help='blocks committed per second for several storage profiles')
+    parser_profiles.add_argument('--blocks', type=int, default=200)
+    parser_profiles.add_argument('--transactions', type=int, default=10,
+                                 help='transactions per block')
+    parser_profiles.add_argument('--mutations', type=int, default=2,
+                                 help='mutations per transaction')
+    parser_profiles.add_argument('--profiles', nargs='+', choices=list(PROFILES),
+                                 default=list(PROFILES))
+    parser_profiles.set_defaults(func=run_profiles)
+    parser_inserts = sub_parsers.add_parser(
+        'inserts', help='commit time of one block, ORM objects versus Core inserts')
+    parser_inserts.add_argument('--mutations', type=int, nargs='+', default=[10, 500, 5000],
+                                help='mutations per block, 2 per transaction')
+    parser_inserts.add_argument('--repeat', type=int, default=5,
+                                help='blocks committed, the median is reported')
+    parser_inserts.set_defaults(func=run_inserts)
+    parser_reads = sub_parsers.add_parser(
+        'reads', help='queries per second of explorer clients versus read connections')
+    parser_reads.add_argument('--clients', type=int, default=50)
+    parser_reads.add_argument('--connections', type=int, nargs='+', default=[0, 1, 2, 4, 8],
+                              help='0 runs the queries in the event loop, as before')
+    parser_reads.add_argument('--blocks', type=int, default=200)
+    parser_reads.add_argument('--transactions', type=int, default=2,
+                              help='transactions per block, 2 mutations each')
+    parser_reads.add_argument('--duration', type=float, default=3.0)
+    parser_reads.set_defaults(func=run_reads)
+    parser_block_cache = sub_parsers.add_parser(
+        'block-cache', help='hit rate and latency of query-blockchain versus the block cache')
+    parser_block_cache.add_argument('--sizes', type=int, nargs='+', default=[0, 16, 64],
+                                    help='blocks in the cache, 0 reads every block again')
+    parser_block_cache.add_argument('--blocks', type=int, default=200)
+    parser_block_cache.add_argument('--transactions', type=int, default=4,
+                                    help='transactions per block, 2 mutations each')
+    parser_block_cache.add_argument('--clients', type=int, default=10)
+    parser_block_cache.add_argument('--queries', type=int, default=1000)
+    parser_block_cache.add_argument('--mean-age', type=float, default=20.0,
+                                    help='mean distance of the requested blocks from the tip')
+    parser_block_cache.set_defaults(func=run_block_cache)
+    parser_backends = sub_parsers.add_parser(
+        'backends', help='commit rate, read latency and disk usage, SQLite versus block log')
+    parser_backends.add_argument('--backends', nargs='+', choices=sorted(STORAGE_BACKENDS),
+                                 default=sorted(STORAGE_BACKENDS, reverse=True))
+    parser_backends.add_argument('--blocks', type=int, default=2000)
+    parser_backends.add_argument('--transactions', type=int, default=10,
+                                 help='transactions per block, 2 mutations each')
+    parser_backends.add_argument('--queries', type=int, default=500,
+                                 help='blocks read by query-blockchain, without block cache')
+    parser_backends.set_defaults(func=run_backends)
+    args = parser.parse_args()
+    if 'func' in args:
+        asyncio.run(args.func(args))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Catch-up speed of a lagging peer, in blocks per second, versus the batch and pipeline sizes.
+
+A source peer holds a chain of ``--blocks`` blocks after the genesis, the lagging peer only the
+genesis. The two are connected over plain TCP, so the numbers do not include SM TLS, and the
+lagging peer syncs through fetch-blockchains until it has the tip of the source. ``--configs 1x1``
+is a block per round trip, as with query-blockchain. The pipeline pays off with ``--latency``,
+when the next ranges are on the way while one is checked and saved.
+
+Run with ``python3 -m benchmarks.sync``. Blocks have no transactions by default, so that the
+fetching, checking and saving is measured. With ``--transactions``, every transaction is signed
+and verified in the event loop, SM2 verification then bounds the speed.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, List, Tuple, cast
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+from sqlalchemy.ext.asyncio import AsyncSession  # type: ignore
+
+from benchmarks.router import delay_relay
+from horde.models import Base, AccountState, LatestAccountState, TransactionMutation, \
+    Transaction, Blockchain
+from horde.processors.peer import PeerProcessor
+from horde.sm_tls import SMTLSStreamReader, SMTLSStreamWriter
+from horde.storage import create_storage_engine
+from horde.testing import create_processor
+
+INSERT_CHUNK_SIZE = 1000  # blocks
+
+
+def signed_transaction(private_key: bytes, account: str) -> Any:
+    prev_hash = AccountState.compute_hash(account, 1, 0.0)
+    next_hash = AccountState.compute_hash(account, 2, 1.0)
+    mutation_hash = TransactionMutation.compute_hash(prev_hash, next_hash)
+    timestamp = datetime.utcnow()
+    signature = Transaction.compute_signature(private_key, 'endorser1', timestamp,
+                                              [mutation_hash])
+    return {
+        'hash': Transaction.compute_hash('endorser1', signature, timestamp, [mutation_hash]),
+        'endorser': 'endorser1',
+        'signature': signature,
+        'timestamp': timestamp,
+        'mutations': [{
+            'hash': mutation_hash,
+            'account': account,
+            'prev_account_state': {'hash': prev_hash, 'version': 1, 'value': 0.0},
+            'next_account_state': {'hash': next_hash, 'version': 2, 'value': 1.0},
+        }],
+    }
+
+
+def sync_peer(root: str, id_: str, public_key: bytes, batch_size: int,
+              pipeline: int) -> PeerProcessor:
+    # its database is `sqlite.db` in the directory of the peer, under `root`
+    return create_processor(PeerProcessor, root, id_, sections={
+        'rpc': {'request_timeout': None, 'writer_queue_size': 64, 'max_concurrent_requests': 64},
+        'verification': {'workers': 0},
+        'storage': {'read_connections': 2, 'priority_read_connections': 1},
+        'cache': {'blocks': 0},
+        'sync': {'batch_size': batch_size, 'pipeline': pipeline},
+    }, public_keys={'endorser1': public_key})
+
+
+async def create_database(path: str, accounts: List[str], blocks: List[Any]) -> None:
+    engine = create_storage_engine(path, {})
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(Blockchain.__table__.insert(), [{
+            'hash': bytes(32), 'prev_hash': bytes(32), 'timestamp': datetime.utcnow(),
+            'number': 1,
+        }])
+        if accounts:
+            await conn.execute(AccountState.__table__.insert(), [{
+                'account': account, 'version': 1, 'value': 0.0,
+                'hash': AccountState.compute_hash(account, 1, 0.0),
+            } for account in accounts])
+            await conn.execute(LatestAccountState.__table__.insert(), [
+                {'account': account, 'version': 1} for account in accounts])
+    for start in range(0, len(blocks), INSERT_CHUNK_SIZE):
+        async with AsyncSession(engine) as session:
+            async with session.begin():
+                await PeerProcessor.insert_blockchains(
+                    session, blocks[start:start + INSERT_CHUNK_SIZE])
+    await engine.dispose()
+
+
+def chain(private_key: bytes, args: argparse.Namespace) -> Tuple[List[str], List[Any]]:
+    accounts = []
+    blocks: List[Any] = []
+    prev_hash = bytes(32)
+    for number in range(2, args.blocks + 2):
+        transactions = []
+        for index in range(args.transactions):
+            accounts.append('client%d-%d' % (number, index))
+            transactions.append(signed_transaction(private_key, accounts[-1]))
+        timestamp = datetime.utcnow()
+        blocks.append({
+            'hash': Blockchain.compute_hash(prev_hash, timestamp, number,
+                                            [transaction['hash'] for transaction in transactions]),
+            'prev_hash': prev_hash,
+            'timestamp': timestamp,
+            'number': number,
+            'transactions': transactions,
+        })
+        prev_hash = blocks[-1]['hash']
+    return accounts, blocks
+
+
+async def connect(client: PeerProcessor, server: PeerProcessor,
+                  latency: float) -> asyncio.AbstractServer:
+    async def callback(reader, writer):
+        asyncio.create_task(server.on_connected(
+            client.config['id'], 'server', reader, writer,
+            {'id': client.config['id'], 'type': 'endorser'}))
+    tcp_server = await asyncio.start_server(callback, '127.0.0.1', 0)
+    assert tcp_server.sockets
+    port = tcp_server.sockets[0].getsockname()[1]
+    if latency:
+        port = await delay_relay(port, latency)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    # plain TCP, the router only uses the stream interface of the SM TLS reader and writer
+    asyncio.create_task(client.on_connected(
+        server.config['id'], None, cast(SMTLSStreamReader, reader),
+        cast(SMTLSStreamWriter, writer), {'id': server.config['id'], 'type': 'endorser'}))
+    return tcp_server
+
+
+async def catch_up(root: str, public_key: bytes, args: argparse.Namespace, batch_size: int,
+                   pipeline: int) -> float:
+    source = sync_peer(root, 'source', public_key, batch_size, pipeline)
+    lagging = sync_peer(root, 'lagging', public_key, batch_size, pipeline)
+    lagging_path = os.path.join(lagging.config['root'], 'sqlite.db')
+    with open(os.path.join(root, 'lagging.db'), 'rb') as template, \
+            open(lagging_path, 'wb') as copy:
+        copy.write(template.read())
+    for peer in (source, lagging):
+        await peer.warm_state_cache()
+    writer_task = asyncio.create_task(lagging.write_blockchains())
+    start = time.perf_counter()
+    # both peers sync on connect, the source finds nothing to fetch
+    tcp_server = await connect(lagging, source, args.latency)
+    lagging.tip_loaded.set()
+    source.tip_loaded.set()
+    while lagging.sync_task is None:
+        await asyncio.sleep(0)
+    await lagging.sync_task
+    elapsed = time.perf_counter() - start
+    assert lagging.tip == source.tip, (lagging.tip, source.tip)
+    writer_task.cancel()
+    lagging.close_connection('source')
+    source.close_connection('lagging')
+    tcp_server.close()
+    for peer in (source, lagging):
+        await peer.read_pool.close()
+        await peer.engine.dispose()
+    os.remove(lagging_path)
+    return args.blocks / elapsed
+
+
+async def run(args: argparse.Namespace) -> None:
+    public_key, private_key = generate_keypair()
+    with tempfile.TemporaryDirectory(dir=args.dir) as root:
+        accounts, blocks = chain(private_key, args)
+        os.makedirs(os.path.join(root, 'source'))  # the directory of the source peer
+        await create_database(os.path.join(root, 'source', 'sqlite.db'), accounts, blocks)
+        await create_database(os.path.join(root, 'lagging.db'), accounts, [])
+        print('%10s %10s %10s %10s %12s' % ('blocks', 'latency ms', 'batch', 'pipeline',
+                                        'blocks/s'))
+        for config in args.configs:
+            batch_size, pipeline = (int(value) for value in config.split('x'))
+            rate = await catch_up(root, public_key, args, batch_size, pipeline)
+            print('%10d %10g %10d %10d %12.1f' % (args.blocks, args.latency * 1000, batch_size,
+                                                  pipeline, rate))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default=None, help='where the databases are created')
+    parser.add_argument('--blocks', type=int, default=100000, help='blocks behind the source')
+    parser.add_argument('--transactions', type=int, default=0,
+                        help='signed transactions per block, 1 mutation each')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to both directions of the connection')
+    parser.add_argument('--configs', nargs='+', default=['8x1', '128x1', '128x4'],
+                        help='blocks per request x requests in flight')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
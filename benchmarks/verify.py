@@ -0,0 +1,114 @@
+"""Validation time of a block versus the number of signature verification workers.
+
+The longest stall of the event loop during validation is reported too, it is what delays every
+other connection of the node.
+
+Run with ``python3 -m benchmarks.verify``. Every transaction of the block is a copy of the same
+signed transaction, verifying it costs the same as verifying distinct ones.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+
+from horde.models import AccountState, TransactionMutation, Transaction, Blockchain
+from horde.processors.node import NodeProcessor, SignatureCache, VERIFY_CHUNK_SIZE
+from horde.testing import create_processor
+
+
+def signed_transaction(private_key: bytes, endorser: str, mutations: int) -> Any:
+    mutation_list: List[Dict[str, Any]] = []
+    for i in range(mutations):
+        account = 'client%d' % i
+        prev_hash = AccountState.compute_hash(account, 1, 0.0)
+        next_hash = AccountState.compute_hash(account, 2, 1.0)
+        mutation_list.append({
+            'hash': TransactionMutation.compute_hash(prev_hash, next_hash),
+            'account': account,
+            'prev_account_state': {'hash': prev_hash, 'version': 1, 'value': 0.0},
+            'next_account_state': {'hash': next_hash, 'version': 2, 'value': 1.0},
+        })
+    timestamp = datetime.utcnow()
+    mutation_hashes: List[bytes] = [mutation['hash'] for mutation in mutation_list]
+    signature = Transaction.compute_signature(private_key, endorser, timestamp, mutation_hashes)
+    return {
+        'hash': Transaction.compute_hash(endorser, signature, timestamp, mutation_hashes),
+        'endorser': endorser,
+        'signature': signature,
+        'timestamp': timestamp.isoformat(),
+        'mutations': mutation_list,
+    }
+
+
+def signed_block(private_key: bytes, endorser: str, transactions: int, mutations: int) -> Any:
+    transaction = signed_transaction(private_key, endorser, mutations)
+    prev_hash = os.urandom(32)
+    timestamp = datetime.utcnow()
+    return {
+        'hash': Blockchain.compute_hash(prev_hash, timestamp, 2,
+                                        [transaction['hash']] * transactions),
+        'prev_hash': prev_hash,
+        'timestamp': timestamp.isoformat(),
+        'number': 2,
+        'transactions': [transaction] * transactions,
+    }
+
+
+async def max_stall(until: asyncio.Future) -> float:
+    loop = asyncio.get_running_loop()
+    result = 0.0
+    while not until.done():
+        start = loop.time()
+        await asyncio.sleep(0.001)
+        result = max(result, loop.time() - start - 0.001)
+    return result
+
+
+async def run(args: argparse.Namespace) -> None:
+    public_key, private_key = generate_keypair()
+    block = signed_block(private_key, 'endorser1', args.transactions, args.mutations)
+    print('%8s %12s %12s %14s %16s' % ('workers', 'seconds', 'speedup', 'max stall ms',
+                                        'cached seconds'))
+    baseline = None
+    with tempfile.TemporaryDirectory() as root:
+        for workers in sorted(set(args.workers)):
+            node = create_processor(NodeProcessor, root, 'node%d' % workers, sections={
+                'verification': {'workers': workers, 'chunk_size': args.chunk_size},
+            }, public_keys={'endorser1': public_key})
+            if node.verify_executor is not None:  # start the worker processes
+                await node.check_valid_transactions(block['transactions'][:workers])
+                node.signature_cache = SignatureCache()
+            start = time.perf_counter()
+            validation = asyncio.ensure_future(node.check_valid_blockchain(block))
+            stall = await max_stall(validation)
+            await validation
+            elapsed = time.perf_counter() - start
+            # the same block again, as an endorser receives transactions the orderer verified
+            start = time.perf_counter()
+            await node.check_valid_blockchain(block)
+            cached = time.perf_counter() - start
+            if node.verify_executor is not None:
+                node.verify_executor.shutdown()
+            baseline = baseline or elapsed
+            print('%8d %12.2f %11.1fx %14.1f %16.3f' % (workers, elapsed, baseline / elapsed,
+                                                          stall * 1000, cached))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=500)
+    parser.add_argument('--mutations', type=int, default=2, help='mutations per transaction')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[0, 1, 2, 4, os.cpu_count() or 1],
+                        help='0 verifies in the event loop')
+    parser.add_argument('--chunk-size', type=int, default=VERIFY_CHUNK_SIZE)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
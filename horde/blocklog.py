@@ -0,0 +1,329 @@
+"""Append-only block log, a storage backend of peers instead of the SQLite tables.
+
+Blocks are appended, in the form query-blockchain serves them, to segment files
+``blocks-NNNNNN.log``, each record being::
+
+    length (4 bytes) | crc32 (4 bytes) | format (1 byte) | encoded block
+
+and read back through memory maps, without joins. Blocks are numbered from 1 without gaps, so
+the index ``blocks.idx`` only holds the position of block n, 8 bytes at ``8 * (n - 1)``. The
+latest account states are a key-value table in ``states.db``, with the number of the last
+block applied to them.
+
+The log is the source of truth. At open, a torn record at its end is cut off, the index is
+completed from the log, and the blocks the states have not seen yet are applied again. With
+``synchronous: full`` the log and the index are synced before the states commit, otherwise
+they are only flushed to the OS, which a crash of the process does not lose.
+
+Like the SQLite writer, appends block the event loop while they run.
+"""
+import os
+import sqlite3
+import struct
+import zlib
+from array import array
+from mmap import mmap, ACCESS_READ
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from horde.codec import encode, decode, as_bytes, JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, \
+    HAS_MSGPACK
+from horde.models import AccountState
+from horde.storage import SYNCHRONOUS
+
+SEGMENT_SIZE = 256 * 1024 * 1024
+RECORD_HEADER = struct.Struct('<IIB')
+INDEX_ENTRY = struct.Struct('<Q')
+# an index entry is the segment in the high bits and the offset in it in the low ones
+OFFSET_BITS = 40
+FORMATS = [JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE]
+
+
+class CorruptedLog(Exception):
+    pass
+
+
+class BlockLog:
+    root: str
+    segment_size: int
+    sync: bool
+    content_type: str
+    index: array
+    maps: Dict[int, mmap]
+    segment: int  # the segment appended to
+    segment_length: int
+    states: Optional[sqlite3.Connection]
+    tip: Optional[Tuple[bytes, int]]
+    account_count: int
+    account_state_count: int
+
+    def __init__(self, root: str, storage_config: Any):
+        self.root = root
+        self.segment_size = int(storage_config.get('segment_size', SEGMENT_SIZE))
+        assert self.segment_size < 1 << OFFSET_BITS
+        self.sync = storage_config.get('synchronous', SYNCHRONOUS) in ('full', 'extra')
+        self.content_type = MSGPACK_CONTENT_TYPE if HAS_MSGPACK else JSON_CONTENT_TYPE
+        self.index = array('Q')
+        self.maps = {}
+        self.segment = 0
+        self.segment_length = 0
+        self.states = None
+        self.tip = None
+        self.account_count = 0
+        self.account_state_count = 0
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.root, 'blocks-%06d.log' % segment)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, 'blocks.idx')
+
+    def open(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        self.states = sqlite3.connect(os.path.join(self.root, 'states.db'))
+        self.states.execute('PRAGMA journal_mode=wal')
+        self.states.execute('PRAGMA synchronous=%s' % ('full' if self.sync else 'normal'))
+        with self.states:
+            self.states.execute('CREATE TABLE IF NOT EXISTS states (account TEXT PRIMARY KEY, '
+                                'version INTEGER NOT NULL, value REAL NOT NULL, '
+                                'hash BLOB NOT NULL) WITHOUT ROWID')
+            self.states.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, '
+                                'value INTEGER NOT NULL) WITHOUT ROWID')
+        self.index = array('Q')
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as index_file:
+                raw = index_file.read()
+            self.index.extend(entry for entry, in INDEX_ENTRY.iter_unpack(
+                raw[:len(raw) - len(raw) % INDEX_ENTRY.size]))
+        self.recover()
+        self.account_count = self.states.execute('SELECT count(*) FROM states').fetchone()[0]
+        self.account_state_count = self.meta('account_states')
+        self.tip = None
+        if self.index:
+            blockchain = self.read(len(self.index))
+            assert blockchain is not None
+            self.tip = as_bytes(blockchain['hash']), blockchain['number']
+
+    def recover(self) -> None:
+        # the index is cut to the records that are whole in the log, then completed from it
+        while self.index and self.record_at(self.index[-1]) is None:
+            self.index.pop()
+        if self.index:
+            segment, offset = divmod(self.index[-1], 1 << OFFSET_BITS)
+            offset += RECORD_HEADER.size + self.record_at(self.index[-1])[0]  # type: ignore
+        else:
+            segment, offset = 0, 0
+        while True:
+            record = self.record_at((segment << OFFSET_BITS) | offset)
+            if record is None:
+                if os.path.exists(self.segment_path(segment + 1)):
+                    # the rest of this segment is torn, the next one starts a new record
+                    self.truncate(segment, offset)
+                    segment, offset = segment + 1, 0
+                    continue
+                break
+            self.index.append((segment << OFFSET_BITS) | offset)
+            offset += RECORD_HEADER.size + record[0]
+        self.truncate(segment, offset)
+        self.segment, self.segment_length = segment, offset
+        with open(self.index_path, 'wb') as index_file:
+            index_file.write(self.index_bytes(self.index))
+        applied = self.meta('applied')
+        if applied > len(self.index):
+            raise CorruptedLog('states applied up to block %d, the log ends at %d' % (
+                applied, len(self.index)))
+        for number in range(applied + 1, len(self.index) + 1):
+            self.apply([self.read(number)])
+
+    def truncate(self, segment: int, offset: int) -> None:
+        path = self.segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) > offset:
+            self.unmap(segment)
+            with open(path, 'r+b') as segment_file:
+                segment_file.truncate(offset)
+
+    def record_at(self, entry: int) -> Optional[Tuple[int, bytes]]:
+        # length and body of a whole record, None if it is missing, torn or corrupted
+        segment, offset = divmod(entry, 1 << OFFSET_BITS)
+        mapping = self.map(segment, offset + RECORD_HEADER.size)
+        if mapping is None:
+            return None
+        length, checksum, _ = RECORD_HEADER.unpack_from(mapping, offset)
+        mapping = self.map(segment, offset + RECORD_HEADER.size + length)
+        if mapping is None:
+            return None
+        body = mapping[offset + RECORD_HEADER.size - 1:offset + RECORD_HEADER.size + length]
+        if zlib.crc32(body) != checksum:
+            return None
+        return length, body
+
+    def map(self, segment: int, end: int) -> Optional[mmap]:
+        # maps of the segment appended to are renewed when it has grown past them
+        mapping = self.maps.get(segment)
+        if mapping is not None and len(mapping) >= end:
+            return mapping
+        path = self.segment_path(segment)
+        if not os.path.exists(path) or os.path.getsize(path) < end:
+            return None
+        self.unmap(segment)
+        with open(path, 'rb') as segment_file:
+            mapping = mmap(segment_file.fileno(), 0, access=ACCESS_READ)
+        self.maps[segment] = mapping
+        return mapping
+
+    def unmap(self, segment: int) -> None:
+        mapping = self.maps.pop(segment, None)
+        if mapping is not None:
+            mapping.close()
+
+    @staticmethod
+    def index_bytes(entries: Iterable[int]) -> bytes:
+        return b''.join(INDEX_ENTRY.pack(entry) for entry in entries)
+
+    def meta(self, key: str) -> int:
+        assert self.states is not None
+        row = self.states.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def read(self, number: int) -> Optional[Any]:
+        # the block as query-blockchain serves it, None if there is no such block
+        if not 1 <= number <= len(self.index):
+            return None
+        record = self.record_at(self.index[number - 1])
+        if record is None:
+            raise CorruptedLog('block %d is corrupted' % number)
+        body = record[1]
+        return decode(body[1:], FORMATS[body[0]])
+
+    def size(self, number: int) -> int:
+        # bytes of the encoded block, as a weight for caches
+        segment, offset = divmod(self.index[number - 1], 1 << OFFSET_BITS)
+        mapping = self.map(segment, offset + RECORD_HEADER.size)
+        assert mapping is not None
+        return RECORD_HEADER.unpack_from(mapping, offset)[0]
+
+    def append(self, blockchains: List[Any]) -> None:
+        # serialized blocks following the tip, all of them are saved or none
+        number = self.tip[1] if self.tip is not None else 0
+        for blockchain in blockchains:
+            number += 1
+            assert blockchain['number'] == number, 'block %d does not follow %d' % (
+                blockchain['number'], number - 1)
+        start = self.segment, self.segment_length
+        count = len(self.index)
+        entries = []
+        segment_file = open(self.segment_path(self.segment), 'ab')
+        try:
+            for blockchain in blockchains:
+                body = bytes([FORMATS.index(self.content_type)]) + \
+                    encode(blockchain, self.content_type)
+                record = RECORD_HEADER.pack(len(body) - 1, zlib.crc32(body), body[0]) + body[1:]
+                if self.segment_length and \
+                        self.segment_length + len(record) > self.segment_size:
+                    self.flush(segment_file)
+                    segment_file.close()
+                    self.segment, self.segment_length = self.segment + 1, 0
+                    segment_file = open(self.segment_path(self.segment), 'ab')
+                entries.append((self.segment << OFFSET_BITS) | self.segment_length)
+                segment_file.write(record)
+                self.segment_length += len(record)
+            self.flush(segment_file)
+            segment_file.close()
+            with open(self.index_path, 'ab') as index_file:
+                index_file.write(self.index_bytes(entries))
+                self.flush(index_file)
+            self.index.extend(entries)
+            self.apply(blockchains)
+        except BaseException:
+            segment_file.close()
+            del self.index[count:]
+            for segment in range(start[0] + 1, self.segment + 1):
+                self.unmap(segment)
+                if os.path.exists(self.segment_path(segment)):
+                    os.remove(self.segment_path(segment))
+            self.segment, self.segment_length = start
+            self.truncate(*start)
+            with open(self.index_path, 'r+b') as index_file:
+                index_file.truncate(count * INDEX_ENTRY.size)
+            raise
+        self.tip = as_bytes(blockchains[-1]['hash']), blockchains[-1]['number']
+
+    def flush(self, file: Any) -> None:
+        file.flush()
+        if self.sync:
+            os.fsync(file.fileno())
+
+    def apply(self, blockchains: List[Any]) -> None:
+        assert self.states is not None
+        latest = {}
+        mutations = 0
+        for blockchain in blockchains:
+            for transaction in blockchain['transactions']:
+                for mutation in transaction['mutations']:
+                    latest[mutation['account']] = mutation['next_account_state']
+                    mutations += 1
+        with self.states:
+            self.states.executemany(
+                'INSERT OR REPLACE INTO states (account, version, value, hash) '
+                'VALUES (?, ?, ?, ?)',
+                [(account, state['version'], state['value'], as_bytes(state['hash']))
+                 for account, state in latest.items()])
+            self.states.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [
+                ('applied', blockchains[-1]['number']),
+                ('account_states', self.meta('account_states') + mutations),
+            ])
+        self.account_state_count = self.meta('account_states')
+
+    def put_states(self, states: List[AccountState]) -> None:
+        # accounts created by `init`, with their first version
+        assert self.states is not None
+        with self.states:
+            self.states.executemany(
+                'INSERT OR REPLACE INTO states (account, version, value, hash) '
+                'VALUES (?, ?, ?, ?)',
+                [(state.account, state.version, state.value, state.hash) for state in states])
+            self.states.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (
+                'account_states', self.meta('account_states') + len(states)))
+        self.account_count = self.states.execute('SELECT count(*) FROM states').fetchone()[0]
+        self.account_state_count = self.meta('account_states')
+
+    def latest_states(self, accounts: Optional[List[str]] = None, after: Optional[str] = None,
+                      offset: int = 0, limit: int = -1) -> List[AccountState]:
+        # ordered by account, all accounts if none is given
+        assert self.states is not None
+        conditions: List[str] = []
+        parameters: List[Any] = []
+        if accounts is not None:
+            conditions.append('account IN (%s)' % ', '.join('?' * len(accounts)))
+            parameters.extend(accounts)
+        if after is not None:
+            conditions.append('account > ?')
+            parameters.append(after)
+        rows = self.states.execute(
+            'SELECT account, version, value, hash FROM states %s ORDER BY account '
+            'LIMIT ? OFFSET ?' % ('WHERE ' + ' AND '.join(conditions) if conditions else ''),
+            parameters + [limit, offset])
+        return [AccountState(account=account, version=version, value=value, hash=hash_)
+                for account, version, value, hash_ in rows]
+
+    def drop(self) -> None:
+        # removes the files of the log, as `init` drops the SQLite tables
+        self.close()
+        names = ['blocks.idx', 'states.db', 'states.db-wal', 'states.db-shm']
+        if os.path.isdir(self.root):
+            names.extend(name for name in os.listdir(self.root)
+                         if name.startswith('blocks-') and name.endswith('.log'))
+        for name in names:
+            if os.path.exists(os.path.join(self.root, name)):
+                os.remove(os.path.join(self.root, name))
+        self.index = array('Q')
+        self.segment, self.segment_length = 0, 0
+        self.tip = None
+        self.account_count, self.account_state_count = 0, 0
+
+    def close(self) -> None:
+        for segment in list(self.maps):
+            self.unmap(segment)
+        if self.states is not None:
+            self.states.close()
+            self.states = None
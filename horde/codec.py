@@ -0,0 +1,59 @@
+"""Encodes Router messages as JSON, or as msgpack when both peers support it.
+
+Handlers put hashes and signatures as raw `bytes` in messages. msgpack carries them as binary,
+while JSON carries them as hex strings, so receivers should read them with `as_bytes`.
+Pagination cursors are opaque strings, only ever handed back by clients as they got them.
+"""
+import base64
+import json
+from typing import Any, List
+
+try:
+    import msgpack  # type: ignore
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+
+def json_default(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+
+def json_dumps(data: Any, **kwargs) -> str:
+    return json.dumps(data, default=json_default, **kwargs)
+
+
+def encode(data: Any, content_type: str = JSON_CONTENT_TYPE) -> bytes:
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.packb(data, use_bin_type=True)
+    return json_dumps(data).encode()
+
+
+def decode(raw: bytes, content_type: str = JSON_CONTENT_TYPE) -> Any:
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return msgpack.unpackb(raw, raw=False)
+    return json.loads(raw)
+
+
+def as_bytes(value: Any) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    assert isinstance(value, str)
+    return bytes.fromhex(value)
+
+
+def encode_cursor(position: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json_dumps(position).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    # raises ValueError for anything that was not made by `encode_cursor`
+    position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if not isinstance(position, list):
+        raise ValueError('invalid cursor')
+    return position
@@ -0,0 +1,193 @@
+"""Provides SM2, SM3 and SM4 primitives through interchangeable backends.
+
+`pysmx` is the reference implementation. When the `cryptography` package is installed and its
+OpenSSL supports SM3 and SM4, those two primitives are taken from OpenSSL instead. The backend
+can be forced with the `HORDE_CRYPTO_BACKEND` environment variable.
+"""
+import os
+import random
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import ClassVar, Dict, List, Type
+
+from pysmx.SM2 import Sign, Verify, Encrypt, Decrypt  # type: ignore
+from pysmx.SM3 import digest  # type: ignore
+from pysmx.SM4 import Sm4, ENCRYPT, DECRYPT  # type: ignore
+
+try:
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+
+# pysmx silently ignores the key bytes after the first 16, other backends must do the same
+SM4_KEY_SIZE = 16
+SM3_BLOCK_SIZE = 64
+
+
+class CryptoBackend(ABC):
+    name: ClassVar[str] = ''
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+    @abstractmethod
+    def sm3_digest(self, data: bytes) -> bytes:
+        ...
+
+    # CBC without padding, the length of data should be a multiple of 16
+    @abstractmethod
+    def sm4_encrypt_cbc(self, key: bytes, init_vector: bytes, data: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def sm4_decrypt_cbc(self, key: bytes, init_vector: bytes, data: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def sm2_sign(self, data: bytes, private_key: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def sm2_verify(self, signature: bytes, data: bytes, public_key: bytes) -> bool:
+        ...
+
+    @abstractmethod
+    def sm2_encrypt(self, data: bytes, public_key: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def sm2_decrypt(self, data: bytes, private_key: bytes) -> bytes:
+        ...
+
+
+@lru_cache(maxsize=64)
+def pysmx_sm4(key: bytes, mode: int) -> Sm4:
+    # the key schedule is reused by every frame of a connection
+    sm4 = Sm4()
+    sm4.sm4_set_key(key, mode)
+    return sm4
+
+
+class PysmxBackend(CryptoBackend):
+    name = 'pysmx'
+
+    def sm3_digest(self, data: bytes) -> bytes:
+        return digest(data)
+
+    def sm4_encrypt_cbc(self, key: bytes, init_vector: bytes, data: bytes) -> bytes:
+        return bytes(pysmx_sm4(key[:SM4_KEY_SIZE], ENCRYPT).sm4_crypt_cbc(list(init_vector), data))
+
+    def sm4_decrypt_cbc(self, key: bytes, init_vector: bytes, data: bytes) -> bytes:
+        return bytes(pysmx_sm4(key[:SM4_KEY_SIZE], DECRYPT).sm4_crypt_cbc(list(init_vector), data))
+
+    def sm2_sign(self, data: bytes, private_key: bytes) -> bytes:
+        return Sign(data, private_key, hex(random.randint(2 ** (8 * 7), 2 ** (8 * 8) - 1))[2:], 64)
+
+    def sm2_verify(self, signature: bytes, data: bytes, public_key: bytes) -> bool:
+        return Verify(signature, data, public_key, 64)
+
+    def sm2_encrypt(self, data: bytes, public_key: bytes) -> bytes:
+        return Encrypt(data, public_key, 64)
+
+    def sm2_decrypt(self, data: bytes, private_key: bytes) -> bytes:
+        return Decrypt(data, private_key, 64)
+
+
+class CryptographyBackend(PysmxBackend):
+    # OpenSSL has no SM2 binding in `cryptography`, so SM2 still comes from pysmx
+    name = 'cryptography'
+
+    @classmethod
+    def available(cls) -> bool:
+        if not HAS_CRYPTOGRAPHY:
+            return False
+        try:
+            hashes.Hash(hashes.SM3())  # type: ignore
+            Cipher(algorithms.SM4(bytes(SM4_KEY_SIZE)),  # type: ignore
+                   modes.CBC(bytes(16))).encryptor()
+        except UnsupportedAlgorithm:
+            return False
+        return True
+
+    def sm3_digest(self, data: bytes) -> bytes:
+        hash_ = hashes.Hash(hashes.SM3())  # type: ignore
+        hash_.update(data)
+        return hash_.finalize()
+
+    def sm4_encrypt_cbc(self, key: bytes, init_vector: bytes, data: bytes) -> bytes:
+        encryptor = Cipher(algorithms.SM4(key[:SM4_KEY_SIZE]),  # type: ignore
+                           modes.CBC(init_vector)).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def sm4_decrypt_cbc(self, key: bytes, init_vector: bytes, data: bytes) -> bytes:
+        decryptor = Cipher(algorithms.SM4(key[:SM4_KEY_SIZE]),  # type: ignore
+                           modes.CBC(init_vector)).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+
+# ordered from the most preferred
+BACKENDS: Dict[str, Type[CryptoBackend]] = {
+    CryptographyBackend.name: CryptographyBackend,
+    PysmxBackend.name: PysmxBackend,
+}
+
+
+def available_backends() -> List[CryptoBackend]:
+    return [backend_type() for backend_type in BACKENDS.values() if backend_type.available()]
+
+
+def select_backend(name: str = '') -> CryptoBackend:
+    if name:
+        backend_type = BACKENDS[name]
+        assert backend_type.available(), 'crypto backend %s is not available' % name
+        return backend_type()
+    return available_backends()[0]
+
+
+backend: CryptoBackend = select_backend(os.environ.get('HORDE_CRYPTO_BACKEND', ''))
+
+
+def use_backend(name: str) -> None:
+    global backend  # pylint:disable=global-statement,invalid-name
+    backend = select_backend(name)
+
+
+def sm3_digest(data: bytes) -> bytes:
+    return backend.sm3_digest(data)
+
+
+def sm3_hmac(key: bytes, data: bytes) -> bytes:
+    # HMAC of RFC 2104 over SM3, unlike a digest of key + data it cannot be extended
+    if len(key) > SM3_BLOCK_SIZE:
+        key = sm3_digest(key)
+    key = key.ljust(SM3_BLOCK_SIZE, b'\0')
+    inner = sm3_digest(bytes(byte ^ 0x36 for byte in key) + data)
+    return sm3_digest(bytes(byte ^ 0x5c for byte in key) + inner)
+
+
+def sm4_encrypt_cbc(key: bytes, init_vector: bytes, data: bytes) -> bytes:
+    return backend.sm4_encrypt_cbc(key, init_vector, data)
+
+
+def sm4_decrypt_cbc(key: bytes, init_vector: bytes, data: bytes) -> bytes:
+    return backend.sm4_decrypt_cbc(key, init_vector, data)
+
+
+def sm2_sign(data: bytes, private_key: bytes) -> bytes:
+    return backend.sm2_sign(data, private_key)
+
+
+def sm2_verify(signature: bytes, data: bytes, public_key: bytes) -> bool:
+    return backend.sm2_verify(signature, data, public_key)
+
+
+def sm2_encrypt(data: bytes, public_key: bytes) -> bytes:
+    return backend.sm2_encrypt(data, public_key)
+
+
+def sm2_decrypt(data: bytes, private_key: bytes) -> bytes:
+    return backend.sm2_decrypt(data, private_key)
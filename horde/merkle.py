@@ -0,0 +1,56 @@
+"""Merkle trees over SM3 hashes, for inclusion proofs of transactions in blocks.
+
+Leaves and inner nodes are hashed with different prefixes, so that an inner node can never be
+passed off as a leaf. A node without a sibling is carried up to the next level unchanged.
+"""
+from typing import Any, List
+
+from horde.crypto import sm3_digest
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def leaf_hash(leaf: bytes) -> bytes:
+    return sm3_digest(LEAF_PREFIX + leaf)
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return sm3_digest(NODE_PREFIX + left + right)
+
+
+def merkle_levels(leaves: List[bytes]) -> List[List[bytes]]:
+    levels = [[leaf_hash(leaf) for leaf in leaves]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                       for i in range(0, len(level), 2)])
+    return levels
+
+
+def merkle_root(leaves: List[bytes]) -> bytes:
+    if not leaves:
+        return sm3_digest(b'')
+    return merkle_levels(leaves)[-1][0]
+
+
+def merkle_proof(leaves: List[bytes], index: int) -> List[Any]:
+    # siblings from the leaf up, `left` tells on which side the sibling is
+    assert 0 <= index < len(leaves)
+    proof = []
+    for level in merkle_levels(leaves)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append({'hash': level[sibling], 'left': sibling < index})
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf: bytes, proof: List[Any], root: bytes) -> bool:
+    current = leaf_hash(leaf)
+    for step in proof:
+        if step['left']:
+            current = node_hash(step['hash'], current)
+        else:
+            current = node_hash(current, step['hash'])
+    return current == root
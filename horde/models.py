@@ -1,13 +1,14 @@
-import random
 from datetime import datetime
-from typing import List, Any
+from typing import List, Any, Optional
 
-from pysmx.SM2 import Sign, Verify  # type: ignore
-from pysmx.SM3 import digest  # type: ignore
-from sqlalchemy import Column, Integer, String, Numeric, BLOB, Sequence, ForeignKey, TIMESTAMP
+from sqlalchemy import Column, Integer, String, Numeric, BLOB, Sequence, ForeignKey, TIMESTAMP, \
+    Index, inspect, select, func, and_
+from sqlalchemy.engine import Connection
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
+from horde.crypto import sm3_digest, sm2_sign, sm2_verify
+
 ACCOUNT_PRECISION = 3
 
 Base = declarative_base()
@@ -24,7 +25,28 @@ class AccountState(Base):
 
     @staticmethod
     def compute_hash(account: str, version: int, value: float) -> bytes:
-        return digest(('%r,%d,%.' + str(ACCOUNT_PRECISION) + 'f') % (account, version, value))
+        return sm3_digest(
+            (('%r,%d,%.' + str(ACCOUNT_PRECISION) + 'f') % (account, version, value)).encode())
+
+
+class LatestAccountState(Base):
+    __tablename__ = 'latest_account_states'
+
+    # the version of the latest AccountState of each account, updated with every saved block
+    account = Column(String, ForeignKey('account_states.account'), primary_key=True)
+    version = Column(Integer, ForeignKey('account_states.version'), nullable=False)
+
+
+def select_latest_account_states(*accounts: str) -> Any:
+    # point lookups by primary key, all accounts if none is given
+    # noinspection PyTypeChecker
+    stmt = select(AccountState).join(LatestAccountState, and_(  # type: ignore
+        AccountState.account == LatestAccountState.account,
+        AccountState.version == LatestAccountState.version,
+    )).order_by(LatestAccountState.account)
+    if accounts:
+        stmt = stmt.where(LatestAccountState.account.in_(accounts))
+    return stmt
 
 
 class TransactionMutation(Base):
@@ -32,10 +54,15 @@ class TransactionMutation(Base):
 
     # hash(AccountState(account, prev_version).hash, AccountState(account, next_version).hash)
     hash = Column(BLOB(32), primary_key=True)
-    account = Column(Integer, ForeignKey('account_states.account'), nullable=False)
+    account = Column(String, ForeignKey('account_states.account'), nullable=False)
     prev_version = Column(Integer, ForeignKey('account_states.version'), nullable=False)
     next_version = Column(Integer, ForeignKey('account_states.version'), nullable=False)
-    transaction_hash = Column(Integer, ForeignKey('transactions.hash'), nullable=False)
+    transaction_hash = Column(BLOB(32), ForeignKey('transactions.hash'), index=True,
+                              nullable=False)
+
+    # the mutation that made a given version of an account
+    __table_args__ = (Index('ix_transaction_mutations_account_next_version',
+                            'account', 'next_version'),)
 
     prev_account_state = relationship(
         'AccountState', uselist=False, viewonly=True,
@@ -49,19 +76,19 @@ class TransactionMutation(Base):
 
     @staticmethod
     def compute_hash(prev_hash: bytes, next_hash: bytes) -> bytes:
-        return digest(prev_hash + next_hash)
+        return sm3_digest(prev_hash + next_hash)
 
     def serialize(self) -> Any:
         return {
-            'hash': self.hash.hex(),
+            'hash': self.hash,
             'account': self.account,
             'prev_account_state': {
-                'hash': self.prev_account_state.hash.hex(),
+                'hash': self.prev_account_state.hash,
                 'version': self.prev_account_state.version,
                 'value': self.prev_account_state.value,
             },
             'next_account_state': {
-                'hash': self.next_account_state.hash.hex(),
+                'hash': self.next_account_state.hash,
                 'version': self.next_account_state.version,
                 'value': self.next_account_state.value,
             },
@@ -77,39 +104,47 @@ class Transaction(Base):
     signature = Column(BLOB(64), nullable=False)
     endorser = Column(String, nullable=False)
     timestamp = Column(TIMESTAMP, nullable=False)
-    blockchain_hash = Column(Integer, ForeignKey('blockchains.hash'), nullable=False)
+    blockchain_hash = Column(BLOB(32), ForeignKey('blockchains.hash'), index=True,
+                             nullable=False)
+    # merkle_root(mutations.hash), the hash covers it instead of the mutation hashes if set
+    mutations_root = Column(BLOB(32), nullable=True)
 
     mutations = relationship('TransactionMutation', uselist=True, back_populates='transaction')
     blockchain = relationship('Blockchain', back_populates='transactions')
 
     @staticmethod
     def compute_hash(endorser: str, signature: bytes, timestamp: datetime,
-                     mutations: List[bytes]) -> bytes:
-        return digest(b'%r,%s,' % (endorser, timestamp.isoformat().encode()) +
-                      signature + b''.join(mutations))
+                     mutations: List[bytes], mutations_root: Optional[bytes] = None) -> bytes:
+        if mutations_root is not None:
+            return sm3_digest(b'%r,%s,merkle,' % (endorser, timestamp.isoformat().encode()) +
+                              signature + mutations_root)
+        return sm3_digest(b'%r,%s,' % (endorser, timestamp.isoformat().encode()) +
+                          signature + b''.join(mutations))
 
     @staticmethod
     def compute_signature(private_key: bytes, endorser: str,
                           timestamp: datetime, mutations: List[bytes]):
         content = b'%r,%s,' % (endorser, timestamp.isoformat().encode()) + b''.join(mutations)
-        return Sign(content, private_key,
-                    hex(random.randint(2 ** (8 * 7), 2 ** (8 * 8) - 1))[2:], 64)
+        return sm2_sign(content, private_key)
 
     @staticmethod
     def verify_signature(signature: bytes, public_key: bytes, endorser: str,
                          timestamp: datetime, mutations: List[bytes]):
         content = b'%r,%s,' % (endorser, timestamp.isoformat().encode()) + b''.join(mutations)
-        return Verify(signature, content, public_key, 64)
+        return sm2_verify(signature, content, public_key)
 
     def serialize(self) -> Any:
         # noinspection PyTypeChecker
-        return {
-            'hash': self.hash.hex(),
+        result = {
+            'hash': self.hash,
             'endorser': self.endorser,
-            'signature': self.signature.hex(),
+            'signature': self.signature,
             'timestamp': self.timestamp.isoformat(),
             'mutations': [mutation.serialize() for mutation in self.mutations]  # type: ignore
         }
+        if self.mutations_root is not None:
+            result['mutations_root'] = self.mutations_root
+        return result
 
 
 class Blockchain(Base):
@@ -120,22 +155,106 @@ class Blockchain(Base):
     prev_hash = Column(BLOB(32), ForeignKey('blockchains.hash'), nullable=False)
     timestamp = Column(TIMESTAMP, nullable=False)
     number = Column(Integer, Sequence('blockchain_number.seq'), index=True, nullable=False)
+    # merkle_root(transactions.hash), the hash covers it instead of the transaction hashes if set
+    transactions_root = Column(BLOB(32), nullable=True)
 
     transactions = relationship('Transaction', back_populates='blockchain')
 
     @staticmethod
     def compute_hash(prev_hash: bytes, timestamp: datetime, number: int,
-                     transactions: List[bytes]) -> bytes:
-        return digest(prev_hash + b',%s,%d,' % (timestamp.isoformat().encode(), number) +
-                      b''.join(transactions))
+                     transactions: List[bytes], transactions_root: Optional[bytes] = None) -> bytes:
+        if transactions_root is not None:
+            return sm3_digest(prev_hash + b',%s,%d,merkle,' % (timestamp.isoformat().encode(),
+                                                                number) + transactions_root)
+        return sm3_digest(prev_hash + b',%s,%d,' % (timestamp.isoformat().encode(), number) +
+                          b''.join(transactions))
 
-    def serialize(self) -> Any:
-        # noinspection PyTypeChecker
-        return {
-            'hash': self.hash.hex(),
-            'prev_hash': self.prev_hash.hex(),
+    def serialize_header(self) -> Any:
+        result = {
+            'hash': self.hash,
+            'prev_hash': self.prev_hash,
             'timestamp': self.timestamp.isoformat(),
             'number': self.number,
-            'transactions': [transaction.serialize()
-                             for transaction in self.transactions]  # type: ignore
         }
+        if self.transactions_root is not None:
+            result['transactions_root'] = self.transactions_root
+        return result
+
+    def serialize(self) -> Any:
+        result = self.serialize_header()
+        # noinspection PyTypeChecker
+        result['transactions'] = [transaction.serialize()
+                                  for transaction in self.transactions]  # type: ignore
+        return result
+
+
+def add_missing_columns(connection: Connection) -> None:
+    # databases created before a nullable column was added get it in place, existing rows keep NULL
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                assert column.nullable, 'column %s.%s is required' % (table.name, column.name)
+                connection.exec_driver_sql(  # type: ignore
+                    'ALTER TABLE %s ADD COLUMN %s %s' % (
+                        table.name, column.name, column.type.compile(connection.dialect)))
+
+
+def retype_columns(connection: Connection) -> None:
+    # SQLite cannot change the type of a column, a table whose declared types differ from its
+    # model is copied into a new one. Values keep their storage class, except in columns that
+    # became text: text turned into numbers by INTEGER affinity is cast back to text
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column['name']: column['type'].compile(connection.dialect)
+                    for column in inspector.get_columns(table.name)}
+        if all(column.type.compile(connection.dialect) == existing[column.name]
+               for column in table.columns if column.name in existing):
+            continue
+        for index in inspector.get_indexes(table.name):
+            connection.exec_driver_sql('DROP INDEX %s' % index['name'])  # type: ignore
+        # foreign keys of the other tables keep referring to the name, not to the old table
+        connection.exec_driver_sql('PRAGMA legacy_alter_table = ON')  # type: ignore
+        connection.exec_driver_sql(  # type: ignore
+            'ALTER TABLE %s RENAME TO %s_old' % (table.name, table.name))
+        connection.exec_driver_sql('PRAGMA legacy_alter_table = OFF')  # type: ignore
+        table.create(connection)
+        copied = [column for column in table.columns if column.name in existing]
+        values = ', '.join(
+            'CAST(%s AS TEXT)' % column.name
+            if isinstance(column.type, String)
+            and existing[column.name] != column.type.compile(connection.dialect)
+            else column.name for column in copied)
+        connection.exec_driver_sql(  # type: ignore
+            'INSERT INTO %s (%s) SELECT %s FROM %s_old' % (
+                table.name, ', '.join(column.name for column in copied), values, table.name))
+        connection.exec_driver_sql('DROP TABLE %s_old' % table.name)  # type: ignore
+
+
+def add_missing_indexes(connection: Connection) -> None:
+    # `create_all` only creates the indexes of the tables it creates
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+def upgrade_schema(connection: Connection) -> None:
+    # brings a database created by an older version up to date, does nothing on a current one
+    tables = set(inspect(connection).get_table_names())
+    retype_columns(connection)
+    Base.metadata.create_all(connection)
+    add_missing_columns(connection)
+    add_missing_indexes(connection)
+    if LatestAccountState.__tablename__ not in tables:
+        # noinspection PyTypeChecker
+        connection.execute(LatestAccountState.__table__.insert().from_select(
+            ['account', 'version'],
+            select(AccountState.account, func.max(AccountState.version))  # type: ignore
+                .group_by(AccountState.account)))
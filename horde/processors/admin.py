@@ -2,7 +2,7 @@ from json import JSONDecodeError
 
 from aiohttp import web
 
-from horde.processors.client import ClientProcessor
+from horde.processors.client import ClientProcessor, json_response
 from horde.processors.router import processor, RpcError
 
 
@@ -24,19 +24,19 @@ class AdminProcessor(ClientProcessor):
             assert isinstance(amount, (int, float))
             amount = float(amount)
         except (JSONDecodeError, AssertionError, KeyError, ValueError):
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'invalid query',
                 },
             }, status=400)
         connection = self.find_peer(endorser)
         if connection is None:
-            return web.json_response({'error': {'message': 'endorser offline'}}, status=400)
+            return json_response({'error': {'message': 'endorser offline'}}, status=400)
         try:
             result = await self.request('make-money', {'amount': amount}, connection)
-            return web.json_response({'result': result})
+            return json_response({'result': result})
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
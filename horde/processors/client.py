@@ -1,8 +1,9 @@
 import argparse
 import asyncio
-import json
 import logging
 import webbrowser
+from collections import OrderedDict
+from functools import partial
 from json import JSONDecodeError
 from pathlib import Path
 from typing import Any, Optional, Tuple
@@ -10,20 +11,31 @@ from typing import Any, Optional, Tuple
 import aiohttp
 from aiohttp import web
 
-from horde.processors.node import NodeProcessor
+from horde.codec import as_bytes, json_dumps
+from horde.processors.node import NodeProcessor, WrongHash, WrongSignature
 from horde.processors.router import processor, RpcError, on_notified, Context
 
+# hashes and signatures in RPC results are bytes, they are sent to the browser as hex strings
+json_response = partial(web.json_response, dumps=json_dumps)
+MAX_BATCH_SIZE = 100
+BLOCK_ETAGS_SIZE = 4096
+
 
 @processor
 class ClientProcessor(NodeProcessor):
     app: web.Application
     web_root: Path
     websocket_outgoing_queue: asyncio.Queue
+    # saved blocks never change, so the hash of a block is a strong entity tag of its response
+    block_etags: 'OrderedDict[Tuple[str, int], str]'
+    block_etags_size: int
 
     def __init__(self, config: Any, full_config: Any, args: argparse.Namespace):
         super().__init__(config, full_config, args)
         self.app = web.Application()
         self.websocket_outgoing_queue = asyncio.Queue()
+        self.block_etags = OrderedDict()
+        self.block_etags_size = full_config.get('cache', {}).get('block_etags', BLOCK_ETAGS_SIZE)
         self.generate_routes()
         self.web_root = Path(self.full_config['web']['static_root'])
 
@@ -35,8 +47,14 @@ class ClientProcessor(NodeProcessor):
             web.get(r'/api/connections', self.global_topology_api),
             web.get(r'/api/{peer}/connections', self.query_topology_api),
             web.get(r'/api/{peer}/accounts', self.query_accounts_api),
+            web.get(r'/api/{peer}/accounts/{account}/history', self.query_account_history_api),
             web.get(r'/api/{peer}/blockchains', self.list_blockchains_api),
+            web.get(r'/api/{peer}/blockchains/batch', self.query_blockchains_api),
             web.get(r'/api/{peer}/blockchains/{blockchain:\d+}', self.query_blockchain_api),
+            web.get(r'/api/{peer}/transactions/{transaction:[0-9a-fA-F]+}',
+                    self.query_transaction_api),
+            web.get(r'/api/{peer}/transactions/{transaction:[0-9a-fA-F]+}/proof',
+                    self.query_transaction_proof_api),
             web.get(r'/{tail:.*}', self.static_file_handler),
         ])
 
@@ -80,7 +98,7 @@ class ClientProcessor(NodeProcessor):
                 incoming_task = asyncio.create_task(retrieve_websocket())
             if outgoing_task in done:
                 data = await outgoing_task
-                await socket.send_str(json.dumps(data))
+                await socket.send_str(json_dumps(data))
                 outgoing_task = asyncio.create_task(self.websocket_outgoing_queue.get())
         logging.debug('%s: websocket connection closed', self.config['id'])
         return socket
@@ -148,14 +166,14 @@ class ClientProcessor(NodeProcessor):
             requests.append(new_request)
         try:
             results = await asyncio.gather(*requests)
-            return web.json_response({
+            return json_response({
                 'result': {
                     'self': self.config,
                     'peers': {ids[index]: result for index, result in enumerate(results)}
                 }
             })
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
@@ -170,14 +188,19 @@ class ClientProcessor(NodeProcessor):
             assert raw_blockchain is not None
             blockchain = int(raw_blockchain)
         except ValueError:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'invalid blockchain number',
                 },
             }, status=400)
+        if_none_match = request.headers.get('If-None-Match')
+        etag = self.block_etags.get((peer, blockchain))
+        if etag is not None and if_none_match == etag:
+            self.block_etags.move_to_end((peer, blockchain))
+            return web.Response(status=304, headers={'ETag': etag})
         connection = self.find_peer(peer)
         if connection is None:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'peer offline',
                 },
@@ -186,35 +209,207 @@ class ClientProcessor(NodeProcessor):
             result = await self.request('query-blockchain', {
                 'blockchain_number': blockchain,
             }, connection)
-            return web.json_response({
+            etag = '"%s"' % as_bytes(result['hash']).hex()
+            self.block_etags[peer, blockchain] = etag
+            self.block_etags.move_to_end((peer, blockchain))
+            if len(self.block_etags) > self.block_etags_size:
+                self.block_etags.popitem(last=False)
+            if if_none_match == etag:
+                return web.Response(status=304, headers={'ETag': etag})
+            return json_response({
+                'result': result,
+            }, headers={'ETag': etag})
+        except RpcError as error:
+            return json_response({
+                'error': {
+                    'message': str(error),
+                    'data': error.data,
+                },
+            }, status=400)
+
+    async def query_blockchains_api(self, request: web.Request) -> web.Response:
+        # several blocks in one round trip, e.g. a page of the explorer
+        peer = request.match_info.get('peer')
+        assert peer is not None
+        try:
+            numbers = [int(number) for number in request.rel_url.query['numbers'].split(',')]
+            assert 0 < len(numbers) <= MAX_BATCH_SIZE
+        except (KeyError, ValueError, AssertionError):
+            return json_response({
+                'error': {
+                    'message': 'invalid blockchain numbers',
+                },
+            }, status=400)
+        connection = self.find_peer(peer)
+        if connection is None:
+            return json_response({
+                'error': {
+                    'message': 'peer offline',
+                },
+            }, status=400)
+        try:
+            results = await self.request_many([('query-blockchain', {
+                'blockchain_number': number,
+            }) for number in numbers], connection, return_exceptions=True)
+        except RpcError as error:
+            return json_response({
+                'error': {
+                    'message': str(error),
+                    'data': error.data,
+                },
+            }, status=400)
+        return json_response({
+            'result': [{
+                'error': {
+                    'message': str(result),
+                    'data': result.data,
+                },
+            } if isinstance(result, RpcError) else {
+                'result': result,
+            } for result in results],
+        })
+
+    async def query_transaction_api(self, request: web.Request) -> web.Response:
+        peer = request.match_info.get('peer')
+        assert peer is not None
+        try:
+            raw_transaction = request.match_info.get('transaction')
+            assert raw_transaction is not None
+            transaction = bytes.fromhex(raw_transaction)
+        except ValueError:
+            return json_response({
+                'error': {
+                    'message': 'invalid transaction hash',
+                },
+            }, status=400)
+        connection = self.find_peer(peer)
+        if connection is None:
+            return json_response({
+                'error': {
+                    'message': 'peer offline',
+                },
+            }, status=400)
+        try:
+            result = await self.request('query-transaction', {
+                'hash': transaction,
+            }, connection)
+            return json_response({
+                'result': result,
+            })
+        except RpcError as error:
+            return json_response({
+                'error': {
+                    'message': str(error),
+                    'data': error.data,
+                },
+            }, status=400)
+
+    async def query_account_history_api(self, request: web.Request) -> web.Response:
+        try:
+            peer = request.match_info.get('peer')
+            account = request.match_info.get('account')
+            assert peer is not None and account is not None
+            raw_asc = request.rel_url.query.get('asc')
+            if raw_asc is not None:
+                assert raw_asc in ['true', 'false']
+                asc: Optional[bool] = raw_asc == 'true'
+            else:
+                asc = None
+            raw_limit = request.rel_url.query.get('limit')
+            limit = int(raw_limit) if raw_limit is not None else None
+            cursor = request.rel_url.query.get('cursor')
+        except (ValueError, AssertionError):
+            return json_response({
+                'error': {
+                    'message': 'invalid query parameter',
+                },
+            }, status=400)
+        connection = self.find_peer(peer)
+        if connection is None:
+            return json_response({
+                'error': {
+                    'message': 'peer offline',
+                },
+            }, status=400)
+        query: Any = {'account': account}
+        if asc is not None:
+            query['asc'] = asc
+        if limit is not None:
+            query['limit'] = limit
+        if cursor is not None:
+            query['cursor'] = cursor
+        try:
+            result = await self.request('query-account-history', query, connection)
+            return json_response({
                 'result': result,
             })
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
                 },
             }, status=400)
 
+    async def query_transaction_proof_api(self, request: web.Request) -> web.Response:
+        # the proof is checked here, so the peer only has to be trusted for the block hash
+        peer = request.match_info.get('peer')
+        assert peer is not None
+        try:
+            raw_transaction = request.match_info.get('transaction')
+            assert raw_transaction is not None
+            transaction = bytes.fromhex(raw_transaction)
+        except ValueError:
+            return json_response({
+                'error': {
+                    'message': 'invalid transaction hash',
+                },
+            }, status=400)
+        connection = self.find_peer(peer)
+        if connection is None:
+            return json_response({
+                'error': {
+                    'message': 'peer offline',
+                },
+            }, status=400)
+        try:
+            result = await self.request('query-transaction-proof', {
+                'hash': transaction,
+            }, connection)
+        except RpcError as error:
+            return json_response({
+                'error': {
+                    'message': str(error),
+                    'data': error.data,
+                },
+            }, status=400)
+        try:
+            verified = self.check_valid_transaction_proof(result)['hash'] == transaction
+        except (KeyError, AssertionError, ValueError, TypeError, WrongHash, WrongSignature):
+            verified = False
+        return json_response({
+            'result': result,
+            'verified': verified,
+        })
+
     async def query_topology_api(self, request: web.Request) -> web.Response:
         peer = request.match_info.get('peer')
         assert peer is not None
         connection: Optional[str] = None
         connection = self.find_peer(peer)
         if connection is None:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'peer offline',
                 },
             }, status=400)
         try:
             result = await self.request('query-topology', None, connection)
-            return web.json_response({
+            return json_response({
                 'result': result,
             })
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
@@ -238,20 +433,31 @@ class ClientProcessor(NodeProcessor):
             limit = int(raw_limit) if raw_limit is not None else None
             raw_offset = request.rel_url.query.get('offset')
             offset = int(raw_offset) if raw_offset is not None else None
+            cursor = request.rel_url.query.get('cursor')
+            raw_count = request.rel_url.query.get('count')
+            if raw_count is not None:
+                assert raw_count in ['true', 'false']
+                count: Optional[bool] = raw_count == 'true'
+            else:
+                count = None
         except (ValueError, AssertionError):
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'invalid query parameter',
                 },
             }, status=400)
         connection = self.find_peer(peer)
         if connection is None:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'peer offline',
                 },
             }, status=400)
         query: Any = {}
+        if cursor is not None:
+            query['cursor'] = cursor
+        if count is not None:
+            query['count'] = count
         if account is not None:
             query['account'] = account
         if version is not None:
@@ -264,11 +470,11 @@ class ClientProcessor(NodeProcessor):
             query['offset'] = offset
         try:
             result = await self.request('query-accounts', query, connection)
-            return web.json_response({
+            return json_response({
                 'result': result,
             })
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
@@ -288,20 +494,23 @@ class ClientProcessor(NodeProcessor):
             limit = int(raw_limit) if raw_limit is not None else None
             raw_offset = request.rel_url.query.get('offset')
             offset = int(raw_offset) if raw_offset is not None else None
+            cursor = request.rel_url.query.get('cursor')
         except (ValueError, AssertionError):
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'invalid query parameter',
                 },
             }, status=400)
         connection = self.find_peer(peer)
         if connection is None:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': 'peer offline',
                 },
             }, status=400)
         query: Any = {}
+        if cursor is not None:
+            query['cursor'] = cursor
         if asc is not None:
             query['asc'] = asc
         if limit is not None:
@@ -310,11 +519,11 @@ class ClientProcessor(NodeProcessor):
             query['offset'] = offset
         try:
             result = await self.request('list-blockchains', query, connection)
-            return web.json_response({
+            return json_response({
                 'result': result,
             })
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
@@ -328,15 +537,15 @@ class ClientProcessor(NodeProcessor):
             assert isinstance(endorser, str)
             data = body['data']
         except (JSONDecodeError, KeyError, AssertionError, TypeError):
-            return web.json_response({'error': {'message': 'invalid query'}}, status=400)
+            return json_response({'error': {'message': 'invalid query'}}, status=400)
         connection = self.find_peer(endorser)
         if connection is None:
-            return web.json_response({'error': {'message': 'endorser offline'}}, status=400)
+            return json_response({'error': {'message': 'endorser offline'}}, status=400)
         try:
             result = await self.request('transfer-money', data, connection)
-            return web.json_response({'result': result})
+            return json_response({'result': result})
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
@@ -350,15 +559,15 @@ class ClientProcessor(NodeProcessor):
             assert isinstance(orderer, str)
             data = body['data']
         except (JSONDecodeError, KeyError, AssertionError, TypeError):
-            return web.json_response({'error': {'message': 'invalid query'}}, status=400)
+            return json_response({'error': {'message': 'invalid query'}}, status=400)
         connection = self.find_peer(orderer)
         if connection is None:
-            return web.json_response({'error': {'message': 'orderer offline'}}, status=400)
+            return json_response({'error': {'message': 'orderer offline'}}, status=400)
         try:
             result = await self.request('submit-transactions', data, connection)
-            return web.json_response({'result': result})
+            return json_response({'result': result})
         except RpcError as error:
-            return web.json_response({
+            return json_response({
                 'error': {
                     'message': str(error),
                     'data': error.data,
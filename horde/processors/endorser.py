@@ -1,9 +1,6 @@
-from datetime import datetime
-from typing import Any, Tuple, Dict, List
+from typing import Any, Tuple, List
 
-from sqlalchemy import select, func, or_, and_
-
-from horde.models import AccountState, ACCOUNT_PRECISION, TransactionMutation, Transaction
+from horde.models import AccountState, ACCOUNT_PRECISION, TransactionMutation
 from horde.processors.peer import PeerProcessor
 from horde.processors.router import processor, on_requested, Context, RpcError
 
@@ -28,15 +25,15 @@ class EndorserProcessor(PeerProcessor):
         account_mutation_hash = TransactionMutation.compute_hash(
             account.hash, account_next_account_hash)
         account_mutation = {
-            'hash': account_mutation_hash.hex(),
+            'hash': account_mutation_hash,
             'account': account.account,
             'prev_account_state': {
-                'hash': account.hash.hex(),
+                'hash': account.hash,
                 'version': account.version,
                 'value': account.value,
             },
             'next_account_state': {
-                'hash': account_next_account_hash.hex(),
+                'hash': account_next_account_hash,
                 'version': account_next_version,
                 'value': account_next_value,
             },
@@ -47,68 +44,29 @@ class EndorserProcessor(PeerProcessor):
     async def make_money_handler(self, data: Any, context: Context) -> Any:
         config = context.peer_config()
         assert config is not None
-        assert self.session is not None
         try:
             amount = round(data['amount'], ACCOUNT_PRECISION)
             assert amount > 0.0
         except (AssertionError, TypeError, KeyError) as error:
             raise RpcError(None, 'bad request') from error
-        subquery = select(
-            AccountState.account,  # type: ignore
-            func.max(AccountState.version).label('latest_version')
-        ) \
-            .where(or_(AccountState.account == 'coinbase',
-                       AccountState.account == config['id'])) \
-            .group_by(AccountState.account).alias('latest')
-        # noinspection PyUnresolvedReferences,PyTypeChecker
-        accounts = list((await self.session.execute(
-            select(AccountState).join(  # type: ignore
-                subquery,
-                and_(
-                    AccountState.account == subquery.c.account,  # type: ignore
-                    AccountState.version == subquery.c.latest_version,  # type: ignore
-                ),
-            )
-        )).scalars())
+        accounts = await self.latest_account_states(['coinbase', config['id']])
         try:
-            assert len(accounts) == 2
-            if accounts[0].account == 'coinbase':
-                assert accounts[1].account == config['id']
-                coinbase, account = accounts
-            else:
-                assert accounts[0].account == config['id']
-                assert accounts[1].account == 'coinbase'
-                account, coinbase = accounts
-        except (AssertionError, TypeError, KeyError) as error:
+            coinbase = accounts['coinbase']
+            account = accounts[config['id']]
+        except KeyError as error:
             raise RpcError(None, 'account does not exist') from error
 
         coinbase_mutation_hash, coinbase_mutation = self.compute_mutation(coinbase, amount)
         account_mutation_hash, account_mutation = self.compute_mutation(account, amount)
-        timestamp = datetime.utcnow()
-        endorser = self.config['id']
-        signature = Transaction.compute_signature(
-            self.private_key, endorser, timestamp,
-            [coinbase_mutation_hash, account_mutation_hash])
-        block_hash = Transaction.compute_hash(
-            endorser, signature, timestamp,
-            [coinbase_mutation_hash, account_mutation_hash])
-        return {
-            'hash': block_hash.hex(),
-            'endorser': endorser,
-            'signature': signature.hex(),
-            'timestamp': timestamp.isoformat(),
-            'mutations': [
-                coinbase_mutation,
-                account_mutation,
-            ]
-        }
+        return self.sign_transaction(
+            [coinbase_mutation_hash, account_mutation_hash],
+            [coinbase_mutation, account_mutation])
 
     @on_requested('transfer-money', peer_type='admin')
     @on_requested('transfer-money', peer_type='client')
     async def transfer_money_handler(self, temp_data: Any, context: Context) -> Any:
         config = context.peer_config()
         assert config is not None
-        assert self.session is not None
         try:
             data = []
             targets = set()
@@ -133,25 +91,9 @@ class EndorserProcessor(PeerProcessor):
                 })
         except (AssertionError, KeyError) as error:
             raise RpcError(None, 'bad request') from error
-        subquery = select(
-            AccountState.account,  # type: ignore
-            func.max(AccountState.version).label('latest_version')
-        ) \
-            .where(AccountState.account.in_([config['id'], *targets])) \
-            .group_by(AccountState.account).alias('latest')
-        # noinspection PyUnresolvedReferences,PyTypeChecker
-        accounts = list((await self.session.execute(
-            select(AccountState).join(  # type: ignore
-                subquery,
-                and_(
-                    AccountState.account == subquery.c.account,  # type: ignore
-                    AccountState.version == subquery.c.latest_version,  # type: ignore
-                ),
-            )
-        )).scalars())
-        if len(accounts) != len(targets) + 1:
+        accounts_map = await self.latest_account_states([config['id'], *targets])
+        if len(accounts_map) != len(targets) + 1:
             raise RpcError(None, 'account does not exist')
-        accounts_map: Dict[str, AccountState] = {account.account: account for account in accounts}
         if total_amount > accounts_map[config['id']].value:
             raise RpcError(None, 'no enough money')
         mutations: List[Tuple[bytes, Any]] = [
@@ -160,17 +102,5 @@ class EndorserProcessor(PeerProcessor):
         for item in data:
             mutations.append(self.compute_mutation(
                 accounts_map[item['target']], item['amount']))
-        mutation_hashs = [mutation_hash for mutation_hash, _ in mutations]
-        timestamp = datetime.utcnow()
-        endorser = self.config['id']
-        signature = Transaction.compute_signature(
-            self.private_key, endorser, timestamp, mutation_hashs)
-        block_hash = Transaction.compute_hash(
-            endorser, signature, timestamp, mutation_hashs)
-        return {
-            'hash': block_hash.hex(),
-            'endorser': endorser,
-            'signature': signature.hex(),
-            'timestamp': timestamp.isoformat(),
-            'mutations': [mutation for _, mutation in mutations]
-        }
+        return self.sign_transaction([mutation_hash for mutation_hash, _ in mutations],
+                                     [mutation for _, mutation in mutations])
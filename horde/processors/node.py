@@ -1,9 +1,19 @@
+import argparse
+import asyncio
+import math
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Any
+from typing import Any, Dict, List, Optional, Tuple
 
+from horde.codec import as_bytes
+from horde.merkle import merkle_root, verify_merkle_proof
 from horde.models import AccountState, TransactionMutation, Transaction, Blockchain
 from horde.processors.router import Router, processor, on_requested, Context
 
+VERIFY_CHUNK_SIZE = 32
+SIGNATURE_CACHE_SIZE = 65536
+
 
 class WrongHash(Exception):
     pass
@@ -13,15 +23,95 @@ class WrongSignature(Exception):
     pass
 
 
+SignatureKey = Tuple[bytes, str, bytes]
+
+
+class SignatureCache:
+    # Bounded LRU of (transaction hash, endorser, signature) that passed signature verification
+    # and hash recomputation, limited by entry count and optionally by the total size in bytes.
+    max_size: int
+    max_bytes: Optional[int]
+    entries: 'OrderedDict[SignatureKey, int]'  # value is the size of the entry
+    size_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int = SIGNATURE_CACHE_SIZE, max_bytes: Optional[int] = None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data: Any) -> Optional[SignatureKey]:
+        # None for malformed data, which is then rejected by the full check
+        try:
+            endorser = data['endorser']
+            assert isinstance(endorser, str)
+            return as_bytes(data['hash']), endorser, as_bytes(data['signature'])
+        except (KeyError, TypeError, ValueError, AssertionError):
+            return None
+
+    def get(self, key: Optional[SignatureKey]) -> bool:
+        if key is None or key not in self.entries:
+            self.misses += 1
+            return False
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True
+
+    def put(self, key: SignatureKey) -> None:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        size = len(key[0]) + len(key[1]) + len(key[2])
+        self.entries[key] = size
+        self.size_bytes += size
+        while len(self.entries) > self.max_size or \
+                (self.max_bytes is not None and self.size_bytes > self.max_bytes):
+            _, evicted_size = self.entries.popitem(last=False)
+            self.size_bytes -= evicted_size
+
+
+def check_valid_transactions(public_keys: Dict[str, bytes], data: List[Any]) -> List[Any]:
+    # run in the verification pool, so it only takes picklable arguments
+    return [NodeProcessor.check_valid_transaction_with_keys(public_keys, transaction)
+            for transaction in data]
+
+
 @processor
 class NodeProcessor(Router):
+    verify_executor: Optional[ProcessPoolExecutor]
+    verify_workers: int
+    verify_chunk_size: int
+    signature_cache: SignatureCache
+    merkle_root: bool
+
+    def __init__(self, config: Any, full_config: Any, args: argparse.Namespace):
+        super().__init__(config, full_config, args)
+        verification_config = full_config.get('verification', {})
+        self.verify_workers = verification_config.get('workers', 0)
+        self.verify_chunk_size = verification_config.get('chunk_size', VERIFY_CHUNK_SIZE)
+        self.verify_executor = ProcessPoolExecutor(self.verify_workers) \
+            if self.verify_workers else None
+        self.signature_cache = SignatureCache(
+            verification_config.get('signature_cache_size', SIGNATURE_CACHE_SIZE),
+            verification_config.get('signature_cache_bytes'))
+        # new blocks and transactions commit to Merkle roots, older ones are still accepted. Off
+        # unless configured, nodes without Merkle support reject such hashes
+        self.merkle_root = full_config.get('blocks', {}).get('merkle_root', False)
+
+    async def start(self) -> None:
+        await super().start()
+        if self.verify_executor is not None:
+            self.verify_executor.shutdown()
 
     @staticmethod
     def check_valid_account_state(account: str, data: Any) -> Any:
         assert isinstance(data, dict)
-        account_hash = data['hash']
-        assert isinstance(account_hash, str)
-        account_hash = bytes.fromhex(account_hash)
+        account_hash = as_bytes(data['hash'])
         version = data['version']
         assert isinstance(version, int)
         value = data['value']
@@ -39,7 +129,7 @@ class NodeProcessor(Router):
     @staticmethod
     def serialize_account_state(data) -> Any:
         return {
-            'hash': data['hash'].hex(),
+            'hash': data['hash'],
             'version': data['version'],
             'value': data['value'],
         }
@@ -47,9 +137,7 @@ class NodeProcessor(Router):
     @staticmethod
     def check_valid_mutation(data: Any) -> Any:
         assert isinstance(data, dict)
-        mutation_hash = data['hash']
-        assert isinstance(mutation_hash, str)
-        mutation_hash = bytes.fromhex(mutation_hash)
+        mutation_hash = as_bytes(data['hash'])
         account = data['account']
         assert isinstance(account, str)
         prev_account_state = NodeProcessor.check_valid_account_state(
@@ -71,23 +159,30 @@ class NodeProcessor(Router):
     @staticmethod
     def serialize_mutation(data) -> Any:
         return {
-            'hash': data['hash'].hex(),
+            'hash': data['hash'],
             'account': data['account'],
             'prev_account_state': NodeProcessor.serialize_account_state(data['prev_account_state']),
             'next_account_state': NodeProcessor.serialize_account_state(data['next_account_state']),
         }
 
     def check_valid_transaction(self, data: Any) -> Any:
+        key = SignatureCache.key(data)
+        signature_verified = self.signature_cache.get(key)
+        transaction = NodeProcessor.check_valid_transaction_with_keys(
+            self.public_keys, data, signature_verified)
+        if key is not None:
+            self.signature_cache.put(key)
+        return transaction
+
+    @staticmethod
+    def check_valid_transaction_with_keys(public_keys: Dict[str, bytes], data: Any,
+                                          signature_verified: bool = False) -> Any:
         assert isinstance(data, dict)
-        transaction_hash = data['hash']
-        assert isinstance(transaction_hash, str)
-        transaction_hash = bytes.fromhex(transaction_hash)
+        transaction_hash = as_bytes(data['hash'])
         endorser = data['endorser']
         assert isinstance(endorser, str)
-        assert endorser in self.public_keys
-        signature = data['signature']
-        assert isinstance(signature, str)
-        signature = bytes.fromhex(signature)
+        assert endorser in public_keys
+        signature = as_bytes(data['signature'])
         timestamp = data['timestamp']
         assert isinstance('timestamp', str)
         timestamp = datetime.fromisoformat(timestamp)
@@ -96,11 +191,17 @@ class NodeProcessor(Router):
         mutations = [NodeProcessor.check_valid_mutation(mutation)
                      for mutation in temp_mutations]
         mutation_hashs = [mutation['hash'] for mutation in mutations]
-        if not Transaction.verify_signature(signature, self.public_keys[endorser],
-                                            endorser, timestamp, mutation_hashs):
+        mutations_root = None
+        if data.get('mutations_root') is not None:
+            mutations_root = as_bytes(data['mutations_root'])
+            if merkle_root(mutation_hashs) != mutations_root:
+                raise WrongHash()
+        # the hash is still recomputed, so a cache hit proves the content is the verified one
+        if not signature_verified and not Transaction.verify_signature(
+                signature, public_keys[endorser], endorser, timestamp, mutation_hashs):
             raise WrongSignature
         computed_transaction_hash = Transaction.compute_hash(
-            endorser, signature, timestamp, mutation_hashs)
+            endorser, signature, timestamp, mutation_hashs, mutations_root)
         if computed_transaction_hash != transaction_hash:
             raise WrongHash()
         return {
@@ -109,38 +210,115 @@ class NodeProcessor(Router):
             'signature': signature,
             'timestamp': timestamp,
             'mutations': mutations,
+            'mutations_root': mutations_root,
         }
 
+    def sign_transaction(self, mutation_hashs: List[bytes], mutations: List[Any]) -> Any:
+        mutations_root = merkle_root(mutation_hashs) if self.merkle_root else None
+        timestamp = datetime.utcnow()
+        endorser = self.config['id']
+        signature = Transaction.compute_signature(
+            self.private_key, endorser, timestamp, mutation_hashs)
+        transaction_hash = Transaction.compute_hash(
+            endorser, signature, timestamp, mutation_hashs, mutations_root)
+        # signed here, so not verified again when the block comes back
+        self.signature_cache.put((transaction_hash, endorser, signature))
+        return self.serialize_transaction({
+            'hash': transaction_hash,
+            'endorser': endorser,
+            'signature': signature,
+            'timestamp': timestamp,
+            'mutations': mutations,
+            'mutations_root': mutations_root,
+        })
+
     @staticmethod
     def serialize_transaction(data) -> Any:
-        return {
-            'hash': data['hash'].hex(),
+        result = {
+            'hash': data['hash'],
             'endorser': data['endorser'],
-            'signature': data['signature'].hex(),
+            'signature': data['signature'],
             'timestamp': data['timestamp'].isoformat(),
             'mutations': [NodeProcessor.serialize_mutation(mutation)
                           for mutation in data['mutations']],
         }
+        if data.get('mutations_root') is not None:
+            result['mutations_root'] = data['mutations_root']
+        return result
+
+    async def check_valid_transactions(self, data: Any) -> List[Any]:
+        # SM2 verification is slow, so a list is split into chunks for the verification pool
+        # instead of blocking the event loop
+        assert isinstance(data, list)
+        # transactions with a verified signature are only hashed, in the event loop
+        transactions: List[Any] = [None] * len(data)
+        unverified = []
+        for index, transaction in enumerate(data):
+            if self.signature_cache.get(SignatureCache.key(transaction)):
+                transactions[index] = NodeProcessor.check_valid_transaction_with_keys(
+                    self.public_keys, transaction, True)
+            else:
+                unverified.append(index)
+        unverified_data = [data[index] for index in unverified]
+        if self.verify_executor is None or not unverified_data:
+            verified = check_valid_transactions(self.public_keys, unverified_data)
+        else:
+            chunk_size = min(self.verify_chunk_size,
+                             math.ceil(len(unverified_data) / self.verify_workers))
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*[
+                loop.run_in_executor(self.verify_executor, check_valid_transactions,
+                                     self.public_keys, unverified_data[i:i + chunk_size])
+                for i in range(0, len(unverified_data), chunk_size)], return_exceptions=True)
+            verified = []
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result  # the error of the first invalid chunk, as if verified in order
+                verified.extend(result)
+        for index, transaction in zip(unverified, verified):
+            transactions[index] = transaction
+            self.signature_cache.put(
+                (transaction['hash'], transaction['endorser'], transaction['signature']))
+        return transactions
+
+    async def check_valid_blockchain(self, data: Any) -> Any:
+        return (await self.check_valid_blockchains([data]))[0]
 
-    def check_valid_blockchain(self, data: Any) -> Any:
-        block_hash = data['hash']
-        assert isinstance(block_hash, str)
-        block_hash = bytes.fromhex(block_hash)
-        prev_block_hash = data['prev_hash']
-        assert isinstance(prev_block_hash, str)
-        prev_block_hash = bytes.fromhex(prev_block_hash)
+    async def check_valid_blockchains(self, data: Any) -> List[Any]:
+        # the transactions of all blocks are verified together, so that blocks fetched in bulk
+        # fill the chunks of the verification pool
+        assert isinstance(data, list)
+        for item in data:
+            assert isinstance(item['transactions'], list)
+        transactions = await self.check_valid_transactions(
+            [transaction for item in data for transaction in item['transactions']])
+        result = []
+        start = 0
+        for item in data:
+            end = start + len(item['transactions'])
+            result.append(NodeProcessor.check_valid_blockchain_header(
+                item, transactions[start:end]))
+            start = end
+        return result
+
+    @staticmethod
+    def check_valid_blockchain_header(data: Any, transactions: List[Any]) -> Any:
+        # the block around its already checked transactions
+        block_hash = as_bytes(data['hash'])
+        prev_block_hash = as_bytes(data['prev_hash'])
         timestamp = data['timestamp']
         assert isinstance('timestamp', str)
         timestamp = datetime.fromisoformat(timestamp)
         number = data['number']
         assert isinstance(number, int)
-        temp_transactions = data['transactions']
-        assert isinstance(temp_transactions, list)
-        transactions = [self.check_valid_transaction(transaction)
-                        for transaction in temp_transactions]
         transaction_hashs = [transaction['hash'] for transaction in transactions]
+        transactions_root = None
+        if data.get('transactions_root') is not None:
+            transactions_root = as_bytes(data['transactions_root'])
+            if merkle_root(transaction_hashs) != transactions_root:
+                raise WrongHash()
         computed_block_hash = Blockchain.compute_hash(
-            prev_block_hash, timestamp, number, transaction_hashs)
+            prev_block_hash, timestamp, number, transaction_hashs, transactions_root)
         if computed_block_hash != block_hash:
             raise WrongHash()
         return {
@@ -148,19 +326,43 @@ class NodeProcessor(Router):
             'prev_hash': prev_block_hash,
             'timestamp': timestamp,
             'number': number,
-            'transactions': transactions
+            'transactions': transactions,
+            'transactions_root': transactions_root,
         }
 
+    def check_valid_transaction_proof(self, data: Any) -> Any:
+        # a transaction and the header of its block, linked by the Merkle proof
+        header = data['blockchain']
+        block_hash = as_bytes(header['hash'])
+        transactions_root = as_bytes(header['transactions_root'])
+        computed_block_hash = Blockchain.compute_hash(
+            as_bytes(header['prev_hash']), datetime.fromisoformat(header['timestamp']),
+            header['number'], [], transactions_root)
+        if computed_block_hash != block_hash:
+            raise WrongHash()
+        transaction = self.check_valid_transaction(data['transaction'])
+        proof = data['proof']
+        assert isinstance(proof, list)
+        if not verify_merkle_proof(transaction['hash'], [{
+            'hash': as_bytes(step['hash']),
+            'left': bool(step['left']),
+        } for step in proof], transactions_root):
+            raise WrongHash()
+        return transaction
+
     @staticmethod
     def serialize_blockchain(data) -> Any:
-        return {
-            'hash': data['hash'].hex(),
-            'prev_hash': data['prev_hash'].hex(),
+        result = {
+            'hash': data['hash'],
+            'prev_hash': data['prev_hash'],
             'timestamp': data['timestamp'].isoformat(),
             'number': data['number'],
             'transactions': [NodeProcessor.serialize_transaction(transaction)
                              for transaction in data['transactions']],
         }
+        if data.get('transactions_root') is not None:
+            result['transactions_root'] = data['transactions_root']
+        return result
 
     @on_requested('who-are-you')
     async def who_are_you_handler(self, data: Any, context: Context) -> Any:
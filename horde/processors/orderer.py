@@ -4,8 +4,7 @@ import logging
 from datetime import datetime
 from typing import Any, List, Set
 
-from sqlalchemy import select, func
-
+from horde.merkle import merkle_root
 from horde.models import Blockchain
 from horde.processors.node import WrongHash, WrongSignature
 from horde.processors.peer import PeerProcessor
@@ -31,43 +30,34 @@ class OrdererProcessor(PeerProcessor):
     async def generate_blockchain(self, transactions: List[Any],
                                   mutated_accounts: Set[str]) -> None:
         logging.info('%s: generate block started', self.config['id'])
-        assert self.session is not None
-        subquery = select(func.max(Blockchain.number).label('latest_number')).alias('latest')
-        # noinspection PyTypeChecker
-        result = list((await self.session.execute(
-            select(Blockchain)  # type: ignore
-                .join(subquery, Blockchain.number == subquery.c.latest_number)
-        )).scalars())
-        assert len(result) == 1
-        prev: Blockchain = result[0]
+        assert self.tip is not None
+        prev_hash, prev_number = self.tip
         timestamp = datetime.utcnow()
-        number = prev.number + 1
+        number = prev_number + 1
+        transaction_hashs = [transaction['hash'] for transaction in transactions]
+        transactions_root = merkle_root(transaction_hashs) if self.merkle_root else None
         blockchain_hash = Blockchain.compute_hash(
-            prev.hash, timestamp, number,
-            [transaction['hash'] for transaction in transactions])
+            prev_hash, timestamp, number, transaction_hashs, transactions_root)
         blockchain = {
             'hash': blockchain_hash,
-            'prev_hash': prev.hash,
+            'prev_hash': prev_hash,
             'timestamp': timestamp,
             'number': number,
-            'transactions': transactions
+            'transactions': transactions,
+            'transactions_root': transactions_root,
         }
         logging.info('%s: generate block finished %d', self.config['id'], number)
         if self.verify_num == 1:
             await self.save_blockchain(blockchain)
         else:
-            data = self.serialize_blockchain(blockchain)
-            await asyncio.gather(
-                *[self.notify('new-blockchain', data, connection)
-                  for connection in self.connection_to_config])
-            await self.verify_blockchain(blockchain)
+            await self.broadcast('new-blockchain', self.serialize_blockchain(blockchain))
+            await self._verify_blockchain(blockchain)
 
     @on_requested('submit-transactions', peer_type='admin')
     @on_requested('submit-transactions', peer_type='client')
     async def submit_transaction(self, data: Any, context: Context) -> Any:
         try:
-            assert isinstance(data, list)
-            transactions = [self.check_valid_transaction(item) for item in data]
+            transactions = await self.check_valid_transactions(data)
         except (KeyError, AssertionError, ValueError) as error:
             raise RpcError(None, 'bad request') from error
         except WrongHash as error:
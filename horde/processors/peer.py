@@ -2,36 +2,170 @@ import argparse
 import asyncio
 import logging
 import os
-from typing import Any, Optional, Dict, Tuple
+from collections import OrderedDict, deque
+from typing import Any, Optional, Deque, Dict, Tuple, Iterable, List
 
-from sqlalchemy import select, and_, func
-from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, AsyncSession  # type: ignore
-from sqlalchemy.orm import subqueryload
+from sqlalchemy import select, and_, func, literal_column, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession  # type: ignore
+from sqlalchemy.orm import Session, aliased, subqueryload
 
-from horde.models import Blockchain, Transaction, TransactionMutation, AccountState
+from horde.blocklog import BlockLog
+from horde.codec import as_bytes, json_dumps, encode_cursor, decode_cursor
+from horde.merkle import merkle_proof
+from horde.models import Blockchain, Transaction, TransactionMutation, AccountState, \
+    LatestAccountState, select_latest_account_states, upgrade_schema
+from horde.processors import router
 from horde.processors.node import NodeProcessor
-from horde.processors.router import processor, on_requested, on_client_connected, Context, \
+from horde.processors.router import processor, on_requested, on_server_connected, Context, \
     RpcError, on_notified
+from horde.storage import create_storage_engine, storage_backend, ReadPool, READ_CONNECTIONS, \
+    PRIORITY_READ_CONNECTIONS
+
+
+ACCOUNT_STATE_CACHE_SIZE = 65536
+GROUP_COMMIT_SIZE = 16
+BLOCK_CACHE_SIZE = 1024
+BLOCK_CACHE_BYTES = 64 * 1024 * 1024
+SYNC_BATCH_SIZE = 128
+SYNC_PIPELINE = 4
 
 
 class BlockchainRejected(Exception):
     pass
 
 
+class AccountStateCache:
+    # Bounded LRU of the latest AccountState of accounts, the states are detached copies
+    max_size: int
+    entries: 'OrderedDict[str, AccountState]'
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int = ACCOUNT_STATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, account: str) -> Optional[AccountState]:
+        state = self.entries.get(account)
+        if state is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(account)
+        self.hits += 1
+        return state
+
+    def put(self, state: AccountState) -> None:
+        # a state read before a newer one was saved never replaces it
+        cached = self.entries.get(state.account)
+        if cached is None or cached.version < state.version:
+            self.entries[state.account] = AccountState(
+                account=state.account, version=state.version, value=state.value, hash=state.hash)
+        self.entries.move_to_end(state.account)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class BlockCache:
+    # Bounded LRU of serialized blocks by number, limited by count and by their size as JSON.
+    # Saved blocks never change, so entries are never invalidated.
+    max_size: int
+    max_bytes: int
+    entries: 'OrderedDict[int, Tuple[Any, int]]'  # value is the block and its size
+    size_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int = BLOCK_CACHE_SIZE, max_bytes: int = BLOCK_CACHE_BYTES):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, number: int) -> Optional[Any]:
+        entry = self.entries.get(number)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(number)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, number: int, blockchain: Any, size: int) -> None:
+        if number in self.entries or size > self.max_bytes:
+            return
+        self.entries[number] = blockchain, size
+        self.size_bytes += size
+        while len(self.entries) > self.max_size or self.size_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size_bytes -= evicted_size
+
+
 @processor
 class PeerProcessor(NodeProcessor):
     engine: AsyncEngine
-    session: Optional[AsyncSession]
+    read_pool: ReadPool
+    block_log: Optional[BlockLog] = None  # instead of the SQLite tables when set
     blockchains: Dict[bytes, Tuple[Optional[Any], int]]
+    tip: Optional[Tuple[bytes, int]]  # hash and number of the latest saved block
+    # totals of the account pages, counted once at start and then kept along with the tip
+    account_count: int
+    account_state_count: int
+    account_state_cache: AccountStateCache
+    block_cache: BlockCache
+    save_queue: asyncio.Queue
+    group_commit_size: int
+    tip_loaded: asyncio.Event
+    # blocks received ahead of the tip, verified once the sync has saved the ones before them
+    waiting_blockchains: Dict[int, Any]
+    sync_task: Optional[asyncio.Task] = None
+    sync_batch_size: int
+    sync_pipeline: int
 
     def __init__(self, config: Any, full_config: Any, args: argparse.Namespace):
         super().__init__(config, full_config, args)
-        self.engine = create_async_engine('sqlite:///' +
-                                          os.path.join(self.config['root'], 'sqlite.db'))
-        self.session = None
+        storage_config = full_config.get('storage', {})
+        self.engine = create_storage_engine(os.path.join(self.config['root'], 'sqlite.db'),
+                                            storage_config)
+        # the writer keeps using `engine`, queries go through read-only connections
+        self.read_pool = ReadPool(
+            create_storage_engine(os.path.join(self.config['root'], 'sqlite.db'),
+                                  storage_config, read_only=True),
+            storage_config.get('read_connections', READ_CONNECTIONS),
+            storage_config.get('priority_read_connections', PRIORITY_READ_CONNECTIONS))
+        self.block_log = None
+        if storage_backend(self.config, full_config) == 'blocklog':
+            self.block_log = BlockLog(self.config['root'], storage_config)
         self.blockchains = {}
+        self.tip = None
+        self.account_count = 0
+        self.account_state_count = 0
+        cache_config = full_config.get('cache', {})
+        self.account_state_cache = AccountStateCache(
+            cache_config.get('account_states', ACCOUNT_STATE_CACHE_SIZE))
+        self.block_cache = BlockCache(cache_config.get('blocks', BLOCK_CACHE_SIZE),
+                                      cache_config.get('block_bytes', BLOCK_CACHE_BYTES))
+        self.save_queue = asyncio.Queue()
+        self.group_commit_size = storage_config.get('group_commit_size', GROUP_COMMIT_SIZE)
+        self.tip_loaded = asyncio.Event()
+        self.waiting_blockchains = {}
+        sync_config = full_config.get('sync', {})
+        self.sync_batch_size = sync_config.get('batch_size', SYNC_BATCH_SIZE)
+        self.sync_pipeline = sync_config.get('pipeline', SYNC_PIPELINE)
 
-    @on_client_connected()
+    @on_server_connected('orderer')
+    @on_server_connected('endorser')
+    @router.on_client_connected('orderer')
+    @router.on_client_connected('endorser')
+    async def on_peer_connected(self, context: Context) -> None:
+        # a peer that was offline catches up with the first peer it sees again
+        await self.tip_loaded.wait()
+        self._start_sync(context.connection_id)
+
+    @router.on_client_connected()
     async def on_client_connected(self, context: Context) -> None:
         if context.peer_config() is None:
             peer_id = await context.request('who-are-you')
@@ -39,52 +173,242 @@ class PeerProcessor(NodeProcessor):
 
     async def start(self) -> None:
         host, port = self.config['bind_addr']
+        if self.block_log is not None:
+            self.block_log.open()
+        else:
+            async with self.engine.begin() as connection:
+                await connection.run_sync(upgrade_schema)
+        await self.warm_state_cache()
+        self.tip_loaded.set()
+        writer_task = asyncio.create_task(self.write_blockchains())
         await self.start_server(host, port)
-        self.session = AsyncSession(self.engine)
         await super().start()
-        await self.session.close()
-        self.session = None
-
-    async def save_blockchain(self, blockchain: Any) -> None:
-        logging.info('%s: save blockchain %d', self.config['id'], blockchain['number'])
-        async with AsyncSession(self.engine) as session:
-            async with session.begin():
-                session.add(
-                    Blockchain(
-                        hash=blockchain['hash'], prev_hash=blockchain['prev_hash'],
-                        timestamp=blockchain['timestamp'], number=blockchain['number'])
-                )
-                session.add_all([
-                    Transaction(
-                        hash=transaction['hash'], signature=transaction['signature'],
-                        endorser=transaction['endorser'], timestamp=transaction['timestamp'],
-                        blockchain_hash=blockchain['hash'])
-                    for transaction in blockchain['transactions']
-                ])
-                session.add_all([
-                    TransactionMutation(
-                        hash=mutation['hash'], account=mutation['account'],
-                        prev_version=mutation['prev_account_state']['version'],
-                        next_version=mutation['next_account_state']['version'],
-                        transaction_hash=transaction['hash']
-                    )
-                    for transaction in blockchain['transactions']
-                    for mutation in transaction['mutations']
-                ])
-                session.add_all([
-                    AccountState(
-                        hash=account['hash'], version=account['version'],
-                        value=account['value'], account=mutation['account']
-                    )
-                    for transaction in blockchain['transactions']
-                    for mutation in transaction['mutations']
-                    for account in [mutation['next_account_state']]
-                ])
+        writer_task.cancel()
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+        await self.read_pool.close()
+        if self.block_log is not None:
+            self.block_log.close()
+
+    async def warm_state_cache(self) -> None:
+        if self.block_log is not None:
+            self.tip = self.block_log.tip
+            self.account_count = self.block_log.account_count
+            self.account_state_count = self.block_log.account_state_count
+            for state in self.block_log.latest_states(limit=self.account_state_cache.max_size):
+                self.account_state_cache.put(state)
+            return
+        subquery = select(func.max(Blockchain.number).label('latest_number')).alias('latest')
+
+        def query(session: Session) -> Tuple[Blockchain, List[AccountState], int, int]:
+            # noinspection PyTypeChecker
+            return session.execute(
+                select(Blockchain)  # type: ignore
+                    .join(subquery, Blockchain.number == subquery.c.latest_number)
+            ).scalars().one(), list(session.execute(select_latest_account_states().limit(
+                self.account_state_cache.max_size)).scalars()), \
+                session.execute(select(func.count(LatestAccountState.account))).scalar(), \
+                session.execute(select(func.count(AccountState.hash))).scalar()
+        tip, states, self.account_count, self.account_state_count = \
+            await self.read_pool.run(query, priority=True)
+        self.tip = tip.hash, tip.number
+        for state in states:
+            self.account_state_cache.put(state)
+
+    async def latest_account_states(self, accounts: Iterable[str],
+                                    priority: bool = False) -> Dict[str, AccountState]:
+        # accounts that do not exist are left out, `priority` for reads of the consensus
+        result = {}
+        missing = []
+        for account in accounts:
+            cached = self.account_state_cache.get(account)
+            if cached is None:
+                missing.append(account)
+            else:
+                result[account] = cached
+        if missing:
+            if self.block_log is not None:
+                states = self.block_log.latest_states(missing)
+            else:
+                states = await self.read_pool.run(lambda session: list(session.execute(
+                    select_latest_account_states(*missing)).scalars()), priority)
+            for state in states:
+                self.account_state_cache.put(state)
+                result[state.account] = state
+        return result
+
+    async def check_state_cache(self) -> List[str]:
+        # differences between the in-memory tip and account states and the database, for tests
+        errors = []
+
+        def query(session: Session) -> Tuple[Any, Dict[str, AccountState], int]:
+            tip = session.execute(
+                select(Blockchain.hash, Blockchain.number)  # type: ignore
+                    .order_by(Blockchain.number.desc()).limit(1)).one()
+            return (tip.hash, tip.number), \
+                {state.account: state for state in session.execute(
+                    select_latest_account_states()).scalars()}, \
+                session.execute(select(func.count(AccountState.hash))).scalar()
+        if self.block_log is not None:
+            # None before the genesis is appended
+            blockchain = self.block_log.read(len(self.block_log.index))
+            tip = None if blockchain is None else (as_bytes(blockchain['hash']),
+                                                   blockchain['number'])
+            states = {state.account: state for state in self.block_log.latest_states()}
+            account_state_count = self.block_log.meta('account_states')
+        else:
+            tip, states, account_state_count = await self.read_pool.run(query)
+        if self.tip != tip:
+            errors.append('tip %r, database has %r' % (self.tip, tip))
+        if (self.account_count, self.account_state_count) != (len(states), account_state_count):
+            errors.append('account counts %r, database has %r' % (
+                (self.account_count, self.account_state_count),
+                (len(states), account_state_count)))
+        for account, cached in self.account_state_cache.entries.items():
+            state = states.get(account)
+            if state is None or (cached.version, cached.value, cached.hash) != \
+                    (state.version, state.value, state.hash):
+                errors.append('account %s cached %r, database has %r' % (
+                    account, (cached.version, cached.value, cached.hash),
+                    None if state is None else (state.version, state.value, state.hash)))
+        return errors
+
+    async def save_blockchain(self, blockchain: Any, synced: bool = False) -> None:
+        # returns once the block is committed, possibly together with the blocks queued after it.
+        # A `synced` block saved meanwhile by the live verification is not saved again
+        future = asyncio.get_running_loop().create_future()
+        await self.save_queue.put((blockchain, synced, future))
+        await future
+
+    async def write_blockchains(self) -> None:
+        # the only writer of the database, blocks already waiting share one transaction
+        while True:
+            group = [await self.save_queue.get()]
+            while len(group) < self.group_commit_size and not self.save_queue.empty():
+                group.append(self.save_queue.get_nowait())
+            group = self._skip_saved(group)
+            if len(group) > 1:
+                try:
+                    await self.commit_blockchains([blockchain for blockchain, _, _ in group])
+                except Exception:  # pylint:disable=broad-except
+                    # rolled back, then one by one so that a bad block does not fail the others
+                    pass
+                else:
+                    for _, _, future in group:
+                        if not future.done():
+                            future.set_result(None)
+                    continue
+            for item in group:
+                # checked again, the blocks before it in the group may have failed
+                for blockchain, _, future in self._skip_saved([item]):
+                    try:
+                        await self.commit_blockchains([blockchain])
+                    except Exception as error:  # pylint:disable=broad-except
+                        if not future.done():
+                            future.set_exception(error)
+                    else:
+                        if not future.done():
+                            future.set_result(None)
+
+    def _skip_saved(self, group: List[Any]) -> List[Any]:
+        # synced blocks were checked against the tip of their fetch, the ones saved since are done
+        # and the others must still follow the tip, or the block before them in the group
+        tip = self.tip
+        kept = []
+        for blockchain, synced, future in group:
+            if synced and tip is not None and blockchain['number'] <= tip[1]:
+                if not future.done():
+                    future.set_result(None)
+            elif synced and tip is not None and blockchain['prev_hash'] != tip[0]:
+                if not future.done():
+                    future.set_exception(AssertionError('block %d does not follow the tip'
+                                                        % blockchain['number']))
+            else:
+                kept.append((blockchain, synced, future))
+                tip = blockchain['hash'], blockchain['number']
+        return kept
+
+    async def commit_blockchains(self, blockchains: List[Any]) -> None:
+        for blockchain in blockchains:
+            logging.info('%s: save blockchain %d', self.config['id'], blockchain['number'])
+        if self.block_log is not None:
+            self.block_log.append([self.serialize_blockchain(blockchain)
+                                   for blockchain in blockchains])
+        else:
+            async with AsyncSession(self.engine) as session:
+                async with session.begin():
+                    await self.insert_blockchains(session, blockchains)
+        # committed, updated without awaiting so that readers see the blocks all or nothing
+        for blockchain in blockchains:
+            self.tip = blockchain['hash'], blockchain['number']
+            for transaction in blockchain['transactions']:
+                # accounts are only created by `init`, a mutation always has a previous state
+                self.account_state_count += len(transaction['mutations'])
+                for mutation in transaction['mutations']:
+                    account = mutation['next_account_state']
+                    self.account_state_cache.put(AccountState(
+                        account=mutation['account'], version=account['version'],
+                        value=account['value'], hash=account['hash']))
+
+    @staticmethod
+    async def insert_blockchains(session: AsyncSession, blockchains: List[Any]) -> None:
+        # rows are only ever appended, one executemany per table skips the unit of work
+        blockchain_rows = []
+        transaction_rows = []
+        mutation_rows = []
+        account_rows = []
+        latest_versions: Dict[str, int] = {}
+        for blockchain in blockchains:
+            blockchain_rows.append({
+                'hash': blockchain['hash'],
+                'prev_hash': blockchain['prev_hash'],
+                'timestamp': blockchain['timestamp'],
+                'number': blockchain['number'],
+                'transactions_root': blockchain.get('transactions_root'),
+            })
+            for transaction in blockchain['transactions']:
+                transaction_rows.append({
+                    'hash': transaction['hash'],
+                    'signature': transaction['signature'],
+                    'endorser': transaction['endorser'],
+                    'timestamp': transaction['timestamp'],
+                    'blockchain_hash': blockchain['hash'],
+                    'mutations_root': transaction.get('mutations_root'),
+                })
+                for mutation in transaction['mutations']:
+                    account = mutation['next_account_state']
+                    mutation_rows.append({
+                        'hash': mutation['hash'],
+                        'account': mutation['account'],
+                        'prev_version': mutation['prev_account_state']['version'],
+                        'next_version': account['version'],
+                        'transaction_hash': transaction['hash'],
+                    })
+                    account_rows.append({
+                        'account': mutation['account'],
+                        'version': account['version'],
+                        'value': account['value'],
+                        'hash': account['hash'],
+                    })
+                    # later blocks come later, a block mutates an account at most once
+                    latest_versions[mutation['account']] = account['version']
+        for table, rows in ((Blockchain.__table__, blockchain_rows),
+                            (Transaction.__table__, transaction_rows),
+                            (TransactionMutation.__table__, mutation_rows),
+                            (AccountState.__table__, account_rows)):
+            if rows:
+                await session.execute(table.insert(), rows)
+        if latest_versions:
+            await session.execute(
+                LatestAccountState.__table__.insert().prefix_with('OR REPLACE'), [{
+                    'account': account,
+                    'version': version,
+                } for account, version in latest_versions.items()])
 
     @on_notified('new-blockchain-verified', peer_type='orderer')
     @on_notified('new-blockchain-verified', peer_type='endorser')
     async def new_blockchain_verified_handler(self, data: Any, context: Context) -> None:
-        blockchain_hash = bytes.fromhex(data['hash'])
+        blockchain_hash = as_bytes(data['hash'])
         if data['verified']:
             if blockchain_hash not in self.blockchains:
                 self.blockchains[blockchain_hash] = None, 0
@@ -95,8 +419,7 @@ class PeerProcessor(NodeProcessor):
                 del self.blockchains[blockchain_hash]
                 await self.save_blockchain(new_tuple[0])
 
-    async def verify_blockchain(self, blockchain: Any) -> None:
-        assert self.session is not None
+    async def _verify_blockchain(self, blockchain: Any) -> None:
         verified: Optional[bool] = None
         try:
             if blockchain['hash'] in self.blockchains:
@@ -104,40 +427,19 @@ class PeerProcessor(NodeProcessor):
                 self.blockchains[blockchain['hash']] = blockchain, old_tuple[1]
             else:
                 self.blockchains[blockchain['hash']] = blockchain, 0
-            subquery1 = select(func.max(Blockchain.number).label('latest_number')).alias('latest')
-            # noinspection PyTypeChecker
-            results1 = list((await self.session.execute(
-                select(Blockchain)  # type: ignore
-                    .join(subquery1, Blockchain.number == subquery1.c.latest_number)
-            )).scalars())
-            assert len(results1) == 1
-            prev: Blockchain = results1[0]
-            assert blockchain['number'] == prev.number + 1
-            assert blockchain['prev_hash'] == prev.hash
+            assert self.tip is not None
+            prev_hash, prev_number = self.tip
+            assert blockchain['number'] == prev_number + 1
+            assert blockchain['prev_hash'] == prev_hash
             accounts: Dict[str, Any] = {}
             for transaction in blockchain['transactions']:
                 for mutation in transaction['mutations']:
                     account = mutation['account']
                     assert account not in accounts
                     accounts[account] = mutation['prev_account_state']
-            subquery2 = select(
-                AccountState.account,  # type: ignore
-                func.max(AccountState.version).label('latest_version')
-            ) \
-                .where(AccountState.account.in_(list(accounts.keys()))) \
-                .group_by(AccountState.account).alias('latest')
-            # noinspection PyUnresolvedReferences,PyTypeChecker
-            results2 = list((await self.session.execute(
-                select(AccountState).join(  # type: ignore
-                    subquery2,
-                    and_(
-                        AccountState.account == subquery2.c.account,  # type: ignore
-                        AccountState.version == subquery2.c.latest_version,  # type: ignore
-                    ),
-                )
-            )).scalars())
-            assert len(accounts) == len(results2)
-            for account_result in results2:
+            results = await self.latest_account_states(accounts.keys(), priority=True)
+            assert len(accounts) == len(results)
+            for account_result in results.values():
                 account = accounts[account_result.account]
                 assert account['version'] == account_result.version
                 assert account['value'] == account_result.value
@@ -154,43 +456,348 @@ class PeerProcessor(NodeProcessor):
                 if new_tuple[0] is not None and new_tuple[1] >= self.verify_num:
                     del self.blockchains[blockchain['hash']]
                     await self.save_blockchain(new_tuple[0])
-            await asyncio.gather(*[
-                self.notify('new-blockchain-verified', {
-                    'hash': blockchain['hash'].hex(),
-                    'verified': verified,
-                }, connection) for connection in self.connection_to_config])
+            await self.broadcast('new-blockchain-verified', {
+                'hash': blockchain['hash'],
+                'verified': verified,
+            })
             logging.info('%s: %s block %d', self.config['id'],
                          'accept' if verified else 'reject', blockchain['number'])
 
     @on_notified('new-blockchain', peer_type='orderer')
     async def new_blockchain_handler(self, data: Any, context: Context) -> None:
-        assert self.session is not None
-        blockchain = self.check_valid_blockchain(data)
-        await self.verify_blockchain(blockchain)
+        blockchain = await self.check_valid_blockchain(data)
+        if self.tip is not None and blockchain['number'] > self.tip[1] + 1:
+            # blocks were missed, they are fetched from the orderer before this one is verified
+            self.waiting_blockchains[blockchain['number']] = blockchain
+            self._start_sync(context.connection_id)
+            return
+        await self._verify_blockchain(blockchain)
+
+    def _start_sync(self, connection_id: str) -> None:
+        # one sync at a time, a gap seen meanwhile is closed by the running one or the next one
+        if self.sync_task is None or self.sync_task.done():
+            self.sync_task = asyncio.create_task(self._sync_blockchains(connection_id))
+
+    async def _sync_blockchains(self, connection_id: str) -> None:
+        # ranges of blocks after the tip are fetched from the peer, several in flight, and saved
+        # once checked, until the tip of the peer is reached
+        assert self.tip is not None
+        next_number = self.tip[1] + 1
+        target: Optional[int] = None  # the tip of the peer in its latest response
+        pending: Deque[Tuple[int, asyncio.Task]] = deque()
+        try:
+            while True:
+                while len(pending) < self.sync_pipeline and \
+                        (next_number <= target if target is not None else not pending):
+                    pending.append((next_number, asyncio.create_task(self.request(
+                        'fetch-blockchains',
+                        {'from_number': next_number, 'count': self.sync_batch_size},
+                        connection_id))))
+                    next_number += self.sync_batch_size
+                if not pending:
+                    break
+                from_number, task = pending.popleft()
+                result = await task
+                target = result['tip']
+                assert isinstance(target, int)
+                blockchains = await self.check_valid_blockchains(result['blockchains'])
+                # blocks saved meanwhile by the live verification are skipped, also by the writer
+                blockchains = [blockchain for blockchain in blockchains
+                               if blockchain['number'] > self.tip[1]]
+                await self._check_synced_blockchains(blockchains)
+                for blockchain in blockchains:
+                    self.blockchains.pop(blockchain['hash'], None)
+                await asyncio.gather(*[self.save_blockchain(blockchain, synced=True)
+                                       for blockchain in blockchains])
+                if blockchains:
+                    logging.info('%s: synced blocks %d to %d', self.config['id'],
+                                 blockchains[0]['number'], blockchains[-1]['number'])
+                if from_number + len(result['blockchains']) < \
+                        min(from_number + self.sync_batch_size, target + 1):
+                    # the peer sent fewer blocks than asked, the ranges after it start again
+                    assert blockchains, 'no progress'
+                    for _, task in pending:
+                        task.cancel()
+                    pending.clear()
+                    next_number = self.tip[1] + 1
+        except Exception as error:  # pylint:disable=broad-except
+            if isinstance(error, asyncio.CancelledError):
+                raise  # an Exception before Python 3.8, the sync was cancelled
+            logging.warning('%s: sync from %s stopped: %r', self.config['id'], connection_id,
+                            error)
+        finally:
+            for _, task in pending:
+                task.cancel()
+        await self._verify_waiting_blockchains()
+
+    async def _check_synced_blockchains(self, blockchains: List[Any]) -> None:
+        # like `_verify_blockchain` for a run of blocks, each one following the one before it
+        assert self.tip is not None
+        prev_hash, prev_number = self.tip
+        accounts = {mutation['account'] for blockchain in blockchains
+                    for transaction in blockchain['transactions']
+                    for mutation in transaction['mutations']}
+        states = {account: (state.version, state.value) for account, state in
+                  (await self.latest_account_states(accounts, priority=True)).items()}
+        for blockchain in blockchains:
+            assert blockchain['number'] == prev_number + 1
+            assert blockchain['prev_hash'] == prev_hash
+            mutated = set()
+            for transaction in blockchain['transactions']:
+                for mutation in transaction['mutations']:
+                    account = mutation['account']
+                    assert account not in mutated
+                    mutated.add(account)
+                    prev_state = mutation['prev_account_state']
+                    assert states.get(account) == (prev_state['version'], prev_state['value'])
+                    next_state = mutation['next_account_state']
+                    states[account] = next_state['version'], next_state['value']
+            prev_hash, prev_number = blockchain['hash'], blockchain['number']
+
+    async def _verify_waiting_blockchains(self) -> None:
+        # the blocks received while behind, in order, as long as they follow the tip
+        while self.tip is not None:
+            for number in [number for number in self.waiting_blockchains
+                           if number <= self.tip[1]]:
+                del self.waiting_blockchains[number]
+            blockchain = self.waiting_blockchains.pop(self.tip[1] + 1, None)
+            if blockchain is None:
+                break
+            tip = self.tip
+            await self._verify_blockchain(blockchain)
+            if self.tip == tip:
+                # saved once enough peers verified it, the next ones wait for another sync
+                break
+
+    @on_requested('fetch-blockchains', peer_type='orderer')
+    @on_requested('fetch-blockchains', peer_type='endorser')
+    async def fetch_blockchains_handler(self, data: Any, context: Context) -> Any:
+        # consecutive blocks for a peer catching up, and the tip it can catch up to
+        try:
+            from_number = data['from_number']
+            assert isinstance(from_number, int) and from_number >= 1
+            count = data.get('count', self.sync_batch_size)
+            assert isinstance(count, int) and count >= 1
+        except (AssertionError, TypeError, KeyError, AttributeError) as error:
+            raise RpcError(None, 'bad request') from error
+        if self.tip is None:
+            # asked by a peer that connected while this one was starting
+            await self.tip_loaded.wait()
+        assert self.tip is not None
+        tip_number = self.tip[1]
+        to_number = min(from_number + min(count, self.sync_batch_size) - 1, tip_number)
+
+        def query(session: Session) -> List[Any]:
+            # noinspection PyTypeChecker,PyUnresolvedReferences
+            return [blockchain.serialize() for blockchain in session.execute(
+                select(Blockchain).options(  # type: ignore
+                    subqueryload(Blockchain.transactions)
+                        .subqueryload(Transaction.mutations)
+                        .options(
+                            subqueryload(TransactionMutation.prev_account_state),
+                            subqueryload(TransactionMutation.next_account_state)))
+                    .where(Blockchain.number.between(from_number, to_number))
+                    .order_by(Blockchain.number)
+            ).scalars()]
+        if from_number > to_number:
+            blockchains = []
+        elif self.block_log is not None:
+            blockchains = [self.block_log.read(number)
+                           for number in range(from_number, to_number + 1)]
+        else:
+            blockchains = await self.read_pool.run(query)
+        return {'tip': tip_number, 'blockchains': blockchains}
 
     @on_requested('query-blockchain', peer_type='admin')
     @on_requested('query-blockchain', peer_type='client')
     async def query_blockchain_handler(self, data: Any, context: Context) -> Any:
-        assert self.session is not None
         try:
             blockchain_number = data['blockchain_number']
             assert isinstance(blockchain_number, int)
         except (AssertionError, TypeError, KeyError) as error:
             raise RpcError(None, 'bad request') from error
-        # noinspection PyTypeChecker,PyUnresolvedReferences
-        result = list((await self.session.execute(
-            select(Blockchain).options(  # type: ignore
-                subqueryload(Blockchain.transactions)
-                    .subqueryload(Transaction.mutations)
-                    .options(
-                        subqueryload(TransactionMutation.prev_account_state),
-                        subqueryload(TransactionMutation.next_account_state)))
-                    .where(Blockchain.number == blockchain_number)
-            )).scalars())
-        if len(result) == 0:
-            raise RpcError(None, 'not found')
-        item: Blockchain = result[0]
-        return item.serialize()
+        cached = self.block_cache.get(blockchain_number)
+        if cached is not None:
+            return cached
+
+        def query(session: Session) -> Tuple[Any, int]:
+            # noinspection PyTypeChecker,PyUnresolvedReferences
+            result = list(session.execute(
+                select(Blockchain).options(  # type: ignore
+                    subqueryload(Blockchain.transactions)
+                        .subqueryload(Transaction.mutations)
+                        .options(
+                            subqueryload(TransactionMutation.prev_account_state),
+                            subqueryload(TransactionMutation.next_account_state)))
+                        .where(Blockchain.number == blockchain_number)
+                ).scalars())
+            if len(result) == 0:
+                raise RpcError(None, 'not found')
+            item = result[0].serialize()
+            return item, len(json_dumps(item))
+        if self.block_log is not None:
+            blockchain = self.block_log.read(blockchain_number)
+            if blockchain is None:
+                raise RpcError(None, 'not found')
+            size = self.block_log.size(blockchain_number)
+        else:
+            blockchain, size = await self.read_pool.run(query)
+        self.block_cache.put(blockchain_number, blockchain, size)
+        return blockchain
+
+    @on_requested('query-transaction-proof', peer_type='admin')
+    @on_requested('query-transaction-proof', peer_type='client')
+    async def query_transaction_proof_handler(self, data: Any, context: Context) -> Any:
+        try:
+            transaction_hash = as_bytes(data['hash'])
+        except (AssertionError, TypeError, KeyError, ValueError) as error:
+            raise RpcError(None, 'bad request') from error
+        if self.block_log is not None:
+            raise RpcError(None, 'not supported by the block log storage')
+
+        def query(session: Session) -> Any:
+            # noinspection PyTypeChecker,PyUnresolvedReferences
+            result = list(session.execute(
+                select(Transaction).options(  # type: ignore
+                    subqueryload(Transaction.blockchain),
+                    subqueryload(Transaction.mutations)
+                        .options(
+                            subqueryload(TransactionMutation.prev_account_state),
+                            subqueryload(TransactionMutation.next_account_state)))
+                    .where(Transaction.hash == transaction_hash)
+            ).scalars())
+            if len(result) == 0:
+                raise RpcError(None, 'not found')
+            transaction: Transaction = result[0]
+            blockchain: Blockchain = transaction.blockchain
+            if blockchain.transactions_root is None:
+                raise RpcError(None, 'no merkle root')
+            # same order as the transactions of query-blockchain, the order they were saved in
+            transaction_hashs = list(session.execute(
+                select(Transaction.hash)  # type: ignore
+                    .where(Transaction.blockchain_hash == blockchain.hash)
+                    .order_by(literal_column('rowid'))
+            ).scalars())
+            index = transaction_hashs.index(transaction_hash)
+            return {
+                'blockchain': blockchain.serialize_header(),
+                'transaction': transaction.serialize(),
+                'index': index,
+                'proof': merkle_proof(transaction_hashs, index),
+            }
+        return await self.read_pool.run(query)
+
+    @on_requested('query-transaction', peer_type='admin')
+    @on_requested('query-transaction', peer_type='client')
+    async def query_transaction_handler(self, data: Any, context: Context) -> Any:
+        # a transaction by its hash, with the header of the block that holds it
+        try:
+            transaction_hash = as_bytes(data['hash'])
+        except (AssertionError, TypeError, KeyError, ValueError) as error:
+            raise RpcError(None, 'bad request') from error
+        if self.block_log is not None:
+            raise RpcError(None, 'not supported by the block log storage')
+
+        def query(session: Session) -> Any:
+            # noinspection PyTypeChecker,PyUnresolvedReferences
+            result = list(session.execute(
+                select(Transaction).options(  # type: ignore
+                    subqueryload(Transaction.blockchain),
+                    subqueryload(Transaction.mutations)
+                        .options(
+                            subqueryload(TransactionMutation.prev_account_state),
+                            subqueryload(TransactionMutation.next_account_state)))
+                    .where(Transaction.hash == transaction_hash)
+            ).scalars())
+            if len(result) == 0:
+                raise RpcError(None, 'not found')
+            transaction: Transaction = result[0]
+            return {
+                'blockchain': transaction.blockchain.serialize_header(),
+                'transaction': transaction.serialize(),
+            }
+        return await self.read_pool.run(query)
+
+    @on_requested('query-account-history', peer_type='admin')
+    @on_requested('query-account-history', peer_type='client')
+    async def query_account_history_handler(self, data: Any, context: Context) -> Any:
+        # the mutations of an account with the block and transaction of each, newest first
+        # unless `asc`, paginated by the `cursor` of the previous page
+        try:
+            account = data['account']
+            assert isinstance(account, str)
+            asc = False
+            if 'asc' in data:
+                asc = data['asc']
+                assert isinstance(asc, bool)
+            limit = 15
+            if 'limit' in data:
+                limit = data['limit']
+                assert isinstance(limit, int)
+                assert limit >= 0
+            after_version = None
+            if 'cursor' in data:
+                after_version, = decode_cursor(data['cursor'])
+                assert isinstance(after_version, int)
+        except (AssertionError, TypeError, KeyError, ValueError) as error:
+            raise RpcError(None, 'bad request') from error
+        if self.block_log is not None:
+            raise RpcError(None, 'not supported by the block log storage')
+        prev_state = aliased(AccountState)
+        next_state = aliased(AccountState)
+        columns = [
+            TransactionMutation.hash, TransactionMutation.transaction_hash,
+            Blockchain.number, Transaction.timestamp,
+            prev_state.version.label('prev_version'), prev_state.value.label('prev_value'),
+            prev_state.hash.label('prev_hash'), next_state.version.label('next_version'),
+            next_state.value.label('next_value'), next_state.hash.label('next_hash'),
+        ]
+        # noinspection PyTypeChecker
+        stmt = (
+            select(*columns)  # type: ignore
+            .join(Transaction,  # type: ignore
+                  Transaction.hash == TransactionMutation.transaction_hash)
+            .join(Blockchain, Blockchain.hash == Transaction.blockchain_hash)  # type: ignore
+            .join(prev_state, and_(  # type: ignore
+                prev_state.account == TransactionMutation.account,
+                prev_state.version == TransactionMutation.prev_version))
+            .join(next_state, and_(  # type: ignore
+                next_state.account == TransactionMutation.account,
+                next_state.version == TransactionMutation.next_version))
+            .where(TransactionMutation.account == account)
+            .order_by(TransactionMutation.next_version if asc
+                      else TransactionMutation.next_version.desc()).limit(limit))
+        if after_version is not None:
+            stmt = stmt.where(TransactionMutation.next_version > after_version if asc
+                              else TransactionMutation.next_version < after_version)
+        # every mutation increments the version, which starts from 1
+        state = (await self.latest_account_states([account])).get(account)
+        total = 0 if state is None else state.version - 1
+
+        def query(session: Session) -> Any:
+            result = list(session.execute(stmt))
+            return {
+                'data': [{
+                    'hash': item.hash,
+                    'transaction_hash': item.transaction_hash,
+                    'blockchain_number': item.number,
+                    'timestamp': item.timestamp.isoformat(),
+                    'prev_account_state': {
+                        'hash': item.prev_hash,
+                        'version': item.prev_version,
+                        'value': float(item.prev_value),
+                    },
+                    'next_account_state': {
+                        'hash': item.next_hash,
+                        'version': item.next_version,
+                        'value': float(item.next_value),
+                    },
+                } for item in result],
+                'total': total,
+                'next_cursor': encode_cursor([result[-1].next_version])
+                    if result and len(result) == limit else None,
+            }
+        return await self.read_pool.run(query)
 
     @on_requested('query-topology', peer_type='admin')
     @on_requested('query-topology', peer_type='client')
@@ -200,19 +807,40 @@ class PeerProcessor(NodeProcessor):
         if None in self.server_to_connections:
             connections = self.server_to_connections[None]
         result = []
+        requests = {}
         for connection in connections:
             config = self.connection_to_config[connection]
             if config is not None:
                 result.append(config['id'])
+                requests[config['id']] = self.request_counts(connection)
         return {
             'config': self.config,
-            'connections': result
+            'connections': result,
+            'requests': requests,
+            'signature_cache': {
+                'hits': self.signature_cache.hits,
+                'misses': self.signature_cache.misses,
+                'size': len(self.signature_cache.entries),
+            },
+            'account_state_cache': {
+                'hits': self.account_state_cache.hits,
+                'misses': self.account_state_cache.misses,
+                'size': len(self.account_state_cache.entries),
+            },
+            'block_cache': {
+                'hits': self.block_cache.hits,
+                'misses': self.block_cache.misses,
+                'size': len(self.block_cache.entries),
+                'bytes': self.block_cache.size_bytes,
+            },
         }
 
     @on_requested('query-accounts', peer_type='admin')
     @on_requested('query-accounts', peer_type='client')
     async def query_accounts_handler(self, data: Any, context: Context) -> Any:
-        assert self.session is not None
+        # pages are given either by `offset` or by the `cursor` of the previous page, which
+        # costs the same however deep the page is. `total` is null when it would be a count of
+        # the whole table, unless `count` asks for it
         try:
             account = None
             if 'account' in data:
@@ -236,7 +864,17 @@ class PeerProcessor(NodeProcessor):
                 offset = data['offset']
                 assert isinstance(offset, int)
                 assert offset >= 0
-        except (AssertionError, TypeError, KeyError) as error:
+            after = None
+            if 'cursor' in data:
+                assert 'offset' not in data
+                after = decode_cursor(data['cursor'])
+                assert len(after) == 2
+                assert isinstance(after[0], str) and isinstance(after[1], int)
+            count = False
+            if 'count' in data:
+                count = data['count']
+                assert isinstance(count, bool)
+        except (AssertionError, TypeError, KeyError, ValueError) as error:
             raise RpcError(None, 'bad request') from error
         condition: Any = None
         if account is not None and version is not None:
@@ -246,40 +884,62 @@ class PeerProcessor(NodeProcessor):
         elif version is not None:
             condition = AccountState.version == version
         if version is None and latest_version:
-            subquery = select(
-                AccountState.account,  # type: ignore
-                func.max(AccountState.version).label('latest_version')
-            )
-            if condition is not None:
-                subquery = subquery.where(condition)
-            subquery = subquery.group_by(AccountState.account).alias('latest')  # type: ignore
-            # noinspection PyUnresolvedReferences,PyTypeChecker
-            stmt = select(AccountState).join(subquery, and_(  # type: ignore
-                AccountState.account == subquery.c.account,  # type: ignore
-                AccountState.version == subquery.c.latest_version,  # type: ignore
-            ))
+            stmt = select_latest_account_states(*([] if account is None else [account]))
+            if after is not None:
+                stmt = stmt.where(AccountState.account > after[0])
         else:
             # noinspection PyTypeChecker
-            stmt = select(AccountState)  # type: ignore
+            stmt = select(AccountState).order_by(  # type: ignore
+                AccountState.account, AccountState.version)
             if condition is not None:
                 stmt = stmt.where(condition)  # type: ignore
-        total_count = list((await self.session.execute(select(
-            func.count(stmt.alias('data').c.hash)))).scalars())
-        stmt = stmt.offset(offset).limit(limit)  # type: ignore
-        result = list((await self.session.execute(stmt)).scalars())
-        return {
-            'data': [{
-                'account': item.account,
-                'version': item.version,
-                'value': float(item.value),
-            } for item in result],
-            'total': total_count[0],
-        }
+            if after is not None:
+                stmt = stmt.where(tuple_(AccountState.account, AccountState.version) >
+                                  tuple_(*after))
+        total: Optional[int] = None
+        if account is not None:
+            # versions of an account are numbered from 1
+            state = (await self.latest_account_states([account])).get(account)
+            latest = 0 if state is None else state.version
+            if latest_version:
+                total = min(latest, 1)
+            elif version is not None:
+                total = int(1 <= version <= latest)
+            else:
+                total = latest
+        elif version is None:
+            total = self.account_count if latest_version else self.account_state_count
+
+        def page(result: List[AccountState], total: Optional[int]) -> Any:
+            return {
+                'data': [{
+                    'account': item.account,
+                    'version': item.version,
+                    'value': float(item.value),
+                } for item in result],
+                'total': total,
+                'next_cursor': encode_cursor([result[-1].account, result[-1].version])
+                    if result and len(result) == limit else None,
+            }
+
+        def query(session: Session) -> Any:
+            result = list(session.execute(stmt.offset(offset).limit(limit)).scalars())
+            return page(result, session.execute(select(func.count(stmt.alias('data').c.hash)))
+                        .scalar() if total is None and count else total)
+        if self.block_log is not None:
+            # the block log only keeps the latest states
+            if not latest_version:
+                raise RpcError(None, 'not supported by the block log storage')
+            return page(self.block_log.latest_states(
+                None if account is None else [account], None if after is None else after[0],
+                offset, limit), total)
+        return await self.read_pool.run(query)
 
     @on_requested('list-blockchains', peer_type='admin')
     @on_requested('list-blockchains', peer_type='client')
     async def list_blockchains_handler(self, data: Any, context: Context) -> Any:
-        assert self.session is not None
+        # blocks are numbered from 1 without gaps, so an offset is turned into a range of
+        # numbers as a cursor is, and the total is the number of the tip
         try:
             asc = False
             if 'asc' in data:
@@ -295,21 +955,46 @@ class PeerProcessor(NodeProcessor):
                 offset = data['offset']
                 assert isinstance(offset, int)
                 assert offset >= 0
-        except (AssertionError, TypeError, KeyError) as error:
+            after_number = None
+            if 'cursor' in data:
+                assert 'offset' not in data
+                after_number, = decode_cursor(data['cursor'])
+                assert isinstance(after_number, int)
+        except (AssertionError, TypeError, KeyError, ValueError) as error:
             raise RpcError(None, 'bad request') from error
+        assert self.tip is not None
+        total = self.tip[1]
+        if after_number is None:
+            after_number = offset if asc else total + 1 - offset
+        if self.block_log is not None:
+            numbers = range(after_number + 1, min(after_number + limit, total) + 1) if asc \
+                else range(min(after_number - 1, total), max(after_number - limit - 1, 0), -1)
+            result = []
+            for number in numbers:
+                blockchain = self.block_log.read(number)
+                assert blockchain is not None
+                result.append({'hash': blockchain['hash'], 'number': number})
+            return {
+                'data': result,
+                'total': total,
+                'next_cursor': encode_cursor([result[-1]['number']])
+                    if result and len(result) == limit else None,
+            }
         # noinspection PyTypeChecker
-        stmt = select(Blockchain).order_by( # type: ignore
-            Blockchain.number if asc else Blockchain.number.desc())
-        total_count = list((await self.session.execute(select(
-            func.count(stmt.alias('data').c.hash)))).scalars())
-        result = list((await self.session.execute(
-            stmt.limit(limit).offset(offset)
-        )).scalars())
-        # noinspection PyTypeChecker
-        return {
-            'data': [{
-                'hash': item.hash.hex(),
-                'number': item.number
-            } for item in result],
-            'total': total_count[0],
-        }
+        stmt = select(Blockchain.hash, Blockchain.number).where(  # type: ignore
+            Blockchain.number > after_number if asc else Blockchain.number < after_number
+        ).order_by(Blockchain.number if asc else Blockchain.number.desc()).limit(limit)
+
+        def query(session: Session) -> Any:
+            result = list(session.execute(stmt))
+            # noinspection PyTypeChecker
+            return {
+                'data': [{
+                    'hash': item.hash,
+                    'number': item.number
+                } for item in result],
+                'total': total,
+                'next_cursor': encode_cursor([result[-1].number])
+                    if result and len(result) == limit else None,
+            }
+        return await self.read_pool.run(query)
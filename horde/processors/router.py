@@ -1,7 +1,6 @@
 import argparse
 import asyncio
 import inspect
-import json
 import logging
 import math
 import os
@@ -9,12 +8,16 @@ import random
 import string
 import traceback
 from asyncio import IncompleteReadError, Future, FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from typing import Dict, Set, Any, Callable, TypeVar, Generic, Optional, Tuple, Awaitable, \
-    ClassVar, Type
+    ClassVar, Type, Iterable, List
 
+from horde import crypto
+from horde.codec import encode, decode, HAS_MSGPACK, JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE
 from horde.sm_tls import SMTLSStreamWriter, SMTLSStreamReader, \
-    open_sm_tls_connection, start_sm_tls_server
+    open_sm_tls_connection, start_sm_tls_server, MAX_FRAME_SIZE, OFFLOAD_THRESHOLD, \
+    SessionCache, SESSION_CACHE_SIZE, SESSION_LIFETIME
 
 
 def random_id(n: int) -> str:
@@ -23,6 +26,13 @@ def random_id(n: int) -> str:
 
 
 PUB_KET_EXT = '.pub.key'
+REQUEST_TIMEOUT = 30.0
+WRITER_QUEUE_SIZE = 256
+MAX_CONCURRENT_REQUESTS = 64
+BUSY_MESSAGE = 'busy'
+# notification sent when the caller of a request gives up, params: {"id": request_id}
+CANCEL_REQUEST_METHOD = 'cancel-request'
+TLS_SESSIONS_FILE = 'tls_sessions'
 T = TypeVar("T")
 
 
@@ -43,6 +53,18 @@ class RpcError(Exception):
         self.data = data
 
 
+class RequestTimeout(RpcError):
+    pass
+
+
+class ConnectionClosed(RpcError):
+    pass
+
+
+class ServerBusy(RpcError):
+    pass
+
+
 class Context:
     router: 'Router'
     connection_id: str
@@ -76,10 +98,19 @@ class Context:
             self.router.close_server(server_id)
 
     async def request(self, method: str, data: Any = None,
-                      connection_id: Optional[str] = None) -> Any:
+                      connection_id: Optional[str] = None,
+                      timeout: Optional[float] = None) -> Any:
         if connection_id is None:
             connection_id = self.connection_id
-        return await self.router.request(method, data, connection_id)
+        return await self.router.request(method, data, connection_id, timeout)
+
+    async def request_many(self, calls: List[Tuple[str, Any]],
+                           connection_id: Optional[str] = None,
+                           timeout: Optional[float] = None,
+                           return_exceptions: bool = False) -> List[Any]:
+        if connection_id is None:
+            connection_id = self.connection_id
+        return await self.router.request_many(calls, connection_id, timeout, return_exceptions)
 
     async def notify(self, method: str, data: Any = None,
                      connection_id: Optional[str] = None) -> None:
@@ -87,6 +118,11 @@ class Context:
             connection_id = self.connection_id
         await self.router.notify(method, data, connection_id)
 
+    async def broadcast(self, method: str, data: Any = None,
+                        connections: Optional[Iterable[str]] = None,
+                        peer_type: Optional[str] = None) -> None:
+        await self.router.broadcast(method, data, connections, peer_type)
+
 
 R = TypeVar('R', bound='Router')
 
@@ -185,6 +221,28 @@ class MissingContentLength(Exception):
     pass
 
 
+def response_result(response: Any) -> Any:
+    if 'result' in response:
+        return response['result']
+    error = response.get('error')
+    if error is None:
+        raise RpcError(None, 'error from remote')
+    if error.get('message') == BUSY_MESSAGE:
+        raise ServerBusy(error.get('data'), BUSY_MESSAGE)
+    raise RpcError(error.get('data'), error.get('message'))
+
+
+def frame_message(content: Any, content_type: str) -> bytes:
+    raw_content = encode(content, content_type)
+    if content_type != JSON_CONTENT_TYPE:
+        return b'Content-Length: %d\r\nContent-Type: %s\r\n\r\n%s' % (
+            len(raw_content), content_type.encode(), raw_content)
+    if HAS_MSGPACK:
+        return b'Content-Length: %d\r\nAccept: %s\r\n\r\n%s' % (
+            len(raw_content), MSGPACK_CONTENT_TYPE.encode(), raw_content)
+    return b'Content-Length: %d\r\n\r\n%s' % (len(raw_content), raw_content)
+
+
 class Router:
     config: Any
     configs: Dict[str, Any]
@@ -193,11 +251,22 @@ class Router:
     server: Dict[str, asyncio.AbstractServer]
     server_to_connections: Dict[Optional[str], Set[str]]
     next_request_id: int
-    requests: Dict[int, Future]
+    # removed once the connection stops reading, so that no request can wait forever
+    requests: Dict[str, Dict[int, Future]]
+    timed_out_requests: Dict[str, int]
+    request_timeout: Optional[float]
+    writer_queue_size: int
+    max_concurrent_requests: int
     writer_queues: Dict[str, asyncio.Queue]
     shutdown_futures: Dict[str, Future]
     connection_to_config: Dict[str, Optional[Any]]
+    # switched to msgpack once the peer shows that it understands it
+    content_types: Dict[str, str]
     task_queue: asyncio.Queue
+    tls_executor: Optional[ProcessPoolExecutor]
+    tls_options: Dict[str, Any]
+    tls_client_sessions: SessionCache
+    tls_server_sessions: SessionCache
 
     public_key: bytes
     public_keys: Dict[str, bytes]
@@ -222,10 +291,35 @@ class Router:
         self.server_to_connections = {}
         self.next_request_id = 0
         self.requests = {}
+        self.timed_out_requests = {}
+        rpc_config = full_config.get('rpc', {})
+        self.request_timeout = rpc_config.get('request_timeout', REQUEST_TIMEOUT)
+        self.writer_queue_size = rpc_config.get('writer_queue_size', WRITER_QUEUE_SIZE)
+        self.max_concurrent_requests = rpc_config.get('max_concurrent_requests',
+                                                      MAX_CONCURRENT_REQUESTS)
         self.writer_queues = {}
         self.shutdown_futures = {}
         self.connection_to_config = {}
+        self.content_types = {}
         self.task_queue = asyncio.Queue()
+        tls_config = full_config.get('tls', {})
+        # OpenSSL encrypts a frame faster than it is sent to another process, only the pure
+        # Python backend gains from the pool
+        self.tls_executor = ProcessPoolExecutor(tls_config['offload_workers']) \
+            if tls_config.get('offload_workers') and \
+            crypto.backend.name == crypto.PysmxBackend.name else None
+        self.tls_options = {
+            'coalesce': True,
+            'max_frame_size': tls_config.get('max_frame_size', MAX_FRAME_SIZE),
+            'executor': self.tls_executor,
+            'offload_threshold': tls_config.get('offload_threshold', OFFLOAD_THRESHOLD),
+        }
+        session_cache_size = tls_config.get('session_cache_size', SESSION_CACHE_SIZE)
+        session_lifetime = tls_config.get('session_lifetime', SESSION_LIFETIME)
+        self.tls_client_sessions = SessionCache(session_cache_size, session_lifetime)
+        self.tls_server_sessions = SessionCache(session_cache_size, session_lifetime)
+        # client sessions survive restarts, so that a restarted node can resume
+        self.tls_client_sessions.load(os.path.join(self.config['root'], TLS_SESSIONS_FILE))
         for node in full_config['peers'] + full_config['clients']:
             self.configs[node['id']] = node
         with open(os.path.join(self.config['root'], 'private.key'), 'rb') as f:
@@ -252,24 +346,93 @@ class Router:
         if not exit_future.done():
             exit_future.set_result(None)
 
-    async def request(self, method: str, data: Any, connection_id: str) -> Any:
-        request_id = self.next_request_id
+    async def request(self, method: str, data: Any, connection_id: str,
+                      timeout: Optional[float] = None) -> Any:
+        responses = await self.exchange([(method, data)], connection_id, timeout, False)
+        return response_result(responses[0])
+
+    async def request_many(self, calls: List[Tuple[str, Any]], connection_id: str,
+                           timeout: Optional[float] = None,
+                           return_exceptions: bool = False) -> List[Any]:
+        # sent as one batch message and answered with one, the handlers run concurrently
+        if not calls:
+            return []
+        responses = await self.exchange(calls, connection_id, timeout, True)
+        results: List[Any] = []
+        for response in responses:
+            try:
+                results.append(response_result(response))
+            except RpcError as error:
+                if not return_exceptions:
+                    raise
+                results.append(error)
+        return results
+
+    async def exchange(self, calls: List[Tuple[str, Any]], connection_id: str,
+                       timeout: Optional[float], batch: bool) -> List[Any]:
+        if timeout is None:
+            timeout = self.request_timeout
+        if connection_id not in self.requests:
+            raise ConnectionClosed(None, 'connection closed')
         writer_queue = self.writer_queues[connection_id]
-        self.next_request_id += 1
-        self.requests[request_id] = asyncio.get_running_loop().create_future()
-        content = {
-            'id': request_id,
-            'method': method,
-            'params': data,
+        requests = self.requests[connection_id]
+        loop = asyncio.get_running_loop()
+        contents: List[Any] = []
+        futures: List[Future] = []
+        for method, data in calls:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            futures.append(requests.setdefault(request_id, loop.create_future()))
+            contents.append({
+                'id': request_id,
+                'method': method,
+                'params': data,
+            })
+
+        async def send_and_wait() -> List[Any]:
+            # waits while the connection is congested
+            await writer_queue.put(contents if batch else contents[0])
+            if batch:
+                return await asyncio.gather(*futures)
+            return [await futures[0]]
+        try:
+            return await asyncio.wait_for(send_and_wait(), timeout)
+        except asyncio.TimeoutError:
+            if connection_id in self.timed_out_requests:
+                self.timed_out_requests[connection_id] += len(contents)
+            for content in contents:
+                self.cancel_request(content['id'], connection_id)
+            raise RequestTimeout(None, 'request timeout') from None
+        except asyncio.CancelledError:
+            for content in contents:
+                self.cancel_request(content['id'], connection_id)
+            raise
+        finally:
+            for content in contents:
+                requests.pop(content['id'], None)
+
+    def cancel_request(self, request_id: int, connection_id: str) -> None:
+        # tell the remote side to cancel its handler, the response would be dropped anyway
+        if connection_id in self.requests:
+            try:
+                self.writer_queues[connection_id].put_nowait({
+                    'method': CANCEL_REQUEST_METHOD,
+                    'params': {'id': request_id},
+                })
+            except asyncio.QueueFull:
+                logging.debug('%s: cannot cancel request %d of congested %s',
+                              self.config['id'], request_id, connection_id)
+
+    def fail_requests(self, connection_id: str) -> None:
+        for future in self.requests.pop(connection_id, {}).values():
+            if not future.done():
+                future.set_exception(ConnectionClosed(None, 'connection closed'))
+
+    def request_counts(self, connection_id: str) -> Dict[str, int]:
+        return {
+            'in_flight': len(self.requests.get(connection_id, {})),
+            'timed_out': self.timed_out_requests.get(connection_id, 0),
         }
-        await writer_queue.put(content)
-        response = await self.requests[request_id]
-        if 'result' in response:
-            return response['result']
-        error = response.get('error')
-        if error is None:
-            raise RpcError(None, 'error from remote')
-        raise RpcError(error.get('data'), error.get('message'))
 
     async def notify(self, method: str, data: Any, connection_id: str) -> None:
         writer_queue = self.writer_queues[connection_id]
@@ -279,18 +442,49 @@ class Router:
         }
         await writer_queue.put(raw_content)
 
+    async def broadcast(self, method: str, data: Any,
+                        connections: Optional[Iterable[str]] = None,
+                        peer_type: Optional[str] = None) -> None:
+        # the message is encoded once per content type, not once per connection
+        if connections is None:
+            connections = list(self.connection_to_config)
+        if peer_type is not None:
+            connections = [
+                connection for connection in connections
+                if (self.connection_to_config[connection] or {}).get('type') == peer_type]
+        raw_content = {
+            'method': method,
+            'params': data,
+        }
+        messages: Dict[str, bytes] = {}
+        puts = []
+        for connection in connections:
+            content_type = self.content_types[connection]
+            if content_type not in messages:
+                messages[content_type] = frame_message(raw_content, content_type)
+            puts.append(self.writer_queues[connection].put(messages[content_type]))
+        # a congested connection should not hold back the others
+        await asyncio.gather(*puts)
+
+    def frame_outgoing(self, content: Any, connection_id: str) -> bytes:
+        if isinstance(content, bytes):  # already framed by broadcast
+            return content
+        return frame_message(content, self.content_types[connection_id])
+
     async def on_connected(self, id_: str,
                            server_id: Optional[str],
                            reader: SMTLSStreamReader,
                            writer: SMTLSStreamWriter,
                            config: Optional[Any] = None) -> None:
-        writer_queue: asyncio.Queue = asyncio.Queue()
+        writer_queue: asyncio.Queue = asyncio.Queue(self.writer_queue_size)
         exit_future: Future = Future()
         self.server_to_connections.setdefault(server_id, set()).add(id_)
         self.writer_queues[id_] = writer_queue
         self.shutdown_futures[id_] = exit_future
         self.connection_to_config[id_] = config
-        context: Optional[Context] = None
+        self.content_types[id_] = JSON_CONTENT_TYPE
+        self.requests[id_] = {}
+        self.timed_out_requests[id_] = 0
 
         def change_peer_config(new_config: Any) -> None:
             logging.info('%s: change config from %s to %s', self.config['id'],
@@ -310,8 +504,12 @@ class Router:
                     logging.info('%s: missing content length', id_)
                     return None
                 content_length = int(headers['content-length'])
-                raw_content = (await reader.readexactly(content_length)).decode()
-                return json.loads(raw_content)
+                content_type = headers.get('content-type', JSON_CONTENT_TYPE)
+                # without msgpack installed, a peer offering it keeps getting JSON
+                if HAS_MSGPACK and MSGPACK_CONTENT_TYPE in (content_type,
+                                                            headers.get('accept')):
+                    self.content_types[id_] = MSGPACK_CONTENT_TYPE
+                return decode(await reader.readexactly(content_length), content_type)
             except IncompleteReadError:
                 logging.info('%s: %s connection closed', self.config['id'], id_)
                 return None
@@ -320,118 +518,193 @@ class Router:
                 raise error
 
         logging.info('%s: connection from %s started', self.config['id'], id_)
+        read_task: Optional[asyncio.Task] = None
+        write_task: Optional[asyncio.Task] = None
         try:
             context = Context(self, id_, server_id, change_peer_config)
-            tasks: Set[Future] = set()
+            # handler and listener tasks, only waited for when the connection is closing
+            tasks: Set[asyncio.Task] = set()
+            # handler tasks of requests by request id, for cancellation
+            handler_tasks: Dict[Any, asyncio.Task] = {}
+
+            def track(task: asyncio.Task) -> asyncio.Task:
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                return task
 
             listeners = self.server_connected_listeners if server_id is None \
                 else self.client_connected_listeners
             config = self.connection_to_config[id_]
             type_ = config['type'] if config is not None else None
             if type_ is not None and type_ in listeners:
-                tasks.add(asyncio.create_task(listeners[type_](self, context)))
+                track(asyncio.create_task(listeners[type_](self, context)))
             elif None in listeners:
-                tasks.add(asyncio.create_task(listeners[None](self, context)))
-
-            read_content_task: Optional[asyncio.Task] = asyncio.create_task(read_content())
-            get_writer_queue_task = asyncio.create_task(writer_queue.get())
-
-            while True:
-                done, _ = await asyncio.wait({
-                    *([] if exit_future.done() else [exit_future]),
-                    get_writer_queue_task,
-                    *([] if read_content_task is None else [read_content_task]),
-                    *tasks,
-                }, return_when=FIRST_COMPLETED)
-                if exit_future in done:
-                    await exit_future
-                tasks -= done
-                if get_writer_queue_task in done:
-                    send_content = await get_writer_queue_task
-                    raw_send_content = json.dumps(send_content)
-                    writer.write(b'Content-Length: %d\r\n\r\n%s' % (
-                        len(raw_send_content), raw_send_content.encode()))
-                    get_writer_queue_task = asyncio.create_task(writer_queue.get())
-                if read_content_task is not None and read_content_task in done:
-                    content = await read_content_task
-                    if content is None:
-                        read_content_task = None
+                track(asyncio.create_task(listeners[None](self, context)))
+
+            async def handle_request(content: Any) -> Any:
+                method = content['method']
+                request_id = content['id']
+                config = self.connection_to_config[id_]
+                type_ = config['type'] if config is not None else None
+                handler = None
+                if (method, type_) in self.request_handlers:
+                    handler = self.request_handlers[method, type_]
+                elif (method, None) in self.request_handlers:
+                    handler = self.request_handlers[method, None]
+                if handler is None:
+                    return {
+                        'id': request_id,
+                        'error': {
+                            'message': '%s not supported' % method,
+                        },
+                    }
+                try:
+                    return {
+                        'id': request_id,
+                        'result': await handler(self, content.get('params'), context),
+                    }
+                except RpcError as error:
+                    return {
+                        'id': request_id,
+                        'error': {
+                            'message': str(error),
+                            'data': error.data,
+                        },
+                    }
+                except Exception as error:  # pylint:disable=broad-except
+                    if isinstance(error, asyncio.CancelledError):
+                        raise  # an Exception before Python 3.8, the caller gave up
+                    traceback.print_exc()
+                    return {
+                        'id': request_id,
+                        'error': {
+                            'message': 'internal server error',
+                        },
+                    }
+
+            def busy_response(request_id: Any) -> Any:
+                # refused right away, the caller may retry later
+                return {
+                    'id': request_id,
+                    'error': {
+                        'message': BUSY_MESSAGE,
+                        'data': {'limit': self.max_concurrent_requests},
+                    },
+                }
+
+            async def run_handler(content: Any) -> None:
+                await writer_queue.put(await handle_request(content))
+                handler_tasks.pop(content['id'], None)
+
+            async def run_batch(batch: List[Any]) -> None:
+                # the responses are sent in one message, in any order as in JSON-RPC
+                responses = []
+                batch_tasks = []
+                for content in batch:
+                    if len(handler_tasks) >= self.max_concurrent_requests:
+                        responses.append(busy_response(content['id']))
+                    else:
+                        handler_tasks[content['id']] = asyncio.create_task(
+                            handle_request(content))
+                        batch_tasks.append((content['id'], handler_tasks[content['id']]))
+                if batch_tasks:
+                    await asyncio.wait([task for _, task in batch_tasks])
+                for request_id, task in batch_tasks:
+                    handler_tasks.pop(request_id, None)
+                    if not task.cancelled():
+                        responses.append(task.result())
+                if responses:
+                    await writer_queue.put(responses)
+
+            async def dispatch(content: Any) -> None:
+                if isinstance(content, list):
+                    # batch
+                    batch = [item for item in content if 'id' in item and 'method' in item]
+                    if batch:
+                        track(asyncio.create_task(run_batch(batch)))
+                    for item in content:
+                        if 'id' not in item or 'method' not in item:
+                            await dispatch(item)
+                elif 'id' in content and 'method' in content:
+                    # request
+                    if len(handler_tasks) >= self.max_concurrent_requests:
+                        await writer_queue.put(busy_response(content['id']))
                     else:
-                        read_content_task = asyncio.create_task(read_content())
-                        logging.debug('%s: receive data: %s', self.config['id'], content)
-                        if 'id' in content and 'method' in content:
-                            # request
-                            method = content['method']
-                            config = self.connection_to_config[id_]
-                            type_ = config['type'] if config is not None else None
-                            handler = None
-                            if (method, type_) in self.request_handlers:
-                                handler = self.request_handlers[method, type_]
-                            elif (method, None) in self.request_handlers:
-                                handler = self.request_handlers[method, None]
-
-                            async def run_handler(method, handler, content):
-                                request_id = content['id']
-                                if handler is None:
-                                    response = {
-                                        'id': request_id,
-                                        'error': {
-                                            'message': '%s not supported' % method,
-                                        },
-                                    }
-                                else:
-                                    try:
-                                        response = {
-                                            'id': request_id,
-                                            'result': await handler(self, content.get('params'),
-                                                                    context),
-                                        }
-                                    except RpcError as error:
-                                        response = {
-                                            'id': request_id,
-                                            'error': {
-                                                'message': str(error),
-                                                'data': error.data,
-                                            },
-                                        }
-                                    except Exception:  # pylint:disable=broad-except
-                                        traceback.print_exc()
-                                        response = {
-                                            'id': request_id,
-                                            'error': {
-                                                'message': 'internal server error',
-                                            },
-                                        }
-                                await writer_queue.put(response)
-                            tasks.add(asyncio.create_task(run_handler(method, handler, content)))
-                        elif 'id' in content:
-                            # response
-                            response_id = content['id']
-                            if response_id in self.requests:
-                                self.requests[response_id].set_result(content)
-                                del self.requests[response_id]
-                        else:
-                            # notification
-                            method = content['method']
-                            config = self.connection_to_config[id_]
-                            type_ = config['type'] if config is not None else None
-                            handler = None
-                            if (method, type_) in self.notification_handlers:
-                                handler = self.notification_handlers[method, type_]
-                            elif (method, None) in self.notification_handlers:
-                                handler = self.notification_handlers[method, None]
-                            if handler is not None:
-                                tasks.add(asyncio.create_task(
-                                    handler(self, content.get('params'), context)))
-                if (exit_future.done() or read_content_task is None) \
-                        and writer_queue.empty() and not tasks:
+                        handler_tasks[content['id']] = track(asyncio.create_task(
+                            run_handler(content)))
+                elif 'id' in content:
+                    # response
+                    requests = self.requests.get(id_, {})
+                    response_id = content['id']
+                    if response_id in requests and not requests[response_id].done():
+                        requests[response_id].set_result(content)
+                elif content['method'] == CANCEL_REQUEST_METHOD:
+                    handler_task = handler_tasks.pop(
+                        (content.get('params') or {}).get('id'), None)
+                    if handler_task is not None:
+                        handler_task.cancel()
+                else:
+                    # notification
+                    method = content['method']
+                    config = self.connection_to_config[id_]
+                    type_ = config['type'] if config is not None else None
+                    handler = None
+                    if (method, type_) in self.notification_handlers:
+                        handler = self.notification_handlers[method, type_]
+                    elif (method, None) in self.notification_handlers:
+                        handler = self.notification_handlers[method, None]
+                    if handler is not None:
+                        track(asyncio.create_task(handler(self, content.get('params'), context)))
+
+            async def read_contents() -> None:
+                while True:
+                    content = await read_content()
+                    if content is None:
+                        break
+                    logging.debug('%s: receive data: %s', self.config['id'], content)
+                    await dispatch(content)
+                self.fail_requests(id_)
+
+            async def write_contents() -> None:
+                while True:
+                    send_contents = [await writer_queue.get()]
+                    while not writer_queue.empty():  # coalesced by the writer into one frame
+                        send_contents.append(writer_queue.get_nowait())
+                    for send_content in send_contents:
+                        writer.write(self.frame_outgoing(send_content, id_))
+                        writer_queue.task_done()
+                    # while a peer does not read, the writer queue fills up and senders wait
+                    await writer.drain()
+
+            read_task = asyncio.create_task(read_contents())
+            write_task = asyncio.create_task(write_contents())
+            await asyncio.wait({exit_future, read_task, write_task}, return_when=FIRST_COMPLETED)
+            # the handlers already started still finish and send their responses
+            while True:
+                for task in (read_task, write_task):
+                    if task.done():
+                        task.result()  # raises the error of the task
+                handlers = {task for task in tasks if not task.done()}
+                if not handlers and writer_queue.empty():
                     break
+                # only tasks still running, a finished one would end every wait at once
+                waited = handlers | {task for task in (read_task, write_task) if not task.done()}
+                sent_task = None
+                if not writer_queue.empty():
+                    sent_task = asyncio.create_task(writer_queue.join())
+                    waited.add(sent_task)
+                await asyncio.wait(waited, return_when=FIRST_COMPLETED)
+                if sent_task is not None:
+                    sent_task.cancel()
             writer.close()
             await writer.wait_closed()
         except Exception as error:
             traceback.print_exc()
             raise error
         finally:
+            for connection_task in (read_task, write_task):
+                if connection_task is not None:
+                    connection_task.cancel()
             # await server close
             self.server_to_connections[server_id].remove(id_)
             if not self.server_to_connections[server_id]:
@@ -439,6 +712,9 @@ class Router:
             del self.writer_queues[id_]
             del self.shutdown_futures[id_]
             del self.connection_to_config[id_]
+            del self.content_types[id_]
+            self.fail_requests(id_)
+            del self.timed_out_requests[id_]
             logging.info('%s: connection from %s stopped', self.config['id'], id_)
 
     async def start_server(self, host: str, port: int) -> str:
@@ -451,7 +727,9 @@ class Router:
             callback,
             self.private_key,
             self.public_keys,
-            host, port
+            host, port,
+            session_cache=self.tls_server_sessions,
+            **self.tls_options,
         )
 
         async def start_server():
@@ -474,7 +752,10 @@ class Router:
         reader, writer = await open_sm_tls_connection(
             self.config['id'], self.private_key,
             self.public_keys[peer_config['id']],
-            peer_host, peer_port)
+            peer_host, peer_port,
+            session_cache=self.tls_client_sessions,
+            **self.tls_options)
+        self.tls_client_sessions.save(os.path.join(self.config['root'], TLS_SESSIONS_FILE))
         await self.task_queue.put(asyncio.create_task(
             self.on_connected(id_, None, reader, writer, peer_config)))
         return id_
@@ -492,3 +773,5 @@ class Router:
                 tasks.add(new_task)
                 get_task_queue_task = asyncio.create_task(self.task_queue.get())
             tasks -= done
+        if self.tls_executor is not None:
+            self.tls_executor.shutdown()
@@ -1,69 +1,216 @@
 """Provides async reader and writer for TCP client and server with SM encrypted TLS."""
 import asyncio
+import hmac
+import json
 import os
-from typing import Tuple, Callable, Awaitable, Dict
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Tuple, Callable, Awaitable, Dict, List, Optional, Any
 
-from pysmx.SM2 import Encrypt, Decrypt  # type: ignore
-from pysmx.SM4 import Sm4, ENCRYPT, DECRYPT  # type: ignore
+from horde.crypto import sm2_encrypt, sm2_decrypt, sm3_hmac, sm4_encrypt_cbc, sm4_decrypt_cbc
 
-IV_DATA = [0x5a] * 16
+IV_DATA = bytes([0x5a] * 16)
+# consumed bytes are dropped from the reader buffer once they exceed this size
+COMPACT_THRESHOLD = 64 * 1024
+# default upper bound of the plain text carried by one frame
+MAX_FRAME_SIZE = 64 * 1024
+# frames at least this large are encrypted or decrypted by the offload executor, if given
+OFFLOAD_THRESHOLD = 16 * 1024
+# default bound and lifetime in seconds of the resumable sessions kept by SessionCache
+SESSION_CACHE_SIZE = 1024
+SESSION_LIFETIME = 3600.0
+
+
+def sm4_crypt_cbc(key: bytes, encrypt: bool, frames: List[bytes]) -> List[bytes]:
+    # module level, so that it can be sent to a process pool
+    crypt = sm4_encrypt_cbc if encrypt else sm4_decrypt_cbc
+    return [crypt(key, IV_DATA, frame) for frame in frames]
 
 
 class SMTLSStreamReader:
+    # Decrypted data is appended to `buffer` and consumed from `offset`. `scan_offset` marks how
+    # far `readuntil` has searched, so the same bytes are never scanned twice.
     inner: asyncio.StreamReader
-    buffer: bytes
+    key: bytes
+    buffer: bytearray
+    offset: int
+    scan_offset: int
+    executor: Optional[Executor]
+    offload_threshold: int
 
-    def __init__(self, inner: asyncio.StreamReader, key: bytes):
+    def __init__(self, inner: asyncio.StreamReader, key: bytes,
+                 executor: Optional[Executor] = None,
+                 offload_threshold: int = OFFLOAD_THRESHOLD):
         self.inner = inner
-        self.sm4 = Sm4()
-        self.sm4.sm4_set_key(key, DECRYPT)
-        self.buffer = b''
+        self.key = key
+        self.executor = executor
+        self.offload_threshold = offload_threshold
+        self.buffer = bytearray()
+        self.offset = 0
+        self.scan_offset = 0
+
+    def decrypt(self, data: bytes) -> bytes:
+        return sm4_decrypt_cbc(self.key, IV_DATA, data)
+
+    async def read_frame(self) -> None:
+        data_len = int.from_bytes(await self.inner.readexactly(4), byteorder='big')
+        data = await self.inner.readexactly(data_len)
+        if self.executor is not None and data_len >= self.offload_threshold:
+            data = (await asyncio.get_running_loop().run_in_executor(
+                self.executor, sm4_crypt_cbc, self.key, False, [data]))[0]
+        else:
+            data = self.decrypt(data)
+        padding = data[0]
+        self.buffer += memoryview(data)[1:len(data) - padding]
+
+    def consume(self, n: int) -> bytes:
+        start = self.offset
+        end = start + n
+        if end == len(self.buffer):
+            result = bytes(self.buffer) if start == 0 else bytes(memoryview(self.buffer)[start:])
+            self.buffer.clear()
+            self.offset = self.scan_offset = 0
+            return result
+        result = bytes(memoryview(self.buffer)[start:end])
+        self.offset = end
+        if self.scan_offset < end:
+            self.scan_offset = end
+        if end >= COMPACT_THRESHOLD and 2 * end >= len(self.buffer):
+            # amortized: the remaining bytes are moved at most once per consumed bytes
+            del self.buffer[:end]
+            self.scan_offset -= end
+            self.offset = 0
+        return result
 
     async def readexactly(self, n: int) -> bytes:
-        result = self.buffer
-        while len(result) < n:
-            data_len = int.from_bytes(await self.inner.readexactly(4), byteorder='big')
-            data = bytes(self.sm4.sm4_crypt_cbc(IV_DATA, await self.inner.readexactly(data_len)))
-            padding = int.from_bytes(data[:1], byteorder='big')
-            result += data[1:] if padding == 0 else data[1:-padding]
-        self.buffer = result[n:]
-        return result[:n]
+        while len(self.buffer) - self.offset < n:
+            await self.read_frame()
+        return self.consume(n)
 
     async def readuntil(self, separator: bytes = b'\n') -> bytes:  # separator may be multi-bytes
-        result = self.buffer
-        while result.find(separator) == -1:
-            data_len = int.from_bytes(await self.inner.readexactly(4), byteorder='big')
-            data = bytes(self.sm4.sm4_crypt_cbc(IV_DATA, await self.inner.readexactly(data_len)))
-            padding = int.from_bytes(data[:1], byteorder='big')
-            result += data[1:] if padding == 0 else data[1:-padding]
-        index = result.find(separator) + len(separator)
-        self.buffer = result[index:]
-        return result[:index]
+        index = self.buffer.find(separator, self.scan_offset)
+        while index == -1:
+            self.scan_offset = max(self.offset, len(self.buffer) - len(separator) + 1)
+            await self.read_frame()
+            index = self.buffer.find(separator, self.scan_offset)
+        return self.consume(index + len(separator) - self.offset)
 
 
 class SMTLSStreamWriter:
+    # With `coalesce`, writes issued in the same loop iteration are encrypted as one frame.
+    # Payloads larger than `max_frame_size` are always split into several frames. Writes of at
+    # least `offload_threshold` bytes are encrypted by `executor`; until they finish, later writes
+    # are queued behind them in `write_task` to keep their order.
     inner: asyncio.StreamWriter
-    sm4: Sm4
+    key: bytes
+    coalesce: bool
+    max_frame_size: int
+    executor: Optional[Executor]
+    offload_threshold: int
+    pending: List[bytes]
+    pending_size: int
+    flush_handle: Optional[asyncio.Handle]
+    write_task: Optional[asyncio.Task]
 
-    def __init__(self, inner: asyncio.StreamWriter, key: bytes):
+    def __init__(self, inner: asyncio.StreamWriter, key: bytes,
+                 coalesce: bool = False, max_frame_size: int = MAX_FRAME_SIZE,
+                 executor: Optional[Executor] = None,
+                 offload_threshold: int = OFFLOAD_THRESHOLD):
+        assert max_frame_size > 0
         self.inner = inner
-        self.sm4 = Sm4()
-        self.sm4.sm4_set_key(key, ENCRYPT)
+        self.key = key
+        self.coalesce = coalesce
+        self.max_frame_size = max_frame_size
+        self.executor = executor
+        self.offload_threshold = offload_threshold
+        self.pending = []
+        self.pending_size = 0
+        self.flush_handle = None
+        self.write_task = None
+
+    def encrypt(self, data: bytes) -> bytes:
+        return sm4_encrypt_cbc(self.key, IV_DATA, data)
+
+    def pad_frames(self, data: bytes) -> List[bytes]:
+        frames = []
+        for i in range(0, max(len(data), 1), self.max_frame_size):
+            chunk = data[i:i + self.max_frame_size]
+            padding = (15 - len(chunk)) % 16
+            frames.append(padding.to_bytes(1, byteorder='big') + chunk + b'\0' * padding)
+        return frames
+
+    @staticmethod
+    def frame_lines(encrypted_frames: List[bytes]) -> List[bytes]:
+        lines = []
+        for encrypted_data in encrypted_frames:
+            lines.append(len(encrypted_data).to_bytes(4, byteorder='big'))
+            lines.append(encrypted_data)
+        return lines
+
+    def write_frames(self, data: bytes) -> None:
+        offload = self.executor is not None and len(data) >= self.offload_threshold
+        if not offload and self.write_task is None:
+            self.inner.writelines(self.frame_lines(
+                [self.encrypt(frame) for frame in self.pad_frames(data)]))
+            return
+        loop = asyncio.get_running_loop()
+        encrypted_frames: Awaitable[List[bytes]]
+        if offload:
+            encrypted_frames = loop.run_in_executor(
+                self.executor, sm4_crypt_cbc, self.key, True, self.pad_frames(data))
+        else:
+            done: asyncio.Future = loop.create_future()
+            done.set_result([self.encrypt(frame) for frame in self.pad_frames(data)])
+            encrypted_frames = done
+        self.write_task = loop.create_task(self.write_after(self.write_task, encrypted_frames))
+
+    async def write_after(self, previous: Optional[asyncio.Task],
+                          encrypted_frames: Awaitable[List[bytes]]) -> None:
+        if previous is not None:
+            await previous
+        self.inner.writelines(self.frame_lines(await encrypted_frames))
+        if self.write_task is asyncio.current_task():
+            self.write_task = None
 
     def write(self, data: bytes) -> None:
-        padding = (15 - len(data)) % 16
-        data = padding.to_bytes(1, byteorder='big') + data + b'\0' * padding
-        encrypted_data = self.sm4.sm4_crypt_cbc(IV_DATA, data)
-        self.inner.write(len(encrypted_data).to_bytes(4, byteorder='big'))
-        self.inner.write(bytes(encrypted_data))
+        if not self.coalesce:
+            self.write_frames(data)
+            return
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.max_frame_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.pending:
+            data = b''.join(self.pending)
+            self.pending.clear()
+            self.pending_size = 0
+            self.write_frames(data)
 
     async def drain(self) -> None:
+        self.flush()
+        if self.write_task is not None:
+            # cancelling a drain must not drop the frames being written
+            await asyncio.shield(self.write_task)
         await self.inner.drain()
 
     def close(self) -> None:
-        self.inner.close()
+        self.flush()
+        if self.write_task is not None:
+            self.write_task.add_done_callback(lambda _: self.inner.close())
+        else:
+            self.inner.close()
 
     async def wait_closed(self) -> None:
+        if self.write_task is not None:
+            await self.write_task
         await self.inner.wait_closed()
 
 
@@ -71,26 +218,134 @@ class HandshakeError(Exception):
     pass
 
 
+class SessionCache:
+    # Bounded LRU of resumable sessions, entries older than `lifetime` seconds are dropped. The
+    # client side maps the server public key to (ticket, master key), the server side maps the
+    # ticket to (client id, master key).
+    max_size: int
+    lifetime: float
+    sessions: 'OrderedDict[bytes, Tuple[float, Tuple[Any, bytes]]]'
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int = SESSION_CACHE_SIZE, lifetime: float = SESSION_LIFETIME):
+        self.max_size = max_size
+        self.lifetime = lifetime
+        self.sessions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes) -> Optional[Tuple[Any, bytes]]:
+        item = self.sessions.get(key)
+        if item is None or item[0] < time.time():
+            self.sessions.pop(key, None)
+            self.misses += 1
+            return None
+        self.sessions.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: bytes, value: Tuple[Any, bytes]) -> None:
+        self.sessions[key] = time.time() + self.lifetime, value
+        self.sessions.move_to_end(key)
+        while len(self.sessions) > self.max_size:
+            self.sessions.popitem(last=False)
+
+    def pop(self, key: bytes) -> None:
+        self.sessions.pop(key, None)
+
+    def save(self, path: str) -> None:
+        # master keys in hex, readable by the owner only
+        entries = []
+        for key, (expiry, (peer, master_key)) in self.sessions.items():
+            entry = {'key': key.hex(), 'expiry': expiry, 'master_key': master_key.hex()}
+            if isinstance(peer, bytes):
+                entry['ticket'] = peer.hex()
+            else:
+                entry['id'] = peer
+            entries.append(entry)
+        file_descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(file_descriptor, 0o600)
+        with open(file_descriptor, 'w') as f:
+            json.dump(entries, f)
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path) as f:
+                sessions = [(bytes.fromhex(entry['key']), entry['expiry'],
+                             (bytes.fromhex(entry['ticket']) if 'ticket' in entry else entry['id'],
+                              bytes.fromhex(entry['master_key']))) for entry in json.load(f)]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        for key, expiry, value in sessions:
+            if expiry >= time.time():
+                self.sessions[key] = expiry, value
+        while len(self.sessions) > self.max_size:
+            self.sessions.popitem(last=False)
+
+
+def resumption_proof(master_key: bytes, *parts: bytes) -> bytes:
+    return sm3_hmac(master_key, b''.join(parts))
+
+
+async def resume_sm_tls_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                ticket: bytes, master_key: bytes) -> bytes:
+    # a zero length marks a resumption, full handshakes always carry an SM2 cipher text
+    local_nonce = os.urandom(16)
+    writer.write(bytes(4) + ticket + local_nonce +
+                 resumption_proof(master_key, b'client', ticket, local_nonce))
+    await writer.drain()
+    remote_nonce = await reader.readexactly(16)
+    remote_proof = await reader.readexactly(32)
+    if not hmac.compare_digest(
+            remote_proof, resumption_proof(master_key, b'server', local_nonce, remote_nonce)):
+        raise HandshakeError('wrong resumption proof')
+    return resumption_proof(master_key, local_nonce, remote_nonce)
+
+
 async def open_sm_tls_connection(
         local_id: str,
         local_private_key: bytes,
         remote_public_key: bytes,
         *args,
+        coalesce: bool = False,
+        max_frame_size: int = MAX_FRAME_SIZE,
+        executor: Optional[Executor] = None,
+        offload_threshold: int = OFFLOAD_THRESHOLD,
+        session_cache: Optional[SessionCache] = None,
         **kwargs,
 ) -> Tuple[SMTLSStreamReader, SMTLSStreamWriter]:
+    def wrap(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+             key: bytes) -> Tuple[SMTLSStreamReader, SMTLSStreamWriter]:
+        return SMTLSStreamReader(reader, key, executor, offload_threshold), \
+            SMTLSStreamWriter(writer, key, coalesce, max_frame_size, executor, offload_threshold)
+
+    session = session_cache.get(remote_public_key) if session_cache is not None else None
+    if session is not None:
+        assert session_cache is not None
+        reader, writer = await asyncio.open_connection(*args, **kwargs)
+        try:
+            return wrap(reader, writer, await resume_sm_tls_session(reader, writer, *session))
+        except (HandshakeError, asyncio.IncompleteReadError, ConnectionError):
+            # the server forgot the session, fall back to a full handshake
+            session_cache.pop(remote_public_key)
+            writer.close()
     try:
         reader, writer = await asyncio.open_connection(*args, **kwargs)
         local_random = os.urandom(16)
         handshake = local_id.encode() + local_random
-        handshake_encrypted = Encrypt(handshake, remote_public_key, 64)
+        handshake_encrypted = sm2_encrypt(handshake, remote_public_key)
         writer.write(len(handshake_encrypted).to_bytes(4, byteorder='big'))
         writer.write(handshake_encrypted)
         await writer.drain()
         remote_random_encrypted_len = int.from_bytes(await reader.readexactly(4), byteorder='big')
         remote_random_encrypted = await reader.readexactly(remote_random_encrypted_len)
-        remote_random = Decrypt(remote_random_encrypted, local_private_key, 64)
-        key = local_random + remote_random
-        return SMTLSStreamReader(reader, key), SMTLSStreamWriter(writer, key)
+        remote_random = sm2_decrypt(remote_random_encrypted, local_private_key)
+        # servers with a session cache append a ticket to their random
+        key = local_random + remote_random[:16]
+        if len(remote_random) == 32 and session_cache is not None:
+            session_cache.put(remote_public_key, (remote_random[16:], key))
+        return wrap(reader, writer, key)
     except (TypeError, asyncio.IncompleteReadError) as error:
         raise HandshakeError from  error
 
@@ -100,25 +355,58 @@ async def start_sm_tls_server(
         local_private_key: bytes,
         remote_public_keys: Dict[str, bytes],  # do not make copy, value may changed
         *args,
+        coalesce: bool = False,
+        max_frame_size: int = MAX_FRAME_SIZE,
+        executor: Optional[Executor] = None,
+        offload_threshold: int = OFFLOAD_THRESHOLD,
+        session_cache: Optional[SessionCache] = None,
         **kwargs,
 ) -> asyncio.AbstractServer:
+    async def resume(reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> Tuple[str, bytes]:
+        ticket = await reader.readexactly(16)
+        remote_nonce = await reader.readexactly(16)
+        remote_proof = await reader.readexactly(32)
+        session = session_cache.get(ticket) if session_cache is not None else None
+        if session is None:
+            raise KeyError(ticket)
+        remote_id, master_key = session
+        if remote_id not in remote_public_keys or not hmac.compare_digest(
+                remote_proof, resumption_proof(master_key, b'client', ticket, remote_nonce)):
+            raise KeyError(ticket)
+        local_nonce = os.urandom(16)
+        writer.write(local_nonce +
+                     resumption_proof(master_key, b'server', remote_nonce, local_nonce))
+        await writer.drain()
+        return remote_id, resumption_proof(master_key, remote_nonce, local_nonce)
+
     async def callback(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
         try:
             handshake_encrypted_len = int.from_bytes(await reader.readexactly(4), byteorder='big')
-            handshake_encrypted = await reader.readexactly(handshake_encrypted_len)
-            handshake = Decrypt(handshake_encrypted, local_private_key, 64)
-            remote_id = handshake[:-16].decode()
-            remote_random = handshake[-16:]
-            local_random = os.urandom(16)
-            local_random_encrypted = Encrypt(local_random, remote_public_keys[remote_id], 64)
-            writer.write(len(local_random_encrypted).to_bytes(4, byteorder='big'))
-            writer.write(local_random_encrypted)
-            await writer.drain()
-            key = remote_random + local_random
-            await client_connected_cb(SMTLSStreamReader(reader, key),
-                                      SMTLSStreamWriter(writer, key),
-                                      remote_id)
-        except (KeyError, TypeError):
+            if handshake_encrypted_len == 0:
+                remote_id, key = await resume(reader, writer)
+            else:
+                handshake_encrypted = await reader.readexactly(handshake_encrypted_len)
+                handshake = sm2_decrypt(handshake_encrypted, local_private_key)
+                remote_id = handshake[:-16].decode()
+                remote_random = handshake[-16:]
+                local_random = os.urandom(16)
+                key = remote_random + local_random
+                if session_cache is not None:
+                    # old clients only use the first 16 bytes of the key, the ticket is ignored
+                    ticket = os.urandom(16)
+                    session_cache.put(ticket, (remote_id, key))
+                    local_random += ticket
+                local_random_encrypted = sm2_encrypt(local_random, remote_public_keys[remote_id])
+                writer.write(len(local_random_encrypted).to_bytes(4, byteorder='big'))
+                writer.write(local_random_encrypted)
+                await writer.drain()
+            await client_connected_cb(
+                SMTLSStreamReader(reader, key, executor, offload_threshold),
+                SMTLSStreamWriter(writer, key, coalesce, max_frame_size,
+                                  executor, offload_threshold),
+                remote_id)
+        except (KeyError, TypeError, asyncio.IncompleteReadError):
             writer.close()
             await writer.wait_closed()
     return await asyncio.start_server(callback, *args, **kwargs)
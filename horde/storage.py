@@ -0,0 +1,127 @@
+"""Creates the SQLite engine of a peer with the pragmas of its storage profile.
+
+WAL lets readers run while a block is written and turns every commit into an append to the
+log. ``synchronous: full``, the default, syncs every commit before the block counts as saved.
+``synchronous: normal`` is opt-in: the log is only synced at checkpoints, so a crash of the
+process loses nothing, but a power loss or OS crash may lose the last committed blocks.
+
+The SQLite driver is synchronous and blocks the event loop while a statement runs. Queries
+therefore run on a `ReadPool` of read-only connections, each in its own thread, so that they
+neither block the event loop nor wait for each other. SQLite releases the GIL while it works.
+
+A peer may store its chain in an append-only block log instead, see `horde.blocklog`.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine  # type: ignore
+from sqlalchemy.orm import Session
+
+JOURNAL_MODE = 'wal'
+SYNCHRONOUS = 'full'
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE = 64 * 1024  # KiB
+READ_CONNECTIONS = 2
+PRIORITY_READ_CONNECTIONS = 1
+STORAGE_BACKEND = 'sqlite'
+
+T = TypeVar('T')
+JOURNAL_MODES = {'delete', 'truncate', 'persist', 'memory', 'wal', 'off'}
+SYNCHRONOUS_MODES = {'off', 'normal', 'full', 'extra'}
+STORAGE_BACKENDS = {'sqlite', 'blocklog'}
+
+
+def storage_backend(config: Any, full_config: Any) -> str:
+    # chosen per peer, or for all peers in the storage section
+    backend = config.get('storage_backend',
+                         full_config.get('storage', {}).get('backend', STORAGE_BACKEND))
+    assert backend in STORAGE_BACKENDS, 'unknown storage backend %s' % backend
+    return backend
+
+
+def create_storage_engine(path: str, storage_config: Any, read_only: bool = False) -> AsyncEngine:
+    journal_mode = storage_config.get('journal_mode', JOURNAL_MODE)
+    synchronous = storage_config.get('synchronous', SYNCHRONOUS)
+    mmap_size = int(storage_config.get('mmap_size', MMAP_SIZE))
+    cache_size = int(storage_config.get('cache_size', CACHE_SIZE))
+    assert journal_mode in JOURNAL_MODES, 'unknown journal mode %s' % journal_mode
+    assert synchronous in SYNCHRONOUS_MODES, 'unknown synchronous mode %s' % synchronous
+    engine = create_async_engine('sqlite:///' + path)
+
+    def set_pragmas(dbapi_connection: Any, _: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=%s' % journal_mode)
+        cursor.execute('PRAGMA synchronous=%s' % synchronous)
+        cursor.execute('PRAGMA mmap_size=%d' % mmap_size)
+        # negative means KiB instead of pages
+        cursor.execute('PRAGMA cache_size=%d' % -cache_size)
+        if read_only:
+            cursor.execute('PRAGMA query_only=1')
+        cursor.close()
+
+    event.listen(engine.sync_engine, 'connect', set_pragmas)
+    return engine
+
+
+class ReadLane:
+    # One read-only connection, only used from the thread of its executor
+    engine: Engine
+    executor: ThreadPoolExecutor
+    connection: Optional[Connection]
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(1)
+        self.connection = None
+
+    def run(self, func: Callable[[Session], T]) -> T:
+        if self.connection is None:
+            self.connection = self.engine.connect()
+        session = Session(bind=self.connection)
+        try:
+            return func(session)
+        finally:
+            session.close()
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class ReadPool:
+    # Runs queries on read-only connections in their own threads, one query per connection at a
+    # time. The priority lanes are only lent to consensus reads, which never wait behind queries
+    # of clients.
+    lanes: List[ReadLane]
+    available: asyncio.Queue
+    priority_available: asyncio.Queue
+
+    def __init__(self, engine: AsyncEngine, size: int = READ_CONNECTIONS,
+                 priority_size: int = PRIORITY_READ_CONNECTIONS):
+        assert size > 0 and priority_size > 0
+        self.lanes = []
+        self.available = asyncio.Queue()
+        self.priority_available = asyncio.Queue()
+        for index in range(size + priority_size):
+            lane = ReadLane(engine.sync_engine)
+            self.lanes.append(lane)
+            (self.available if index < size else self.priority_available).put_nowait(lane)
+
+    async def run(self, func: Callable[[Session], T], priority: bool = False) -> T:
+        # `func` runs in another thread, it should return plain data or loaded objects
+        queue = self.priority_available if priority else self.available
+        lane = await queue.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(lane.executor, lane.run, func)
+        finally:
+            queue.put_nowait(lane)
+
+    async def close(self) -> None:
+        loop = asyncio.get_running_loop()
+        for lane in self.lanes:
+            await loop.run_in_executor(lane.executor, lane.close)
+            lane.executor.shutdown()
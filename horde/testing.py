@@ -0,0 +1,33 @@
+"""Builds processors for the tests and benchmarks the way `main.py start` does.
+
+Every processor gets a directory of its own under the given root, with a fresh key pair and the
+public keys it trusts, and is created by its `__init__` from a config like config.yaml.
+"""
+import argparse
+import os
+from typing import Any, Dict, Optional, Type, TypeVar
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+
+from horde.processors.router import Router, PUB_KET_EXT
+
+R = TypeVar('R', bound=Router)
+
+
+def create_processor(cls: Type[R], root: str, node_id: str, node_type: str = 'endorser',
+                     sections: Optional[Any] = None,
+                     public_keys: Optional[Dict[str, bytes]] = None) -> R:
+    # `sections` are the top-level sections of config.yaml, such as `rpc` or `storage`, and
+    # `public_keys` the keys of other nodes, such as the endorser of test transactions
+    node_root = os.path.join(root, node_id)
+    public_root = os.path.join(node_root, 'public')
+    os.makedirs(public_root, exist_ok=True)
+    key_pair = generate_keypair()
+    with open(os.path.join(node_root, 'private.key'), 'wb') as f:
+        f.write(key_pair.privateKey)
+    for key_id, public_key in dict(public_keys or {}, **{node_id: key_pair.publicKey}).items():
+        with open(os.path.join(public_root, key_id + PUB_KET_EXT), 'wb') as f:
+            f.write(public_key)
+    config = {'id': node_id, 'type': node_type, 'root': node_root}
+    full_config = dict(sections or {}, public_root=public_root, peers=[config], clients=[])
+    return cls(config, full_config, argparse.Namespace())
@@ -11,8 +11,11 @@ from pysmx.SM2 import generate_keypair  # type: ignore
 import yaml
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession  # type: ignore
 
-from horde.models import Base, AccountState, Blockchain
+from horde.blocklog import BlockLog
+from horde.models import Base, AccountState, LatestAccountState, Blockchain
 from horde.processors import processor_factory
+from horde.processors.node import NodeProcessor
+from horde.storage import storage_backend
 
 
 async def init(args: argparse.Namespace) -> None:
@@ -62,6 +65,27 @@ async def init(args: argparse.Namespace) -> None:
             public_file_f.write(generated_key.publicKey)
         if nodecfg['type'] not in ['orderer', 'endorser']:
             continue
+        if storage_backend(nodecfg, config) == 'blocklog':
+            block_log = BlockLog(nodecfg['root'], config.get('storage', {}))
+            block_log.drop()
+            block_log.open()
+            block_log.append([NodeProcessor.serialize_blockchain({
+                'hash': Blockchain.compute_hash(
+                    prev_hash=prev_blockchain_hash, timestamp=timestamp, number=1,
+                    transactions=[]),
+                'prev_hash': prev_blockchain_hash, 'timestamp': timestamp, 'number': 1,
+                'transactions': [],
+            })])
+            block_log.put_states([
+                AccountState(
+                    account=node['id'], version=1, value=0.0,
+                    hash=AccountState.compute_hash(account=node['id'], version=1, value=0.0))
+                for node in [{
+                    'id': 'coinbase'
+                }] + config['clients']
+            ])
+            block_log.close()
+            continue
         engine = create_async_engine('sqlite:///' + os.path.join(nodecfg['root'], 'sqlite.db'))
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.drop_all)
@@ -76,6 +100,12 @@ async def init(args: argparse.Namespace) -> None:
                         'id': 'coinbase'
                     }] + config['clients']
                 ])
+                session.add_all([
+                    LatestAccountState(account=node['id'], version=1)
+                    for node in [{
+                        'id': 'coinbase'
+                    }] + config['clients']
+                ])
                 session.add(
                     Blockchain(
                         prev_hash=prev_blockchain_hash, timestamp=timestamp, number=1,
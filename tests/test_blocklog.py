@@ -0,0 +1,126 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from typing import Any, List
+
+from horde.blocklog import BlockLog, INDEX_ENTRY, RECORD_HEADER
+from horde.codec import as_bytes
+from horde.models import AccountState
+from horde.processors.node import NodeProcessor
+
+
+def serialized_block(number: int, versions: Any) -> Any:
+    # one transaction moving every account given to its next version
+    timestamp = datetime.utcnow()
+    mutations = []
+    for account, version in versions.items():
+        versions[account] = version + 1
+        mutations.append({
+            'hash': os.urandom(32),
+            'account': account,
+            'prev_account_state': {'hash': os.urandom(32), 'version': version,
+                                   'value': float(version)},
+            'next_account_state': {'hash': os.urandom(32), 'version': version + 1,
+                                   'value': float(version + 1)},
+        })
+    return NodeProcessor.serialize_blockchain({
+        'hash': os.urandom(32),
+        'prev_hash': os.urandom(32),
+        'timestamp': timestamp,
+        'number': number,
+        'transactions': [{
+            'hash': os.urandom(32),
+            'endorser': 'endorser1',
+            'signature': bytes(64),
+            'timestamp': timestamp,
+            'mutations': mutations,
+        }],
+    })
+
+
+def initial_states(accounts: List[str]) -> List[AccountState]:
+    return [AccountState(account=account, version=1, value=0.0,
+                         hash=AccountState.compute_hash(account, 1, 0.0)) for account in accounts]
+
+
+class BlockLogTestCase(unittest.TestCase):
+
+    def test_append(self) -> None:
+        """Blocks should be read back by number across segments and after a reopen."""
+        with tempfile.TemporaryDirectory() as root:
+            log = BlockLog(root, {'segment_size': 4096})
+            log.open()
+            log.put_states(initial_states(['client1', 'client2', 'client3']))
+            versions = {'client1': 1, 'client2': 1}
+            blocks = [serialized_block(number, versions) for number in range(1, 41)]
+            for start in range(0, 40, 8):
+                log.append(blocks[start:start + 8])
+            self.assertGreater(log.segment, 1)
+            with self.assertRaises(AssertionError):
+                log.append([serialized_block(42, {})])
+            log.close()
+            log = BlockLog(root, {'segment_size': 4096})
+            log.open()
+            self.assertEqual(log.tip, (as_bytes(blocks[-1]['hash']), 40))
+            for number in (1, 17, 40):
+                self.assertEqual(as_bytes(log.read(number)['hash']),  # type: ignore
+                                 as_bytes(blocks[number - 1]['hash']))
+            self.assertIsNone(log.read(41))
+            self.assertEqual((log.account_count, log.account_state_count), (3, 3 + 80))
+            self.assertEqual([(state.account, state.version) for state in log.latest_states()],
+                             [('client1', 41), ('client2', 41), ('client3', 1)])
+            self.assertEqual([state.account for state in log.latest_states(after='client1')],
+                             ['client2', 'client3'])
+            log.close()
+
+    def test_recover(self) -> None:
+        """A torn tail, a lost index and stale states should be repaired at open."""
+        with tempfile.TemporaryDirectory() as root:
+            log = BlockLog(root, {})
+            log.open()
+            log.put_states(initial_states(['client1']))
+            versions = {'client1': 1}
+            log.append([serialized_block(number, versions) for number in range(1, 6)])
+            length = log.segment_length
+            assert log.states is not None
+            with log.states:
+                log.states.execute("UPDATE meta SET value = 2 WHERE key = 'applied'")
+                log.states.execute("UPDATE states SET version = 3")
+            log.close()
+            # a record cut in the middle of its write, and an index not written at all
+            with open(log.segment_path(0), 'ab') as segment_file:
+                segment_file.write(RECORD_HEADER.pack(1000, 0, 0) + b'torn')
+            with open(log.index_path, 'r+b') as index_file:
+                index_file.truncate(2 * INDEX_ENTRY.size)
+            log.open()
+            self.assertEqual(os.path.getsize(log.segment_path(0)), length)
+            self.assertEqual(os.path.getsize(log.index_path), 5 * INDEX_ENTRY.size)
+            self.assertEqual(log.tip[1], 5)  # type: ignore
+            self.assertEqual(log.latest_states()[0].version, 6)
+            self.assertEqual(log.meta('applied'), 5)
+            log.append([serialized_block(6, versions)])
+            self.assertEqual(log.latest_states()[0].version, 7)
+            log.close()
+
+    def test_failed_append(self) -> None:
+        """Blocks of a failed append should leave neither records nor index entries."""
+        with tempfile.TemporaryDirectory() as root:
+            log = BlockLog(root, {'segment_size': 1024})
+            log.open()
+            log.put_states(initial_states(['client1']))
+            versions = {'client1': 1}
+            log.append([serialized_block(1, versions)])
+            tip, length = log.tip, os.path.getsize(log.segment_path(0))
+            blocks = [serialized_block(number, dict(versions)) for number in range(2, 12)]
+            blocks[-1]['transactions'][0]['endorser'] = object()  # cannot be encoded
+            with self.assertRaises(TypeError):
+                log.append(blocks)
+            self.assertEqual((log.tip, len(log.index), log.segment), (tip, 1, 0))
+            self.assertEqual(os.path.getsize(log.segment_path(0)), length)
+            self.assertFalse(os.path.exists(log.segment_path(1)))
+            self.assertEqual(os.path.getsize(log.index_path), INDEX_ENTRY.size)
+            self.assertEqual(log.latest_states()[0].version, 2)
+            log.append(blocks[:-1])
+            self.assertEqual(log.tip[1], 10)  # type: ignore
+            log.close()
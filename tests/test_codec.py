@@ -0,0 +1,52 @@
+import json
+import os
+import unittest
+from typing import Any, Dict
+
+from horde.codec import encode, decode, as_bytes, encode_cursor, decode_cursor, \
+    JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, HAS_MSGPACK
+
+
+class CodecTestCase(unittest.TestCase):
+    data: Dict[str, Any]
+
+    def setUp(self) -> None:
+        self.data = {
+            'id': 1,
+            'method': 'new-blockchain',
+            'params': {'hash': os.urandom(32), 'number': 2, 'value': 1.5, 'items': ['a', None]},
+        }
+
+    def test_json(self) -> None:
+        """JSON should carry bytes as hex strings, as peers without msgpack expect."""
+        raw = encode(self.data, JSON_CONTENT_TYPE)
+        self.assertEqual(json.loads(raw)['params']['hash'], self.data['params']['hash'].hex())
+        result = decode(raw, JSON_CONTENT_TYPE)
+        self.assertEqual(as_bytes(result['params']['hash']), self.data['params']['hash'])
+
+    @unittest.skipUnless(HAS_MSGPACK, 'msgpack is not installed')
+    def test_msgpack(self) -> None:
+        """msgpack should carry bytes as they are and be smaller than JSON."""
+        raw = encode(self.data, MSGPACK_CONTENT_TYPE)
+        self.assertEqual(decode(raw, MSGPACK_CONTENT_TYPE), self.data)
+        self.assertLess(len(raw), len(encode(self.data, JSON_CONTENT_TYPE)))
+
+    def test_as_bytes(self) -> None:
+        """Hashes may arrive as bytes or hex strings, anything else is rejected."""
+        self.assertEqual(as_bytes(b'\x01\x02'), b'\x01\x02')
+        self.assertEqual(as_bytes('0102'), b'\x01\x02')
+        self.assertRaises(AssertionError, lambda: as_bytes(12))
+        self.assertRaises(ValueError, lambda: as_bytes('xyz'))
+
+    def test_cursor(self) -> None:
+        """Cursors should round trip in URLs, anything else is rejected."""
+        cursor = encode_cursor(['client/1?', 7])
+        self.assertNotIn('=', cursor)
+        self.assertNotIn('/', cursor)
+        self.assertEqual(decode_cursor(cursor), ['client/1?', 7])
+        for invalid in ('', 'xyz', encode_cursor({'a': 1}), 'é'):  # type: ignore
+            self.assertRaises(ValueError, decode_cursor, invalid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import unittest
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+
+try:
+    from cryptography.hazmat.primitives import hashes, hmac
+except ImportError:
+    pass
+
+from horde.crypto import CryptoBackend, PysmxBackend, available_backends, sm3_hmac, \
+    CryptographyBackend
+
+
+class CryptoTestCase(unittest.TestCase):
+    """Every available backend should agree with the pysmx reference backend."""
+
+    def setUp(self) -> None:
+        self.reference = PysmxBackend()
+        self.backends = available_backends()
+        self.key_pair = generate_keypair()
+
+    def test_sm3(self) -> None:
+        for backend in self.backends:
+            for data in [b'', b'abc', os.urandom(63), os.urandom(64), os.urandom(1000)]:
+                with self.subTest(backend=backend.name, size=len(data)):
+                    self.assertEqual(backend.sm3_digest(data), self.reference.sm3_digest(data))
+
+    @unittest.skipUnless(CryptographyBackend.available(), 'needs SM3 from OpenSSL')
+    def test_sm3_hmac(self) -> None:
+        for key in [b'', b'key', os.urandom(64), os.urandom(100)]:
+            with self.subTest(size=len(key)):
+                reference = hmac.HMAC(key, hashes.SM3())  # type: ignore
+                reference.update(b'hello world')
+                self.assertEqual(sm3_hmac(key, b'hello world'), reference.finalize())
+
+    def test_sm4(self) -> None:
+        key = os.urandom(32)  # only the first 16 bytes are used
+        init_vector = os.urandom(16)
+        for backend in self.backends:
+            for size in [16, 64, 1024]:
+                with self.subTest(backend=backend.name, size=size):
+                    data = os.urandom(size)
+                    encrypted = backend.sm4_encrypt_cbc(key, init_vector, data)
+                    self.assertEqual(encrypted,
+                                     self.reference.sm4_encrypt_cbc(key, init_vector, data))
+                    self.assertEqual(backend.sm4_decrypt_cbc(key, init_vector, encrypted), data)
+
+    def test_sm2(self) -> None:
+        data = b'hello world'
+        for backend in self.backends:
+            with self.subTest(backend=backend.name):
+                signature = backend.sm2_sign(data, self.key_pair[1])
+                self.assertTrue(self.reference.sm2_verify(signature, data, self.key_pair[0]))
+                signature = self.reference.sm2_sign(data, self.key_pair[1])
+                self.assertTrue(backend.sm2_verify(signature, data, self.key_pair[0]))
+                self.assertFalse(backend.sm2_verify(signature, data + b'!', self.key_pair[0]))
+                encrypted = backend.sm2_encrypt(data, self.key_pair[0])
+                self.assertEqual(self.reference.sm2_decrypt(encrypted, self.key_pair[1]), data)
+
+    def test_incomplete_backend(self) -> None:
+        """A backend missing a primitive should fail when it is created."""
+        class DigestOnly(CryptoBackend):  # pylint: disable=abstract-method
+            name = 'digest-only'
+
+            def sm3_digest(self, data: bytes) -> bytes:
+                return data
+        with self.assertRaises(TypeError):
+            DigestOnly()  # type: ignore  # pylint: disable=abstract-class-instantiated
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from horde.crypto import sm3_digest
+from horde.merkle import leaf_hash, node_hash, merkle_root, merkle_proof, verify_merkle_proof
+
+
+class MerkleTestCase(unittest.TestCase):
+
+    def test_merkle_root(self) -> None:
+        """The root should pair leaves level by level and carry an odd node up unchanged."""
+        leaves = [sm3_digest(bytes([i])) for i in range(3)]
+        self.assertEqual(merkle_root([]), sm3_digest(b''))
+        self.assertEqual(merkle_root(leaves[:1]), leaf_hash(leaves[0]))
+        self.assertEqual(merkle_root(leaves), node_hash(
+            node_hash(leaf_hash(leaves[0]), leaf_hash(leaves[1])), leaf_hash(leaves[2])))
+        self.assertNotEqual(merkle_root(leaves), merkle_root(leaves[::-1]))
+
+    def test_merkle_proof(self) -> None:
+        """Every leaf should be proved to its root with about log2(n) hashes."""
+        for size in (1, 2, 3, 5, 8, 13):
+            leaves = [sm3_digest(bytes([i])) for i in range(size)]
+            root = merkle_root(leaves)
+            for index, leaf in enumerate(leaves):
+                proof = merkle_proof(leaves, index)
+                self.assertLessEqual(len(proof), (size - 1).bit_length())
+                self.assertTrue(verify_merkle_proof(leaf, proof, root))
+
+    def test_tampered_proof(self) -> None:
+        """A proof should fail for another leaf, another root or altered siblings."""
+        leaves = [sm3_digest(bytes([i])) for i in range(5)]
+        root = merkle_root(leaves)
+        proof = merkle_proof(leaves, 1)
+        self.assertFalse(verify_merkle_proof(leaves[2], proof, root))
+        self.assertFalse(verify_merkle_proof(leaves[1], proof, merkle_root(leaves[:4])))
+        self.assertFalse(verify_merkle_proof(
+            leaves[1], [dict(step, left=not step['left']) for step in proof], root))
+        self.assertFalse(verify_merkle_proof(
+            leaves[1], [dict(proof[0], hash=bytes(32)), *proof[1:]], root))
+        # an inner node is not a leaf, even though it hashes to the same root
+        inner = node_hash(leaf_hash(leaves[0]), leaf_hash(leaves[1]))
+        self.assertFalse(verify_merkle_proof(inner, merkle_proof(leaves, 0)[1:], root))
+
+
+if __name__ == '__main__':
+    unittest.main()
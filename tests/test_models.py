@@ -1,9 +1,29 @@
 import asyncio
 import unittest
 
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import create_async_engine  # type: ignore
 
-from horde.models import Base
+from sqlalchemy.ext.asyncio import AsyncSession  # type: ignore
+
+from horde.models import Base, AccountState, TransactionMutation, add_missing_columns, \
+    select_latest_account_states, upgrade_schema
+
+# the tables of `main.py init` before their column types were fixed and indexed
+LEGACY_TABLES = [
+    '''CREATE TABLE transactions (
+        hash BLOB NOT NULL, signature BLOB NOT NULL, endorser VARCHAR NOT NULL,
+        timestamp TIMESTAMP NOT NULL, blockchain_hash INTEGER NOT NULL, mutations_root BLOB,
+        PRIMARY KEY (hash), FOREIGN KEY(blockchain_hash) REFERENCES blockchains (hash))''',
+    '''CREATE TABLE transaction_mutations (
+        hash BLOB NOT NULL, account INTEGER NOT NULL, prev_version INTEGER NOT NULL,
+        next_version INTEGER NOT NULL, transaction_hash INTEGER NOT NULL, PRIMARY KEY (hash),
+        FOREIGN KEY(account) REFERENCES account_states (account),
+        FOREIGN KEY(prev_version) REFERENCES account_states (version),
+        FOREIGN KEY(next_version) REFERENCES account_states (version),
+        FOREIGN KEY(transaction_hash) REFERENCES transactions (hash))''',
+]
 
 
 class ModelsTestCase(unittest.TestCase):
@@ -15,3 +35,112 @@ class ModelsTestCase(unittest.TestCase):
             async with engine.begin() as conn:
                 await conn.run_sync(Base.metadata.create_all)
         asyncio.run(test())
+
+    def test_add_missing_columns(self) -> None:
+        """Databases created before the Merkle roots should get their columns in place."""
+        async def test() -> None:
+            engine = create_async_engine('sqlite:///:memory:')
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.exec_driver_sql('ALTER TABLE blockchains DROP COLUMN transactions_root')
+                await conn.run_sync(add_missing_columns)
+                await conn.run_sync(add_missing_columns)
+                result = await conn.exec_driver_sql('PRAGMA table_info(blockchains)')
+                self.assertIn('transactions_root', [row[1] for row in result])
+        asyncio.run(test())
+
+    def test_retype_columns(self) -> None:
+        """Legacy tables should be retyped and indexed in place, keeping their rows."""
+        async def test() -> None:
+            engine = create_async_engine('sqlite:///:memory:')
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.exec_driver_sql('DROP TABLE transaction_mutations')
+                await conn.exec_driver_sql('DROP TABLE transactions')
+                for statement in LEGACY_TABLES:
+                    await conn.exec_driver_sql(statement)
+                await conn.exec_driver_sql(
+                    "INSERT INTO transactions VALUES (x'01', x'02', 'endorser1', "
+                    "'2020-01-01 00:00:00.000000', x'03', NULL)")
+                # INTEGER affinity stored a numeric account name as a number
+                await conn.exec_driver_sql(
+                    "INSERT INTO transaction_mutations VALUES (x'04', '0012', 1, 2, x'01')")
+                await conn.run_sync(upgrade_schema)
+                await conn.run_sync(upgrade_schema)
+                columns = {row[1]: row[2] for row in await conn.exec_driver_sql(
+                    'PRAGMA table_info(transaction_mutations)')}
+                self.assertEqual((columns['account'], columns['transaction_hash']),
+                                 ('VARCHAR', 'BLOB'))
+                indexes = {row[1] for row in await conn.exec_driver_sql(
+                    "SELECT type, name FROM sqlite_master WHERE type = 'index'")}
+                self.assertTrue({'ix_transactions_blockchain_hash',
+                                 'ix_transaction_mutations_transaction_hash',
+                                 'ix_transaction_mutations_account_next_version'} <= indexes)
+                schema = ' '.join(row[0] for row in await conn.exec_driver_sql(
+                    'SELECT sql FROM sqlite_master WHERE sql IS NOT NULL'))
+                self.assertNotIn('_old', schema)
+                plan = ' '.join(row[3] for row in await conn.exec_driver_sql(
+                    "EXPLAIN QUERY PLAN SELECT * FROM transactions WHERE blockchain_hash = x'03'"))
+                self.assertIn('USING INDEX', plan)
+                rows = list(await conn.exec_driver_sql(
+                    'SELECT blockchain_hash, typeof(blockchain_hash) FROM transactions'))
+                self.assertEqual(rows, [(b'\x03', 'blob')])
+                rows = list(await conn.exec_driver_sql(
+                    'SELECT account, typeof(account), transaction_hash '
+                    'FROM transaction_mutations'))
+                self.assertEqual(rows, [('12', 'text', b'\x01')])
+        asyncio.run(test())
+
+    def test_retyped_row(self) -> None:
+        """A migrated mutation should load with its text account and reach its account states."""
+        async def test() -> None:
+            engine = create_async_engine('sqlite:///:memory:')
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.exec_driver_sql('DROP TABLE transaction_mutations')
+                await conn.exec_driver_sql(LEGACY_TABLES[1])
+                for version in (1, 2):
+                    await conn.exec_driver_sql(
+                        "INSERT INTO account_states VALUES ('12', ?, ?, ?)",
+                        (version, float(version), AccountState.compute_hash('12', version,
+                                                                            version)))
+                await conn.exec_driver_sql(
+                    "INSERT INTO transaction_mutations VALUES (x'04', '12', 1, 2, x'01')")
+                await conn.run_sync(upgrade_schema)
+            async with AsyncSession(engine) as session:
+                mutation = (await session.execute(
+                    select(TransactionMutation).options(  # type: ignore
+                        selectinload(TransactionMutation.prev_account_state),
+                        selectinload(TransactionMutation.next_account_state)))).scalar_one()
+                self.assertEqual((mutation.account, mutation.transaction_hash), ('12', b'\x01'))
+                self.assertEqual((mutation.prev_account_state.version,
+                                  mutation.next_account_state.value), (1, 2.0))
+        asyncio.run(test())
+
+    def test_latest_account_states(self) -> None:
+        """Upgraded databases should point every account to its latest version."""
+        async def test() -> None:
+            engine = create_async_engine('sqlite:///:memory:')
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.exec_driver_sql('DROP TABLE latest_account_states')
+            async with AsyncSession(engine) as session:
+                async with session.begin():
+                    session.add_all([
+                        AccountState(account=account, version=version, value=float(version),
+                                     hash=AccountState.compute_hash(account, version, version))
+                        for account, versions in (('alice', 3), ('bob', 1))
+                        for version in range(1, versions + 1)
+                    ])
+            async with engine.begin() as conn:
+                await conn.run_sync(upgrade_schema)
+                await conn.run_sync(upgrade_schema)
+            async with AsyncSession(engine) as session:
+                latest = list((await session.execute(select_latest_account_states())).scalars())
+                self.assertEqual([(state.account, state.version) for state in latest],
+                                 [('alice', 3), ('bob', 1)])
+                latest = list((await session.execute(
+                    select_latest_account_states('bob', 'carol'))).scalars())
+                self.assertEqual([(state.account, state.version) for state in latest],
+                                 [('bob', 1)])
+        asyncio.run(test())
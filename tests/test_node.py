@@ -0,0 +1,173 @@
+import asyncio
+import tempfile
+import unittest
+from datetime import datetime
+from typing import Any, List
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+
+from horde.merkle import merkle_root, merkle_proof
+from horde.models import AccountState, TransactionMutation, Transaction, Blockchain
+from horde.processors.node import NodeProcessor, SignatureCache, WrongHash, WrongSignature
+from horde.testing import create_processor
+
+
+def signed_transaction(private_key: bytes, endorser: str, merkle: bool = False) -> Any:
+    prev_hash = AccountState.compute_hash('client1', 1, 0.0)
+    next_hash = AccountState.compute_hash('client1', 2, 1.0)
+    mutation_hash = TransactionMutation.compute_hash(prev_hash, next_hash)
+    timestamp = datetime.utcnow()
+    signature = Transaction.compute_signature(private_key, endorser, timestamp, [mutation_hash])
+    mutations_root = merkle_root([mutation_hash]) if merkle else None
+    transaction = {
+        'hash': Transaction.compute_hash(
+            endorser, signature, timestamp, [mutation_hash], mutations_root),
+        'endorser': endorser,
+        'signature': signature,
+        'timestamp': timestamp.isoformat(),
+        'mutations': [{
+            'hash': mutation_hash,
+            'account': 'client1',
+            'prev_account_state': {'hash': prev_hash, 'version': 1, 'value': 0.0},
+            'next_account_state': {'hash': next_hash, 'version': 2, 'value': 1.0},
+        }],
+    }
+    if merkle:
+        transaction['mutations_root'] = mutations_root
+    return transaction
+
+
+class NodeTestCase(unittest.TestCase):
+    public_key: bytes
+    transaction: Any
+    merkle_transactions: List[Any]
+    root: str
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.public_key, private_key = generate_keypair()
+        cls.transaction = signed_transaction(private_key, 'endorser1')
+        cls.merkle_transactions = [signed_transaction(private_key, 'endorser1', merkle=True)
+                                   for _ in range(3)]
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def node(self, workers: int = 0) -> NodeProcessor:
+        # verifying in the event loop, or in a pool of `workers` processes until the test ends
+        node = create_processor(NodeProcessor, self.root, 'node%d' % workers, sections={
+            'verification': {'workers': workers, 'chunk_size': 2},
+        }, public_keys={'endorser1': self.public_key})
+        if node.verify_executor is not None:
+            self.addCleanup(node.verify_executor.shutdown)
+        return node
+
+    def test_check_valid_transactions(self) -> None:
+        """The verification pool should give the same result as verifying in the event loop."""
+        data = [self.transaction] * 5
+        inline = asyncio.run(self.node().check_valid_transactions(data))
+        node = self.node(2)
+        pooled = asyncio.run(node.check_valid_transactions(data))
+        self.assertEqual(len(pooled), 5)
+        self.assertEqual(pooled, inline)
+        self.assertEqual(asyncio.run(node.check_valid_transactions([])), [])
+
+    def test_check_invalid_transactions(self) -> None:
+        """Invalid transactions should raise the same errors from the verification pool."""
+        node = self.node(2)
+        wrong_signature = dict(self.transaction, signature=bytes(64))
+        wrong_hash = dict(self.transaction, hash=bytes(32))
+        with self.assertRaises(WrongSignature):
+            asyncio.run(node.check_valid_transactions([self.transaction] * 3 + [wrong_signature]))
+        with self.assertRaises(WrongHash):
+            asyncio.run(node.check_valid_transactions([wrong_hash, self.transaction]))
+        with self.assertRaises(AssertionError):
+            asyncio.run(node.check_valid_transactions(
+                [dict(self.transaction, endorser='nobody')]))
+
+    def test_signature_cache(self) -> None:
+        """A verified transaction should only be hashed again, never trusted if altered."""
+        node = self.node()
+        node.check_valid_transaction(self.transaction)
+        self.assertEqual((node.signature_cache.hits, node.signature_cache.misses), (0, 1))
+        asyncio.run(node.check_valid_transactions([self.transaction] * 2))
+        self.assertEqual((node.signature_cache.hits, node.signature_cache.misses), (2, 1))
+        altered = dict(self.transaction, timestamp=datetime.utcnow().isoformat())
+        with self.assertRaises(WrongHash):
+            node.check_valid_transaction(altered)
+        with self.assertRaises(WrongHash):
+            asyncio.run(node.check_valid_transactions([altered]))
+        with self.assertRaises(WrongSignature):
+            node.check_valid_transaction(dict(self.transaction, signature=bytes(64)))
+        self.assertEqual(len(node.signature_cache.entries), 1)
+
+    def test_signature_cache_bounds(self) -> None:
+        """The cache should evict the least recently used entries by count and by bytes."""
+        cache = SignatureCache(max_size=3)
+        keys = [(bytes([i]) * 32, 'endorser1', bytes([i]) * 64) for i in range(4)]
+        for key in keys[:3]:
+            cache.put(key)
+        self.assertTrue(cache.get(keys[0]))
+        cache.put(keys[3])
+        self.assertFalse(cache.get(keys[1]))
+        self.assertEqual(list(cache.entries), [keys[2], keys[0], keys[3]])
+        cache = SignatureCache(max_bytes=2 * (32 + 9 + 64))
+        for key in keys:
+            cache.put(key)
+        self.assertEqual(list(cache.entries), keys[2:])
+        self.assertEqual(cache.size_bytes, 2 * (32 + 9 + 64))
+        self.assertFalse(cache.get(None))
+
+    def test_merkle_roots(self) -> None:
+        """Roots should be checked against the content and be optional for older blocks."""
+        node = self.node()
+        transaction = self.merkle_transactions[0]
+        self.assertEqual(node.check_valid_transaction(transaction)['mutations_root'],
+                         transaction['mutations_root'])
+        self.assertIsNone(node.check_valid_transaction(self.transaction)['mutations_root'])
+        with self.assertRaises(WrongHash):
+            node.check_valid_transaction(dict(transaction, mutations_root=bytes(32)))
+        with self.assertRaises(WrongHash):
+            # the root is covered by the hash, dropping it does not give a legacy transaction
+            node.check_valid_transaction(
+                {key: value for key, value in transaction.items() if key != 'mutations_root'})
+
+    def test_check_valid_transaction_proof(self) -> None:
+        """A transaction should be proved to be in a block from the block header alone."""
+        node = self.node()
+        transaction_hashs = [transaction['hash'] for transaction in self.merkle_transactions]
+        timestamp = datetime.utcnow()
+        transactions_root = merkle_root(transaction_hashs)
+        header = {
+            'hash': Blockchain.compute_hash(
+                bytes(32), timestamp, 2, transaction_hashs, transactions_root),
+            'prev_hash': bytes(32),
+            'timestamp': timestamp.isoformat(),
+            'number': 2,
+            'transactions_root': transactions_root,
+        }
+        blockchain = asyncio.run(node.check_valid_blockchain(
+            dict(header, transactions=self.merkle_transactions)))
+        self.assertEqual(node.serialize_blockchain(blockchain)['transactions_root'],
+                         transactions_root)
+        for index, transaction in enumerate(self.merkle_transactions):
+            proof = {
+                'blockchain': header,
+                'transaction': transaction,
+                'index': index,
+                'proof': merkle_proof(transaction_hashs, index),
+            }
+            self.assertEqual(node.check_valid_transaction_proof(proof)['hash'],
+                             transaction['hash'])
+        with self.assertRaises(WrongHash):
+            node.check_valid_transaction_proof(dict(
+                proof, transaction=self.merkle_transactions[0]))
+        with self.assertRaises(WrongHash):
+            node.check_valid_transaction_proof(dict(
+                proof, blockchain=dict(header, number=3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
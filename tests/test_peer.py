@@ -0,0 +1,577 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pysmx.SM2 import generate_keypair  # type: ignore
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession  # type: ignore
+
+from horde.blocklog import BlockLog
+from horde.codec import encode_cursor, as_bytes, encode, decode
+from horde.models import Base, AccountState, LatestAccountState, TransactionMutation, \
+    Transaction, Blockchain
+from horde.processors.peer import PeerProcessor, BlockCache
+from horde.processors.router import RpcError, Context
+from horde.storage import create_storage_engine
+from horde.testing import create_processor
+
+
+async def init_database(peer: PeerProcessor, accounts: List[str],
+                        timestamp: Optional[datetime] = None) -> None:
+    # the same genesis as `main.py init`
+    async with peer.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    timestamp = timestamp or datetime.utcnow()
+    async with AsyncSession(peer.engine) as session:
+        async with session.begin():
+            session.add_all([AccountState(
+                account=account, version=1, value=0.0,
+                hash=AccountState.compute_hash(account, 1, 0.0)) for account in accounts])
+            session.add_all([LatestAccountState(account=account, version=1)
+                             for account in accounts])
+            session.add(Blockchain(
+                prev_hash=bytes(32), timestamp=timestamp, number=1,
+                hash=Blockchain.compute_hash(bytes(32), timestamp, 1, [])))
+
+
+def init_block_log(block_log: BlockLog, accounts: List[str],
+                   timestamp: Optional[datetime] = None) -> None:
+    # the same genesis as `main.py init` on the block log storage, left open
+    block_log.open()
+    timestamp = timestamp or datetime.utcnow()
+    block_log.append([PeerProcessor.serialize_blockchain({
+        'hash': Blockchain.compute_hash(bytes(32), timestamp, 1, []),
+        'prev_hash': bytes(32), 'timestamp': timestamp, 'number': 1, 'transactions': [],
+    })])
+    block_log.put_states([AccountState(
+        account=account, version=1, value=0.0,
+        hash=AccountState.compute_hash(account, 1, 0.0)) for account in accounts])
+
+
+def block(prev_hash: bytes, number: int, states: List[AccountState], amount: float) -> Any:
+    # signatures are not checked when saving, only the account states matter here
+    mutations = []
+    for state in states:
+        next_hash = AccountState.compute_hash(state.account, state.version + 1,
+                                              state.value + amount)
+        mutations.append({
+            'hash': TransactionMutation.compute_hash(state.hash, next_hash),
+            'account': state.account,
+            'prev_account_state': {
+                'hash': state.hash, 'version': state.version, 'value': state.value},
+            'next_account_state': {
+                'hash': next_hash, 'version': state.version + 1, 'value': state.value + amount},
+        })
+    timestamp = datetime.utcnow()
+    return {
+        'hash': os.urandom(32),
+        'prev_hash': prev_hash,
+        'timestamp': timestamp,
+        'number': number,
+        'transactions': [{
+            'hash': os.urandom(32),
+            'endorser': 'endorser1',
+            'signature': bytes(64),
+            'timestamp': timestamp,
+            'mutations': mutations,
+        }],
+    }
+
+
+def signed_block(private_key: bytes, prev_hash: bytes, number: int, states: List[AccountState],
+                 amount: float) -> Any:
+    # a block that passes `check_valid_blockchain`, signed by endorser1
+    blockchain = block(prev_hash, number, states, amount)
+    transaction = blockchain['transactions'][0]
+    mutation_hashes = [mutation['hash'] for mutation in transaction['mutations']]
+    transaction['signature'] = Transaction.compute_signature(
+        private_key, 'endorser1', transaction['timestamp'], mutation_hashes)
+    transaction['hash'] = Transaction.compute_hash(
+        'endorser1', transaction['signature'], transaction['timestamp'], mutation_hashes)
+    blockchain['hash'] = Blockchain.compute_hash(
+        prev_hash, blockchain['timestamp'], number, [transaction['hash']])
+    return blockchain
+
+
+def add_blockchain_with_orm(session: AsyncSession, blockchain: Any) -> None:
+    # how blocks were saved before Core inserts
+    session.add(Blockchain(
+        hash=blockchain['hash'], prev_hash=blockchain['prev_hash'],
+        timestamp=blockchain['timestamp'], number=blockchain['number'],
+        transactions_root=blockchain.get('transactions_root')))
+    for transaction in blockchain['transactions']:
+        session.add(Transaction(
+            hash=transaction['hash'], signature=transaction['signature'],
+            endorser=transaction['endorser'], timestamp=transaction['timestamp'],
+            blockchain_hash=blockchain['hash'], mutations_root=transaction.get('mutations_root')))
+        for mutation in transaction['mutations']:
+            account = mutation['next_account_state']
+            session.add(TransactionMutation(
+                hash=mutation['hash'], account=mutation['account'],
+                prev_version=mutation['prev_account_state']['version'],
+                next_version=account['version'], transaction_hash=transaction['hash']))
+            session.add(AccountState(
+                hash=account['hash'], version=account['version'], value=account['value'],
+                account=mutation['account']))
+            session.add(LatestAccountState(account=mutation['account'],
+                                           version=account['version']))
+
+
+def peer_context(peer: PeerProcessor, connection_id: str = 'client') -> Context:
+    # the context of a request received by `peer` on `connection_id`
+    return Context(peer, connection_id, None, lambda config: None)
+
+
+class PeerTestCase(unittest.TestCase):
+    root: str
+    cleanups: AsyncExitStack
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def run_async(self, test: Callable[[], Awaitable[None]]) -> None:
+        # the peers started by the test are stopped in its event loop, even when it fails
+        async def run() -> None:
+            async with AsyncExitStack() as self.cleanups:
+                await test()
+        asyncio.run(run())
+
+    async def start_peer(self, name: str, accounts: List[str], sections: Optional[Any] = None,
+                         timestamp: Optional[datetime] = None,
+                         public_keys: Optional[Dict[str, bytes]] = None) -> PeerProcessor:
+        """Creates a peer and the genesis of its storage, and starts its writer as `start` does.
+
+        `sections` configure the peer as in config.yaml, the peer is stopped by the cleanups.
+        """
+        peer = create_processor(PeerProcessor, self.root, name, sections=sections,
+                                public_keys=public_keys)
+        if peer.block_log is None:
+            await init_database(peer, accounts, timestamp)
+        else:
+            init_block_log(peer.block_log, accounts, timestamp)
+        await peer.warm_state_cache()
+        peer.tip_loaded.set()
+        writer_task = asyncio.create_task(peer.write_blockchains())
+
+        async def stop() -> None:
+            writer_task.cancel()
+            if peer.block_log is not None:
+                peer.block_log.close()
+            await peer.read_pool.close()
+            await peer.engine.dispose()
+        self.cleanups.push_async_callback(stop)
+        return peer
+
+    @staticmethod
+    async def grow(peer: PeerProcessor, count: int, accounts: List[str],
+                   amount: float = 1.0) -> List[Any]:
+        # blocks moving `amount` to each of `accounts`, saved one after the other
+        blocks = []
+        for _ in range(count):
+            assert peer.tip is not None
+            states = await peer.latest_account_states(accounts)
+            blocks.append(block(peer.tip[0], peer.tip[1] + 1,
+                                [states[account] for account in accounts], amount))
+            await peer.save_blockchain(blocks[-1])
+        return blocks
+
+    def test_state_cache(self) -> None:
+        """The tip and cached account states should match the database after every block."""
+        async def test() -> None:
+            peer = await self.start_peer('sqlite', ['coinbase', 'client1', 'client2'],
+                                         {'cache': {'account_states': 2}})
+            self.assertEqual(len(peer.account_state_cache.entries), 2)
+            self.assertEqual(await peer.check_state_cache(), [])
+            for _ in range(3):
+                await self.grow(peer, 1, ['coinbase', 'client1'], 1.5)
+                self.assertEqual(await peer.check_state_cache(), [])
+            assert peer.tip is not None
+            self.assertEqual(peer.tip[1], 4)
+            states = await peer.latest_account_states(['coinbase', 'client2', 'nobody'])
+            self.assertEqual({account: (state.version, state.value)
+                              for account, state in states.items()},
+                             {'coinbase': (4, 4.5), 'client2': (1, 0.0)})
+            self.assertEqual(await peer.check_state_cache(), [])
+            # a state read before a newer block was saved does not replace it
+            peer.account_state_cache.put(AccountState(
+                account='coinbase', version=1, value=0.0, hash=bytes(32)))
+            self.assertEqual(await peer.check_state_cache(), [])
+            peer.account_state_cache.entries['client2'].value = 1.0
+            self.assertEqual(len(await peer.check_state_cache()), 1)
+        self.run_async(test)
+
+    def test_block_cache(self) -> None:
+        """Cached blocks should be answered as read from the database, within both limits."""
+        async def test() -> None:
+            peer = await self.start_peer('sqlite', ['coinbase', 'client1'],
+                                         {'cache': {'blocks': 2}})
+            context = peer_context(peer)
+            await self.grow(peer, 3, ['coinbase', 'client1'])
+            uncached = [await peer.query_blockchain_handler({'blockchain_number': number},
+                                                            context) for number in range(1, 5)]
+            self.assertEqual((peer.block_cache.hits, peer.block_cache.misses), (0, 4))
+            self.assertEqual(list(peer.block_cache.entries), [3, 4])
+            cached = [await peer.query_blockchain_handler({'blockchain_number': number},
+                                                          context) for number in (3, 4)]
+            self.assertEqual(cached, uncached[2:])
+            self.assertEqual(peer.block_cache.hits, 2)
+            size = peer.block_cache.size_bytes
+            self.assertEqual(size, sum(entry[1] for entry in peer.block_cache.entries.values()))
+            # the byte limit evicts the least recently used blocks too
+            peer.block_cache = BlockCache(max_bytes=size - 1)
+            for number in range(1, 5):
+                await peer.query_blockchain_handler({'blockchain_number': number}, context)
+            self.assertLessEqual(peer.block_cache.size_bytes, size - 1)
+            self.assertIn(4, peer.block_cache.entries)
+            self.assertNotIn(3, peer.block_cache.entries)
+        self.run_async(test)
+
+    def test_pagination(self) -> None:
+        """Pages read by cursors should match pages read by offsets, with counted totals."""
+        async def test() -> None:
+            peer = await self.start_peer('sqlite', ['coinbase', 'client1', 'client2'])
+            context = peer_context(peer)
+            await self.grow(peer, 6, ['coinbase', 'client1'])
+            self.assertEqual(await peer.check_state_cache(), [])
+
+            async def pages(handler: Any, query: Any) -> List[Any]:
+                items: List[Any] = []
+                while True:
+                    page = await handler(dict(query, limit=4), context)
+                    items.extend(page['data'])
+                    if page['next_cursor'] is None:
+                        return items
+                    query = dict(query, cursor=page['next_cursor'])
+
+            for asc in (False, True):
+                everything = await peer.list_blockchains_handler({'asc': asc, 'limit': 100},
+                                                                 context)
+                self.assertEqual(everything['total'], 7)
+                self.assertEqual([item['number'] for item in everything['data']],
+                                 sorted(range(1, 8), reverse=not asc))
+                self.assertEqual(await pages(peer.list_blockchains_handler, {'asc': asc}),
+                                 everything['data'])
+                page = await peer.list_blockchains_handler(
+                    {'asc': asc, 'offset': 4, 'limit': 2}, context)
+                self.assertEqual(page['data'], everything['data'][4:6])
+            account_queries: List[Tuple[Dict[str, Any], Optional[int]]] = [
+                ({}, 3 + 12), ({'latest_version': True}, 3), ({'account': 'client1'}, 7),
+                ({'account': 'client2', 'latest_version': True}, 1),
+                ({'account': 'client1', 'version': 8}, 0), ({'version': 2}, None)]
+            for query, total in account_queries:
+                everything = await peer.query_accounts_handler(dict(query, limit=100), context)
+                self.assertEqual(everything['total'], total)
+                self.assertEqual(await pages(peer.query_accounts_handler, query),
+                                 everything['data'])
+            page = await peer.query_accounts_handler({'version': 2, 'count': True}, context)
+            self.assertEqual(page['total'], 2)
+            for query in ({'cursor': 'xyz'}, {'cursor': encode_cursor([1])},
+                          {'cursor': encode_cursor(['coinbase', 1]), 'offset': 1}):
+                with self.assertRaises(RpcError):
+                    await peer.query_accounts_handler(query, context)
+            with self.assertRaises(RpcError):
+                await peer.list_blockchains_handler({'cursor': encode_cursor(['coinbase', 1])},
+                                                    context)
+        self.run_async(test)
+
+    def test_lookups(self) -> None:
+        """Transactions and account histories should be found without walking the blocks."""
+        async def test() -> None:
+            peer = await self.start_peer('sqlite', ['coinbase', 'client1', 'client2'])
+            context = peer_context(peer)
+            blocks = []
+            for index in range(5):
+                blocks += await self.grow(
+                    peer, 1, ['coinbase', 'client1' if index % 2 else 'client2'], 2.0)
+            transaction = blocks[2]['transactions'][0]
+            result = await peer.query_transaction_handler({'hash': transaction['hash']}, context)
+            self.assertEqual(result['blockchain']['number'], 4)
+            self.assertEqual(result['blockchain']['hash'], blocks[2]['hash'])
+            self.assertEqual(result['transaction']['hash'], transaction['hash'])
+            self.assertEqual(len(result['transaction']['mutations']), 2)
+            with self.assertRaises(RpcError):
+                await peer.query_transaction_handler({'hash': bytes(32)}, context)
+
+            history = await peer.query_account_history_handler({'account': 'coinbase'}, context)
+            self.assertEqual(history['total'], 5)
+            self.assertEqual([item['blockchain_number'] for item in history['data']],
+                             [6, 5, 4, 3, 2])
+            self.assertEqual(history['data'][2]['transaction_hash'], transaction['hash'])
+            self.assertEqual([(item['prev_account_state']['value'],
+                               item['next_account_state']['value'])
+                              for item in history['data']][:2], [(8.0, 10.0), (6.0, 8.0)])
+            for asc in (False, True):
+                items: List[Any] = []
+                query = {'account': 'coinbase', 'asc': asc, 'limit': 2}
+                while True:
+                    page = await peer.query_account_history_handler(query, context)
+                    items.extend(page['data'])
+                    if page['next_cursor'] is None:
+                        break
+                    query = dict(query, cursor=page['next_cursor'])
+                self.assertEqual(items, history['data'][::1 if not asc else -1])
+            history = await peer.query_account_history_handler({'account': 'client1'}, context)
+            self.assertEqual([item['blockchain_number'] for item in history['data']], [5, 3])
+            self.assertEqual(history['total'], 2)
+            history = await peer.query_account_history_handler({'account': 'nobody'}, context)
+            self.assertEqual((history['data'], history['total']), ([], 0))
+            with self.assertRaises(RpcError):
+                await peer.query_account_history_handler({}, context)
+        self.run_async(test)
+
+    def test_block_log(self) -> None:
+        """A peer on the block log should serve blocks and latest states as on SQLite."""
+        async def test() -> None:
+            peer = await self.start_peer('blocklog', ['coinbase', 'client1', 'client2'], {
+                'cache': {'account_states': 2},
+                'storage': {'backend': 'blocklog', 'segment_size': 4096},
+            })
+            assert peer.block_log is not None
+            context = peer_context(peer)
+            blocks = []
+            for _ in range(20):
+                blocks += await self.grow(peer, 1, ['coinbase', 'client1'])
+                self.assertEqual(await peer.check_state_cache(), [])
+            self.assertGreater(peer.block_log.segment, 0)
+            blockchain = await peer.query_blockchain_handler({'blockchain_number': 7}, context)
+            self.assertEqual(as_bytes(blockchain['hash']), blocks[5]['hash'])
+            self.assertEqual(as_bytes(blockchain['transactions'][0]['mutations'][0]['hash']),
+                             blocks[5]['transactions'][0]['mutations'][0]['hash'])
+            with self.assertRaises(RpcError):
+                await peer.query_blockchain_handler({'blockchain_number': 22}, context)
+            for asc in (False, True):
+                page = await peer.list_blockchains_handler(
+                    {'asc': asc, 'offset': 2, 'limit': 3}, context)
+                self.assertEqual(page['total'], 21)
+                self.assertEqual([item['number'] for item in page['data']],
+                                 [3, 4, 5] if asc else [19, 18, 17])
+                numbers: List[int] = []
+                query = {'asc': asc, 'limit': 8}
+                while True:
+                    page = await peer.list_blockchains_handler(query, context)
+                    numbers.extend(item['number'] for item in page['data'])
+                    if page['next_cursor'] is None:
+                        break
+                    query = dict(query, cursor=page['next_cursor'])
+                self.assertEqual(numbers, sorted(range(1, 22), reverse=not asc))
+            result = await peer.fetch_blockchains_handler({'from_number': 19, 'count': 5},
+                                                          context)
+            self.assertEqual(result['tip'], 21)
+            self.assertEqual([as_bytes(blockchain['hash'])
+                              for blockchain in result['blockchains']],
+                             [blockchain['hash'] for blockchain in blocks[17:]])
+            page = await peer.query_accounts_handler({'latest_version': True}, context)
+            self.assertEqual(page['total'], 3)
+            self.assertEqual([(item['account'], item['version'], item['value'])
+                              for item in page['data']],
+                             [('client1', 21, 20.0), ('client2', 1, 0.0),
+                              ('coinbase', 21, 20.0)])
+            page = await peer.query_accounts_handler({'latest_version': True, 'limit': 2},
+                                                     context)
+            page = await peer.query_accounts_handler(
+                {'latest_version': True, 'cursor': page['next_cursor']}, context)
+            self.assertEqual([item['account'] for item in page['data']], ['coinbase'])
+            with self.assertRaises(RpcError):
+                await peer.query_accounts_handler({}, context)
+            with self.assertRaises(RpcError):
+                await peer.query_transaction_handler(
+                    {'hash': blocks[0]['transactions'][0]['hash']}, context)
+            # before the genesis is appended
+            empty = create_processor(PeerProcessor, self.root, 'empty',
+                                     sections={'storage': {'backend': 'blocklog'}})
+            self.cleanups.push_async_callback(empty.engine.dispose)
+            self.cleanups.push_async_callback(empty.read_pool.close)
+            assert empty.block_log is not None
+            empty.block_log.open()
+            self.cleanups.callback(empty.block_log.close)
+            await empty.warm_state_cache()
+            self.assertEqual(await empty.check_state_cache(), [])
+        self.run_async(test)
+
+    def test_sync(self) -> None:
+        """A lagging peer should fetch the missed blocks in ranges and stop at a bad one."""
+        async def test() -> None:
+            public_key, private_key = generate_keypair()
+            accounts = ['coinbase', 'client1', 'client2']
+            timestamp = datetime.utcnow()
+            # sends fewer blocks than asked for, the ranges start again
+            source = await self.start_peer('source', accounts, {'sync': {'batch_size': 3}},
+                                           timestamp)
+            lagging = await self.start_peer('endorser2', accounts, {
+                'cache': {'account_states': 2},
+                'sync': {'batch_size': 4, 'pipeline': 3},
+            }, timestamp, {'endorser1': public_key})
+            source_context = peer_context(source, 'lagging')
+            lagging_context = peer_context(lagging, 'source')
+            broadcasts = []
+
+            async def broadcast(method: str, data: Any) -> None:
+                broadcasts.append((method, data))
+            lagging.broadcast = broadcast  # type: ignore
+            requests = []
+            bad_number = None
+
+            async def request(method: str, data: Any, connection_id: str) -> Any:
+                # through the JSON encoding, as over a connection
+                requests.append(data['from_number'])
+                result = await source.fetch_blockchains_handler(data, source_context)
+                result['blockchains'] = [blockchain for blockchain in result['blockchains']
+                                         if blockchain['number'] != bad_number]
+                return decode(encode({'result': result}))['result']
+            lagging.request = request  # type: ignore
+
+            async def grow_signed(count: int) -> List[Any]:
+                blocks = []
+                for index in range(count):
+                    assert source.tip is not None
+                    account = accounts[1 + index % 2]
+                    states = await source.latest_account_states(['coinbase', account])
+                    blocks.append(signed_block(
+                        private_key, source.tip[0], source.tip[1] + 1,
+                        [states['coinbase'], states[account]], 1.0))
+                    await source.save_blockchain(blocks[-1])
+                return blocks
+
+            async def sync() -> None:
+                # as when the source connects
+                await lagging.on_peer_connected(lagging_context)
+                assert lagging.sync_task is not None
+                await lagging.sync_task
+            await grow_signed(20)
+            await sync()
+            self.assertEqual(lagging.tip, source.tip)
+            self.assertEqual(requests[0], 2)
+            self.assertEqual(await lagging.check_state_cache(), [])
+            self.assertEqual(
+                await lagging.query_blockchain_handler({'blockchain_number': 21},
+                                                       lagging_context),
+                await source.query_blockchain_handler({'blockchain_number': 21},
+                                                      source_context))
+
+            # a synced block the live verification saved first is not saved again
+            blocks = await grow_signed(2)
+            await asyncio.gather(lagging.save_blockchain(blocks[0]), *[
+                lagging.save_blockchain(blockchain, synced=True) for blockchain in blocks])
+            self.assertEqual(lagging.tip, source.tip)
+            await lagging.save_blockchain(blocks[1], synced=True)
+            self.assertEqual(await lagging.check_state_cache(), [])
+            # nor one that does not follow the tip
+            blocks = await grow_signed(2)
+            with self.assertRaises(AssertionError):
+                await lagging.save_blockchain(blocks[1], synced=True)
+
+            # a range missing a block stops the sync before it
+            await grow_signed(10)
+            bad_number = 27
+            await sync()
+            assert lagging.tip is not None
+            self.assertEqual(lagging.tip[1], 26)
+            self.assertEqual(await lagging.check_state_cache(), [])
+            bad_number = None
+
+            # a block ahead of the tip waits for the sync of the ones before it
+            blocks = await grow_signed(3)
+            assert source.tip is not None
+            states = await source.latest_account_states(['coinbase', 'client1'])
+            ahead = signed_block(private_key, source.tip[0], source.tip[1] + 1,
+                                 [states['coinbase'], states['client1']], 1.0)
+            await lagging.new_blockchain_handler(PeerProcessor.serialize_blockchain(ahead),
+                                                 lagging_context)
+            self.assertIn(ahead['number'], lagging.waiting_blockchains)
+            assert lagging.sync_task is not None
+            await lagging.sync_task
+            self.assertEqual(lagging.tip, (ahead['hash'], ahead['number']))
+            self.assertEqual(lagging.waiting_blockchains, {})
+            self.assertEqual(broadcasts, [('new-blockchain-verified', {
+                'hash': ahead['hash'], 'verified': True})])
+            self.assertEqual(await lagging.check_state_cache(), [])
+            self.assertEqual(len(blocks), 3)
+            with self.assertRaises(RpcError):
+                await source.fetch_blockchains_handler({'from_number': 0}, source_context)
+        self.run_async(test)
+
+    def test_group_commit(self) -> None:
+        """Blocks saved back to back should share transactions, a bad one failing alone."""
+        async def test() -> None:
+            accounts = ['client%d' % i for i in range(10)]
+            peer = await self.start_peer('sqlite', accounts, {'storage': {'group_commit_size': 4}})
+            assert peer.tip is not None
+            states = await peer.latest_account_states(accounts)
+            blocks = []
+            prev_hash, number = peer.tip
+            for account in accounts:
+                blocks.append(block(prev_hash, number + 1, [states[account]], 1.0))
+                prev_hash, number = blocks[-1]['hash'], number + 1
+            # the same block twice, its second insert breaks the primary key
+            blocks.insert(5, blocks[4])
+            commits = 0
+            commit_blockchains = peer.commit_blockchains
+
+            async def counted_commit_blockchains(blockchains: List[Any]) -> None:
+                nonlocal commits
+                commits += 1
+                await commit_blockchains(blockchains)
+            peer.commit_blockchains = counted_commit_blockchains  # type: ignore
+            results = await asyncio.gather(*[peer.save_blockchain(blockchain)
+                                             for blockchain in blocks],
+                                           return_exceptions=True)
+            self.assertEqual([index for index, result in enumerate(results)
+                              if result is not None], [5])
+            # 3 groups of 4, the second one retried block by block
+            self.assertEqual(commits, 3 + 4)
+            self.assertEqual(peer.tip, (prev_hash, number))
+            self.assertEqual(await peer.read_pool.run(lambda session: session.execute(
+                select(func.count(Blockchain.hash))).scalar()), 11)
+            self.assertEqual(await peer.check_state_cache(), [])
+        self.run_async(test)
+
+    def test_insert_blockchains(self) -> None:
+        """Core inserts should write the same rows as the ORM did."""
+        async def dump(path: str) -> Any:
+            engine = create_storage_engine(path, {})
+            async with engine.connect() as conn:
+                result = {table.name: list((await conn.exec_driver_sql(
+                    'SELECT * FROM %s ORDER BY rowid' % table.name)).all())
+                    for table in Base.metadata.sorted_tables}
+            await engine.dispose()
+            return result
+
+        async def test() -> None:
+            with tempfile.TemporaryDirectory() as root:
+                states = [AccountState(account='client%d' % i, version=1, value=0.0,
+                                       hash=AccountState.compute_hash('client%d' % i, 1, 0.0))
+                          for i in range(3)]
+                blocks = [block(bytes(32), 2, states[:2], 0.1)]
+                blocks.append(block(blocks[0]['hash'], 3, states[2:], 0.2))
+                blocks[1]['transactions_root'] = os.urandom(32)
+                blocks[1]['transactions'][0]['mutations_root'] = os.urandom(32)
+                paths = []
+                for name in ('orm', 'core'):
+                    path = os.path.join(root, name + '.db')
+                    engine = create_storage_engine(path, {})
+                    async with engine.begin() as conn:
+                        await conn.run_sync(Base.metadata.create_all)
+                    async with AsyncSession(engine) as session:
+                        async with session.begin():
+                            if name == 'orm':
+                                for blockchain in blocks:
+                                    add_blockchain_with_orm(session, blockchain)
+                            else:
+                                await PeerProcessor.insert_blockchains(session, blocks)
+                    await engine.dispose()
+                    paths.append(path)
+                orm, core = await dump(paths[0]), await dump(paths[1])
+                self.assertEqual(len(core['transaction_mutations']), 3)
+                self.assertEqual(orm, core)
+        asyncio.run(test())
+
+
+if __name__ == '__main__':
+    unittest.main()
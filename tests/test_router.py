@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import tracemalloc
+import unittest
+from typing import Any, List, Tuple, cast
+from unittest import mock
+
+from horde.codec import JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE, HAS_MSGPACK
+from horde.processors.router import Router, Context, RequestTimeout, ConnectionClosed, \
+    ServerBusy, RpcError, processor, on_requested, frame_message
+from horde.sm_tls import SMTLSStreamReader, SMTLSStreamWriter
+from horde.testing import create_processor
+
+
+def fake_router(root: str, content_types, peer_types) -> Router:
+    # connections that only queue what is sent to them
+    router = create_processor(Router, root, 'router')
+    for i, (content_type, peer_type) in enumerate(zip(content_types, peer_types)):
+        id_ = 'connection%d' % i
+        router.writer_queues[id_] = asyncio.Queue()
+        router.connection_to_config[id_] = {'id': 'node%d' % i, 'type': peer_type}
+        router.content_types[id_] = content_type
+    return router
+
+
+@processor
+class SleepProcessor(Router):
+    # handlers cancelled by the caller
+    cancelled: int
+
+    def __init__(self, config: Any, full_config: Any, args: argparse.Namespace):
+        super().__init__(config, full_config, args)
+        self.cancelled = 0
+
+    @on_requested('echo')
+    async def echo_handler(self, data: Any, context: Context) -> Any:
+        return data
+
+    @on_requested('sleep')
+    async def sleep_handler(self, data: Any, context: Context) -> Any:
+        try:
+            await asyncio.sleep(data)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+
+async def connect(client: Router, server: Router) -> Tuple[str, asyncio.AbstractServer,
+                                                          asyncio.StreamWriter]:
+    """Connects two routers over plain TCP.
+
+    Returns the connection id of the client, the TCP server and the writer of the server side.
+    """
+    connected = asyncio.Event()
+    server_writers = []
+
+    async def callback(reader, writer):
+        server_writers.append(writer)
+        connected.set()
+        asyncio.create_task(server.on_connected('client', 'server', reader, writer,
+                                                {'id': 'client', 'type': 'client'}))
+    tcp_server = await asyncio.start_server(callback, '127.0.0.1', 0)
+    assert tcp_server.sockets
+    port = tcp_server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    # plain TCP, the router only uses the stream interface of the SM TLS reader and writer
+    asyncio.create_task(client.on_connected('server', None, cast(SMTLSStreamReader, reader),
+                                            cast(SMTLSStreamWriter, writer),
+                                            {'id': 'server', 'type': 'peer'}))
+    await connected.wait()
+    await asyncio.sleep(0)
+    return 'server', tcp_server, server_writers[0]
+
+
+class RouterTestCase(unittest.TestCase):
+    root: str
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def router(self, id_: str, **rpc: Any) -> SleepProcessor:
+        # configured by the `rpc` section of config.yaml
+        return create_processor(SleepProcessor, self.root, id_, sections={'rpc': rpc})
+
+    def test_broadcast(self) -> None:
+        """A broadcast should be framed once per content type and shared between connections."""
+        content_types = [JSON_CONTENT_TYPE] * 3
+        if HAS_MSGPACK:
+            content_types += [MSGPACK_CONTENT_TYPE] * 2
+        router = fake_router(self.root, content_types, ['peer'] * len(content_types))
+        data = {'hash': b'\x01' * 32, 'number': 2}
+        asyncio.run(router.broadcast('new-blockchain', data))
+        items = {id_: queue.get_nowait() for id_, queue in router.writer_queues.items()}
+        for id_, item in items.items():
+            self.assertEqual(item, frame_message({'method': 'new-blockchain', 'params': data},
+                                                 router.content_types[id_]))
+            self.assertIs(router.frame_outgoing(item, id_), item)
+        self.assertEqual(len({id(item) for item in items.values()}), len(set(content_types)))
+
+    def test_broadcast_selection(self) -> None:
+        """Only the given connections of the given peer type should receive a broadcast."""
+        router = fake_router(self.root, [JSON_CONTENT_TYPE] * 4, ['peer', 'peer', 'client', 'peer'])
+        asyncio.run(router.broadcast('ping', None, ['connection0', 'connection2', 'connection3'],
+                                     'peer'))
+        received = [id_ for id_, queue in router.writer_queues.items() if not queue.empty()]
+        self.assertEqual(received, ['connection0', 'connection3'])
+
+    def test_without_msgpack(self) -> None:
+        """A node without msgpack should keep answering in JSON a peer that offers msgpack."""
+        async def run() -> None:
+            server = self.router('server')
+
+            async def callback(reader, writer):
+                asyncio.create_task(server.on_connected('client', 'server', reader, writer,
+                                                        {'id': 'client', 'type': 'client'}))
+            tcp_server = await asyncio.start_server(callback, '127.0.0.1', 0)
+            assert tcp_server.sockets
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', tcp_server.sockets[0].getsockname()[1])
+            content = json.dumps({'id': 0, 'method': 'echo', 'params': 'hello'}).encode()
+            writer.write(b'Content-Length: %d\r\nAccept: %s\r\n\r\n%s' % (
+                len(content), MSGPACK_CONTENT_TYPE.encode(), content))
+            headers = (await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 1)).decode()
+            self.assertNotIn(MSGPACK_CONTENT_TYPE, headers)
+            length = int(headers.split('Content-Length:')[1].split('\r\n')[0])
+            self.assertEqual(json.loads(await reader.readexactly(length)),
+                             {'id': 0, 'result': 'hello'})
+            self.assertEqual(server.content_types.get('client', JSON_CONTENT_TYPE),
+                             JSON_CONTENT_TYPE)
+            writer.close()
+            server.close_connection('client')
+            tcp_server.close()
+        with mock.patch('horde.processors.router.HAS_MSGPACK', False):
+            asyncio.run(run())
+
+    def test_request_timeout(self) -> None:
+        """A timed out request should be counted and cancel the handler on the remote side."""
+        async def run() -> None:
+            client = self.router('client', request_timeout=0.1)
+            server = self.router('server')
+            connection, tcp_server, _ = await connect(client, server)
+            self.assertEqual(await client.request('echo', 'hello', connection), 'hello')
+            with self.assertRaises(RequestTimeout):
+                await client.request('sleep', 10, connection)
+            with self.assertRaises(RequestTimeout):
+                await client.request('sleep', 10, connection, timeout=0.05)
+            self.assertEqual(client.request_counts(connection), {'in_flight': 0, 'timed_out': 2})
+            await asyncio.sleep(0.1)
+            self.assertEqual(server.cancelled, 2)
+            client.close_connection(connection)
+            server.close_connection('client')
+            tcp_server.close()
+        asyncio.run(run())
+
+    def test_request_connection_closed(self) -> None:
+        """In-flight requests should fail as soon as the connection stops reading."""
+        async def run() -> None:
+            client = self.router('client')
+            server = self.router('server')
+            connection, tcp_server, server_writer = await connect(client, server)
+            pending = asyncio.gather(*[client.request('sleep', 10, connection)
+                                       for _ in range(3)], return_exceptions=True)
+            await asyncio.sleep(0.05)
+            self.assertEqual(client.request_counts(connection)['in_flight'], 3)
+            # the server dies without answering
+            cast(asyncio.Transport, server_writer.transport).abort()
+            tcp_server.close()
+            results = await asyncio.wait_for(pending, 1)
+            self.assertTrue(all(isinstance(result, ConnectionClosed) for result in results))
+            self.assertEqual(client.requests, {})
+            with self.assertRaises(ConnectionClosed):
+                await client.request('echo', 'hello', connection)
+        asyncio.run(run())
+
+    def test_closed_with_handlers_in_flight(self) -> None:
+        """A peer closing its side should still get the responses of its running requests."""
+        async def run() -> None:
+            server = self.router('server')
+            server_task = None
+
+            async def callback(reader, writer):
+                nonlocal server_task
+                server_task = asyncio.create_task(server.on_connected(
+                    'client', 'server', reader, writer, {'id': 'client', 'type': 'client'}))
+            tcp_server = await asyncio.start_server(callback, '127.0.0.1', 0)
+            assert tcp_server.sockets
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', tcp_server.sockets[0].getsockname()[1])
+            content = json.dumps({'id': 0, 'method': 'sleep', 'params': 0.5}).encode()
+            writer.write(b'Content-Length: %d\r\n\r\n%s' % (len(content), content))
+            writer.write_eof()
+            start = time.process_time()
+            self.assertIn(b'"result": null', await asyncio.wait_for(reader.read(), 2))
+            # the server waited for the handler instead of polling its finished read task
+            self.assertLess(time.process_time() - start, 0.2)
+            assert server_task is not None
+            await asyncio.wait_for(server_task, 1)
+            self.assertNotIn('client', server.writer_queues)
+            writer.close()
+            tcp_server.close()
+        asyncio.run(run())
+
+    def test_busy(self) -> None:
+        """Requests over the concurrency limit of a connection should be refused as busy."""
+        async def run() -> None:
+            client = self.router('client')
+            server = self.router('server', max_concurrent_requests=2)
+            connection, tcp_server, _ = await connect(client, server)
+            results = await asyncio.gather(*[client.request('sleep', 0.1, connection)
+                                             for _ in range(5)], return_exceptions=True)
+            self.assertEqual(results[:2], [None, None])
+            self.assertTrue(all(isinstance(result, ServerBusy) for result in results[2:]))
+            self.assertIsNone(await client.request('sleep', 0, connection))
+            client.close_connection(connection)
+            server.close_connection('client')
+            tcp_server.close()
+        asyncio.run(run())
+
+    def test_request_many(self) -> None:
+        """A batch should run its handlers concurrently and keep the results in order."""
+        async def run() -> None:
+            client = self.router('client')
+            server = self.router('server', max_concurrent_requests=4)
+            connection, tcp_server, _ = await connect(client, server)
+            start = asyncio.get_running_loop().time()
+            calls: List[Tuple[str, Any]] = [('sleep', 0.1)] * 3 + [('echo', 'hello')]
+            results = await client.request_many(calls, connection)
+            self.assertLess(asyncio.get_running_loop().time() - start, 0.25)
+            self.assertEqual(results, [None, None, None, 'hello'])
+            self.assertEqual(await client.request_many([], connection), [])
+            calls = [('nope', None)] + [('echo', i) for i in range(5)]
+            results = await client.request_many(calls, connection, return_exceptions=True)
+            self.assertEqual(str(results[0]), 'nope not supported')
+            self.assertEqual(sum(isinstance(result, ServerBusy) for result in results), 2)
+            with self.assertRaises(RpcError):
+                await client.request_many([('echo', 1), ('nope', None)], connection)
+            with self.assertRaises(RequestTimeout):
+                await client.request_many([('sleep', 10), ('echo', 1)], connection, timeout=0.05)
+            await asyncio.sleep(0.1)
+            self.assertEqual(server.cancelled, 1)
+            self.assertEqual(client.request_counts(connection), {'in_flight': 0, 'timed_out': 2})
+            client.close_connection(connection)
+            server.close_connection('client')
+            tcp_server.close()
+        asyncio.run(run())
+
+    def test_stalled_peer(self) -> None:
+        """Memory should stay flat while sending to a peer that stopped reading."""
+        async def run() -> None:
+            client = self.router('client', writer_queue_size=16)
+            stalled = []
+            tcp_server = await asyncio.start_server(
+                lambda reader, writer: stalled.append(writer), '127.0.0.1', 0)
+            assert tcp_server.sockets
+            port = tcp_server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            asyncio.create_task(client.on_connected(
+                'server', None, cast(SMTLSStreamReader, reader), cast(SMTLSStreamWriter, writer),
+                {'id': 'server', 'type': 'peer'}))
+            await asyncio.sleep(0)
+            sent = 0
+            payload = 'x' * 16384
+
+            async def produce() -> None:
+                nonlocal sent
+                while True:
+                    await client.notify('ping', payload, 'server')
+                    sent += 1
+            producer = asyncio.create_task(produce())
+            await asyncio.sleep(1)  # the socket buffers of both sides fill up
+            tracemalloc.start()
+            sent_before = sent
+            await asyncio.sleep(1)
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertEqual(sent, sent_before)
+            self.assertLess(memory, 1024 * 1024)
+            self.assertEqual(client.writer_queues['server'].qsize(), 16)
+            producer.cancel()
+            tcp_server.close()
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,17 @@
 import asyncio
+import os
 import string
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 
 from pysmx.SM2 import generate_keypair  # type: ignore
 
+from horde import crypto
 from horde.sm_tls import open_sm_tls_connection, SMTLSStreamWriter, SMTLSStreamReader, \
-    start_sm_tls_server, HandshakeError
+    start_sm_tls_server, HandshakeError, SessionCache
 
 
 class SMTLSTestCase(unittest.TestCase):
@@ -33,9 +38,23 @@ class SMTLSTestCase(unittest.TestCase):
         await writer.wait_closed()
 
     @staticmethod
-    async def echo_client(reader: SMTLSStreamReader, writer: SMTLSStreamWriter) -> bool:
+    async def line_echo_server(reader: SMTLSStreamReader, writer: SMTLSStreamWriter,
+                               peer_id) -> None:
+        try:
+            while True:
+                writer.write(await reader.readuntil(b'\n'))
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    @staticmethod
+    async def echo_client(reader: SMTLSStreamReader, writer: SMTLSStreamWriter,
+                          chunk_size: int = 0) -> bool:
         content = (string.ascii_lowercase + string.digits * 100 + '\n').encode()
-        writer.write(content)
+        if chunk_size:
+            for i in range(0, len(content), chunk_size):
+                writer.write(content[i:i + chunk_size])
+        else:
+            writer.write(content)
         await writer.drain()
         part_a = await reader.readexactly(11)  # change this number should always be ok
         part_b = await reader.readuntil(b'\n')
@@ -62,6 +81,142 @@ class SMTLSTestCase(unittest.TestCase):
         result = asyncio.run(test())
         self.assertTrue(result)
 
+    def test_tls_fragmented(self) -> None:
+        """Reads spanning many small frames should be reassembled."""
+        client_id = 'hello'
+
+        async def test() -> bool:
+            host = '127.0.0.1'
+            server = await start_sm_tls_server(SMTLSTestCase.echo_server, self.key_pair1[1], {
+                client_id: self.key_pair2[0],
+            }, host)
+            assert server.sockets is not None
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await open_sm_tls_connection(
+                    client_id, self.key_pair2[1], self.key_pair1[0], host, port)
+                return await SMTLSTestCase.echo_client(reader, writer, chunk_size=7)
+        result = asyncio.run(test())
+        self.assertTrue(result)
+
+    def test_tls_coalesce_and_split(self) -> None:
+        """Coalesced small writes and split large writes should be read back unchanged."""
+        client_id = 'hello'
+
+        async def test() -> bool:
+            host = '127.0.0.1'
+            server = await start_sm_tls_server(SMTLSTestCase.echo_server, self.key_pair1[1], {
+                client_id: self.key_pair2[0],
+            }, host, coalesce=True, max_frame_size=100)
+            assert server.sockets is not None
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await open_sm_tls_connection(
+                    client_id, self.key_pair2[1], self.key_pair1[0], host, port,
+                    coalesce=True, max_frame_size=64)
+                return await SMTLSTestCase.echo_client(reader, writer, chunk_size=7)
+        result = asyncio.run(test())
+        self.assertTrue(result)
+
+    def test_tls_offload_latency(self) -> None:
+        """Small requests should not wait for large frames of another connection."""
+        client_id = 'hello'
+
+        async def test() -> float:
+            host = '127.0.0.1'
+            with ThreadPoolExecutor(2) as executor:
+                server = await start_sm_tls_server(
+                    SMTLSTestCase.line_echo_server, self.key_pair1[1], {
+                        client_id: self.key_pair2[0],
+                    }, host, executor=executor, offload_threshold=1024)
+                assert server.sockets is not None
+                port = server.sockets[0].getsockname()[1]
+                async with server:
+                    bulk_reader, bulk_writer = await open_sm_tls_connection(
+                        client_id, self.key_pair2[1], self.key_pair1[0], host, port,
+                        executor=executor, offload_threshold=1024)
+                    small_reader, small_writer = await open_sm_tls_connection(
+                        client_id, self.key_pair2[1], self.key_pair1[0], host, port,
+                        executor=executor, offload_threshold=1024)
+
+                    async def bulk() -> None:
+                        for _ in range(2):
+                            bulk_writer.write(b'x' * (16 * 1024 - 1) + b'\n')
+                            await bulk_reader.readuntil(b'\n')
+                    bulk_task = asyncio.create_task(bulk())
+                    latencies = []
+                    while not bulk_task.done():
+                        start = time.perf_counter()
+                        small_writer.write(b'ping\n')
+                        await small_reader.readuntil(b'\n')
+                        latencies.append(time.perf_counter() - start)
+                    await bulk_task
+                    bulk_writer.close()
+                    small_writer.close()
+                    await bulk_writer.wait_closed()
+                    await small_writer.wait_closed()
+            latencies.sort()
+            return latencies[int(len(latencies) * 0.99)]
+        # a 16 KiB frame keeps the pure Python SM4 busy for a few hundred milliseconds
+        previous_backend = crypto.backend.name
+        crypto.use_backend('pysmx')
+        try:
+            self.assertLess(asyncio.run(test()), 0.1)
+        finally:
+            crypto.use_backend(previous_backend)
+
+    def test_tls_resumption(self) -> None:
+        """Reconnecting clients should resume, and fall back when the server forgot them."""
+        client_id = 'hello'
+        client_cache = SessionCache()
+
+        async def test(server_cache: SessionCache) -> bool:
+            host = '127.0.0.1'
+            server = await start_sm_tls_server(SMTLSTestCase.echo_server, self.key_pair1[1], {
+                client_id: self.key_pair2[0],
+            }, host, session_cache=server_cache)
+            assert server.sockets is not None
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await open_sm_tls_connection(
+                    client_id, self.key_pair2[1], self.key_pair1[0], host, port,
+                    session_cache=client_cache)
+                return await SMTLSTestCase.echo_client(reader, writer)
+        server_cache = SessionCache()
+        self.assertTrue(asyncio.run(test(server_cache)))
+        self.assertEqual(server_cache.hits, 0)
+        self.assertTrue(asyncio.run(test(server_cache)))
+        self.assertEqual(server_cache.hits, 1)
+        self.assertTrue(asyncio.run(test(SessionCache())))
+        self.assertEqual(client_cache.hits, 2)
+        self.assertEqual(len(client_cache.sessions), 1)
+
+    def test_session_cache_bounds(self) -> None:
+        """Session cache should evict the least recently used and expired sessions."""
+        cache = SessionCache(max_size=2, lifetime=60.0)
+        cache.put(b'a', ('a', b''))
+        cache.put(b'b', ('b', b''))
+        self.assertIsNotNone(cache.get(b'a'))
+        cache.put(b'c', ('c', b''))
+        self.assertIsNone(cache.get(b'b'))
+        self.assertIsNotNone(cache.get(b'a'))
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'sessions')
+            cache.save(path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            cache2 = SessionCache(max_size=1)
+            cache2.load(path)
+            self.assertEqual(list(cache2.sessions), [b'a'])
+            # the client side keeps tickets
+            cache2.put(b'e', (b'ticket', b'master key'))
+            cache2.save(path)
+            cache3 = SessionCache()
+            cache3.load(path)
+            self.assertEqual(cache3.get(b'e'), (b'ticket', b'master key'))
+        cache.lifetime = -1.0
+        cache.put(b'd', ('d', b''))
+        self.assertIsNone(cache.get(b'd'))
+
     def test_tls_fail_on_wrong_client_key(self) -> None:
         """When client offers wrong key, server should reject it"""
         client_id = 'hello'
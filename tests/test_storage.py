@@ -0,0 +1,69 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from horde.models import Base, Blockchain
+from horde.storage import create_storage_engine, ReadPool
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def test_pragmas(self) -> None:
+        """Connections should use the storage profile, read-only ones refusing writes."""
+        async def test() -> None:
+            with tempfile.TemporaryDirectory() as root:
+                path = os.path.join(root, 'sqlite.db')
+                engine = create_storage_engine(path, {'synchronous': 'full'})
+                async with engine.begin() as conn:
+                    await conn.run_sync(Base.metadata.create_all)
+                    self.assertEqual(
+                        (await conn.exec_driver_sql('PRAGMA journal_mode')).scalar(), 'wal')
+                    self.assertEqual(
+                        (await conn.exec_driver_sql('PRAGMA synchronous')).scalar(), 2)
+                read_engine = create_storage_engine(path, {}, read_only=True)
+                async with read_engine.connect() as conn:
+                    with self.assertRaises(OperationalError):
+                        await conn.exec_driver_sql('DELETE FROM blockchains')
+                await engine.dispose()
+                await read_engine.dispose()
+        asyncio.run(test())
+
+    def test_read_pool(self) -> None:
+        """Consensus reads should get a connection while every other one is busy."""
+        async def test() -> None:
+            with tempfile.TemporaryDirectory() as root:
+                path = os.path.join(root, 'sqlite.db')
+                engine = create_storage_engine(path, {})
+                async with engine.begin() as conn:
+                    await conn.run_sync(Base.metadata.create_all)
+                pool = ReadPool(create_storage_engine(path, {}, read_only=True), 2, 1)
+                release = threading.Event()
+                threads = set()
+
+                def explorer_read(session: Session) -> int:
+                    threads.add(threading.get_ident())
+                    release.wait()
+                    return session.execute(select(func.count(Blockchain.hash))).scalar()
+
+                explorer_tasks = [asyncio.create_task(pool.run(explorer_read)) for _ in range(4)]
+                while len(threads) < 2:
+                    await asyncio.sleep(0.01)
+                self.assertEqual(await pool.run(lambda session: session.execute(
+                    select(func.count(Blockchain.hash))).scalar(), priority=True), 0)
+                self.assertEqual(pool.available.qsize(), 0)
+                release.set()
+                self.assertEqual(await asyncio.gather(*explorer_tasks), [0] * 4)
+                self.assertEqual(len(threads), 2)
+                self.assertEqual(pool.available.qsize(), 2)
+                await pool.close()
+                await engine.dispose()
+        asyncio.run(test())
+
+if __name__ == '__main__':
+    unittest.main()